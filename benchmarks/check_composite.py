@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Check that make_composite runs on a weather_type.nc written by
+make_weather_type
+
+The fixtures of fixtures.py go through the same functions as the Makefile:
+rainfall and zonal wind anomalies, weather types of the wind over the WT
+box saved with write_weather_types, and then make_composite is started as
+in the RAIN_WT_COMP rule. The check fails if the weather type file is not
+along time or if the composite does not cover every weather type and lag.
+Run with PYTHONPATH=src, as the Makefile does.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src", "process"))
+
+# pylint: disable=C0413
+import numpy as np
+import xarray as xr
+import regions
+from fixtures import write_all
+from make_anomaly import calc_anomaly
+from make_weather_type import (
+    calc_pcs,
+    loop_kmeans,
+    matrix_classifiability,
+    write_weather_types,
+)
+from pipeline import _box
+
+parser = argparse.ArgumentParser()  # pylint: disable=C0103
+parser.add_argument("--syear", type=int, default=1979, help="first year")
+parser.add_argument("--n_cluster", type=int, default=4, help="number of clusters")
+parser.add_argument("--n_sim", type=int, default=10, help="KMeans runs")
+
+LAGS = [-2, -1, 0, 1, 2]
+
+
+def check(workdir, syear, n_cluster, n_sim):
+    """Make the weather types and their rainfall composite in workdir
+    """
+    eyear = syear + 1
+    write_all(workdir, syear, eyear)
+    out = {name: os.path.join(workdir, name + ".nc") for name in ["rain", "uwnd"]}
+    for name, pattern, box, to_daily in [
+        ("rain", "cpc_rain_*.nc", "RAIN", 0),
+        ("uwnd", "reanalysisv2_uwnd_850_*.nc", "RNLS", 1),
+    ]:
+        calc_anomaly(
+            os.path.join(workdir, pattern),
+            out[name],
+            syear,
+            eyear,
+            *_box(box),
+            to_daily=to_daily
+        )
+
+    with xr.open_dataset(out["uwnd"]) as data:
+        field = regions.subset(data["anomaly"], regions.box("WT", *_box("WT")))
+        field = field.load()
+    pc_ts, _ = calc_pcs(field, var_xpl=0.9)
+    centroids, wtypes = loop_kmeans(pc_ts, n_cluster, n_sim)
+    class_idx, best_part = matrix_classifiability(centroids)
+    wtfile = os.path.join(workdir, "weather_type.nc")
+    write_weather_types(wtypes[best_part, :], field["time"], class_idx, wtfile)
+    with xr.open_dataset(wtfile) as wtype:
+        assert wtype["wtype"].dims == ("time",), wtype["wtype"].dims
+
+    outfile = os.path.join(workdir, "rain_wt_composite.nc")
+    script = os.path.join(HERE, "..", "src", "process", "make_composite.py")
+    subprocess.check_call(
+        [sys.executable, script, "--infile", out["rain"], "--catfile", wtfile]
+        + ["--catvar", "wtype", "--n_boot", "10", "--block", "5"]
+        + ["--lags"]
+        + [str(lag) for lag in LAGS]
+        + ["--outfile", outfile]
+    )
+    with xr.open_dataset(outfile) as result:
+        counts = {name: result.sizes[name] for name in result.dims}
+        assert counts.get("lag") == len(LAGS), counts
+        n_types = len(np.unique(wtypes[best_part, :]))
+        assert counts.get("category") == n_types, counts
+        print(result)
+
+
+def main():
+    """Parse the command line arguments and run check().
+    """
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp()
+    try:
+        check(workdir, args.syear, args.n_cluster, args.n_sim)
+    finally:
+        shutil.rmtree(workdir)
+    print("make_composite ran on weather_type.nc")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Check the region download of download_cpc_year against a full download
+
+A year of synthetic rainfall on the IRI grid (longitudes on 0 to 360, time
+in days since 1960) is served over HTTP from a local server, which the
+netCDF library reads with byte-range requests (mode=bytes) in place of the
+OPeNDAP server of the data library. fetch_year is run once for the whole
+globe and once per box, and each box must equal the same box cut from the
+full download; one of the boxes crosses the prime meridian. The server then
+breaks the connection to check that a failed fetch drops it and that the
+retries of download_batch open a new one, and goes down to check that a
+download that fails for good leaves neither the file nor its .part behind.
+Run with PYTHONPATH=src, as the Makefile does.
+"""
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src", "get"))
+
+# pylint: disable=C0413
+import numpy as np
+import pandas as pd
+import xarray as xr
+import download_batch
+import download_cpc_year
+import iri_time
+from fixtures import _waves
+
+parser = argparse.ArgumentParser()  # pylint: disable=C0103
+parser.add_argument("--year", type=int, default=1990, help="the year to serve")
+
+BOXES = [(-85.0, -30.0, -40.0, 10.0), (-20.0, 20.0, -10.0, 30.0)]
+
+
+def iri_year(year, seed=0):
+    """A year of daily 2.5 degree rainfall as stored by the data library,
+    with a few days of the years around it
+    """
+    rng = np.random.RandomState(seed + year)
+    time = pd.date_range(
+        "{}-12-25".format(year - 1), "{}-01-05".format(year + 1)
+    ).values
+    lat = np.arange(-88.75, 89, 2.5, dtype="float32")
+    lon = np.arange(1.25, 360, 2.5, dtype="float32")
+    values = np.maximum(_waves(time, lat, lon, rng), 0) ** 2
+    return xr.DataArray(
+        values,
+        dims=("T", "Y", "X"),
+        coords=dict(
+            T=iri_time.datetime64_to_days(time).astype("float32"), Y=lat, X=lon
+        ),
+        name="rain",
+    )
+
+
+class Handler(SimpleHTTPRequestHandler):
+    """Serve the file of the server to any path, honouring Range headers
+
+    While server.broken is set, every read fails until the file is opened
+    again (its header read from the start), as after a lost connection.
+    While server.down is set, every request fails.
+    """
+
+    def log_message(self, *args):  # pylint: disable=W0221
+        pass
+
+    def do_HEAD(self):
+        if self.server.down:
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(os.path.getsize(self.server.path)))
+        self.end_headers()
+
+    def do_GET(self):
+        with open(self.server.path, "rb") as fnc:
+            content = fnc.read()
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        start = 0 if match is None else int(match.group(1))
+        if start == 0:
+            self.server.broken = False
+        if self.server.down or self.server.broken:
+            self.send_error(503)
+            return
+        if match is None:
+            end = len(content) - 1
+            self.send_response(200)
+        else:
+            end = min(int(match.group(2) or len(content) - 1), len(content) - 1)
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes {}-{}/{}".format(start, end, len(content))
+            )
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(content[start : end + 1])
+
+
+def serve(path):
+    """Start a local server of path in a thread
+    """
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    server.path, server.broken, server.down = path, False, False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def check(workdir, year):
+    """Compare the boxes of fetch_year with the full download
+    """
+    path = os.path.join(workdir, "rain.nc")
+    iri_year(year).to_netcdf(path)
+    server = serve(path)
+    # fetch_year appends the path of the data set to base_url, which here
+    # ends up in an unused key of the fragment
+    base_url = "http://127.0.0.1:{}/cpc#mode=bytes&path=".format(server.server_port)
+    try:
+        full = download_cpc_year.fetch_year(year, base_url=base_url)
+        assert full.sizes["time"] == pd.Timestamp(year, 12, 31).dayofyear
+        for box in BOXES:
+            region = dict(zip(["lonmin", "lonmax", "latmin", "latmax"], box))
+            subset = download_cpc_year.fetch_year(year, base_url=base_url, **region)
+            expected = full.sel(lon=slice(*box[:2]), lat=slice(*box[2:]))
+            xr.testing.assert_equal(subset, expected)
+
+        # a failed read drops the connection and the retry opens a new one
+        open_urls = download_cpc_year._OPEN_URLS  # pylint: disable=W0212
+        assert open_urls, "fetch_year did not keep its connection"
+        server.broken = True
+        try:
+            download_cpc_year.fetch_year(year, base_url=base_url)
+        except (IOError, OSError, RuntimeError) as err:
+            print("failed as expected: {}".format(err))
+        else:
+            raise AssertionError("the server failure was not raised")
+        assert not open_urls, "the broken connection was kept"
+
+        # a download that fails every attempt cleans up after itself
+        outfile = os.path.join(workdir, "rain_{}.nc".format(year))
+        task = dict(
+            source="cpc",
+            year=year,
+            outfile=outfile,
+            region=dict(zip(["lonmin", "lonmax", "latmin", "latmax"], BOXES[0])),
+            base_url=base_url,
+            retries=1,
+            backoff=0.0,
+        )
+        with open(outfile + ".part", "w") as fpart:
+            fpart.write("left by an interrupted write")
+        server.down = True
+        error = download_batch.fetch_one(task)
+        server.down = False
+        print("gave up as expected: {}".format(error))
+        assert error is not None, "the download did not fail"
+        assert not os.path.exists(outfile + ".part"), "the .part file was kept"
+        assert not os.path.exists(outfile), "a failed download left its file"
+
+        # the retries of a broken connection succeed
+        download_cpc_year.open_url(base_url + "/.RETRO/.rain/dods")
+        server.broken = True
+        assert download_batch.fetch_one(task) is None
+        assert not os.path.exists(outfile + ".part")
+        with xr.open_dataarray(outfile) as retried:
+            expected = full.sel(lon=slice(*BOXES[0][:2]), lat=slice(*BOXES[0][2:]))
+            xr.testing.assert_equal(retried.load(), expected)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    """Parse the command line arguments and run check().
+    """
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp()
+    try:
+        check(workdir, args.year)
+    finally:
+        shutil.rmtree(workdir)
+    print("the region downloads match the full download")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Check the datetime64 conversions of iri_time against the code they replaced
+
+The old decoders built one datetime.date per day offset (download_cpc_year)
+and one year/month pair per month offset (download_ssta); they are kept here
+as they were, apart from np.int, which numpy has removed. Random day and month
+offsets since 1960, negative and fractional ones included, are decoded both
+ways and must agree, and encoding the decoded dates must give back the whole
+offsets. Run with PYTHONPATH=src, as the Makefile does.
+"""
+
+import argparse
+import datetime
+import numpy as np
+import pandas as pd
+import iri_time
+
+parser = argparse.ArgumentParser()  # pylint: disable=C0103
+parser.add_argument("--n_sample", type=int, default=5000, help="offsets per check")
+parser.add_argument("--seed", type=int, default=1085, help="random seed")
+
+
+def old_days_to_dates(time_vec):
+    """The dates of days since 1960, as download_cpc_year decoded them
+    """
+    time = np.array(
+        [datetime.date(1960, 1, 1) + datetime.timedelta(int(ti)) for ti in time_vec]
+    )
+    return time.astype("datetime64[D]")
+
+
+def old_date_to_days(date):
+    """The days since 1960 of a date, as download_cpc_year encoded them
+    """
+    date_diff = date - datetime.date(1960, 1, 1)
+    return date_diff.days
+
+
+def old_months_to_dates(months):
+    """The first day of the months since 1960, as download_ssta decoded them
+    """
+    time = np.int_(np.floor(months))
+    year = 1960 + time // 12
+    month = 1 + time % 12
+    time = pd.to_datetime(year * 10000 + month * 100 + 1, format="%Y%m%d")
+    return time.values.astype("datetime64[D]")
+
+
+def check(n_sample, seed):
+    """Compare the old and new conversions on random offsets
+    """
+    rng = np.random.RandomState(seed)
+
+    # whole, fractional and negative days, 1905 to 2042
+    days = np.concatenate(
+        [
+            rng.randint(-20000, 30000, size=n_sample).astype("float64"),
+            rng.uniform(-20000, 30000, size=n_sample),
+            [0.0, 0.5, -0.5, -1.0, -1.5],
+        ]
+    )
+    new_dates = iri_time.days_to_datetime64(days)
+    assert np.array_equal(new_dates, old_days_to_dates(days))
+    assert np.array_equal(iri_time.datetime64_to_days(new_dates), np.trunc(days))
+    dates = new_dates.astype(datetime.date)
+    old_days = np.array([old_date_to_days(date) for date in dates])
+    assert np.array_equal(iri_time.datetime64_to_days(dates), old_days)
+
+    # whole, mid-month and negative months, 1910 to 2035
+    months = np.concatenate(
+        [
+            rng.randint(-600, 900, size=n_sample) + 0.5,
+            rng.uniform(-600, 900, size=n_sample),
+            [0.0, 0.5, -0.5, -1.0, 11.5, 12.0],
+        ]
+    )
+    new_months = iri_time.months_to_datetime64(months)
+    assert np.array_equal(new_months, old_months_to_dates(months))
+    assert np.array_equal(iri_time.datetime64_to_months(new_months), np.floor(months))
+    print("{} day and {} month offsets agree".format(days.size, months.size))
+
+
+def main():
+    """Parse the command line arguments and run check().
+    """
+    args = parser.parse_args()
+    check(args.n_sample, args.seed)
+    print("the datetime64 conversions match the old decoders")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Check the streamfunction of calculate_streamfunction against windspharm
+
+A few days of the synthetic 850 hPa winds of fixtures.py are transformed by
+calculate_streamfunction.streamfunction, in blocks smaller than the record,
+and by windspharm's VectorWind(...).streamfunction(), which the script used
+before. The two must agree to rounding, with the latitudes stored north to
+south as downloaded and south to north, which must come back in the order
+they went in. Needs windspharm; run with PYTHONPATH=src, as the Makefile
+does.
+"""
+
+import argparse
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src", "process"))
+
+# pylint: disable=C0413
+import numpy as np
+from windspharm.standard import VectorWind
+from calculate_streamfunction import RSPHERE, streamfunction
+from fixtures import reanalysis_year
+
+parser = argparse.ArgumentParser()  # pylint: disable=C0103
+parser.add_argument("--year", type=int, default=1990, help="the year to sample")
+parser.add_argument("--n_time", type=int, default=20, help="time steps compared")
+parser.add_argument("--rtol", type=float, default=1e-5, help="relative tolerance")
+
+
+def windspharm_psi(uwnd, vwnd):
+    """The streamfunction of (time, lat, lon) winds as windspharm computes it,
+    latitudes north to south
+    """
+    uwnd = uwnd.sortby("lat", ascending=False)
+    vwnd = vwnd.sortby("lat", ascending=False)
+    wind = VectorWind(
+        np.moveaxis(uwnd.values, 0, -1),
+        np.moveaxis(vwnd.values, 0, -1),
+        gridtype="regular",
+        rsphere=RSPHERE,
+    )
+    return np.moveaxis(wind.streamfunction(), -1, 0)
+
+
+def check(year, n_time, rtol):
+    """Compare both computations for latitudes in either order
+    """
+    uwnd, vwnd = [
+        reanalysis_year(year, var=var, seed=seed).isel(time=slice(0, n_time))
+        for seed, var in enumerate(["uwnd", "vwnd"])
+    ]
+    expected = windspharm_psi(uwnd, vwnd)
+    scale = np.abs(expected).max()
+    for ascending in [False, True]:
+        u_in = uwnd.sortby("lat", ascending=ascending)
+        v_in = vwnd.sortby("lat", ascending=ascending)
+        psi = streamfunction(u_in, v_in, chunk_size=max(1, n_time // 3))
+        assert np.array_equal(psi["lat"].values, u_in["lat"].values)
+        actual = psi.sortby("lat", ascending=False).transpose("time", "lat", "lon")
+        rel_diff = np.abs(actual.values - expected).max() / scale
+        print(
+            "latitudes ascending={}: relative difference {:.2e}".format(
+                ascending, rel_diff
+            )
+        )
+        assert rel_diff < rtol, rel_diff
+
+
+def main():
+    """Parse the command line arguments and run check().
+    """
+    args = parser.parse_args()
+    check(args.year, args.n_time, args.rtol)
+    print("the streamfunction matches windspharm")
+
+
+if __name__ == "__main__":
+    main()
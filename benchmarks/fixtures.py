@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Synthetic stand-ins for the downloaded data, for benchmarks
+
+The files have the shapes, coordinates, packing and variable names of what
+src/get writes, so every stage can run without network access:
+
+- reanalysis: 6-hourly, 2.5 degree global, 850 hPa, int16 packed, one file
+  per year and variable (uwnd, vwnd)
+- cpc: daily, 0.5 degree over the rain domain of config/rain_region.mk, with
+  the ocean masked, one file per year
+- ssta: monthly, 1 degree global SST anomalies, one file
+
+The fields are smooth large-scale waves plus noise, which is enough for the
+PCA and clustering stages to behave as they do on real data.
+"""
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+import mkconfig
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config")
+COAST_WEST = -80.0  # longitudes of the synthetic coastlines of the CPC data
+COAST_EAST = -35.0
+
+parser = argparse.ArgumentParser()  # pylint: disable=C0103
+parser.add_argument("--outdir", help="the directory to write the files to")
+parser.add_argument("--syear", type=int, default=1979, help="first year")
+parser.add_argument("--eyear", type=int, default=1980, help="last year")
+
+
+def _waves(time, lat, lon, rng, n_modes=12):
+    """A (time, lat, lon) field of oscillating waves of all scales plus noise
+    """
+    t = (time - time[0]) / np.timedelta64(1, "D")
+    phi = np.deg2rad(lat)[:, None]
+    lam = np.deg2rad(lon)[None, :]
+    field = rng.standard_normal((time.size, lat.size, lon.size)).astype("float32")
+    for _ in range(n_modes):
+        k, l = rng.randint(1, 30, size=2)
+        period = rng.uniform(5, 60)
+        amp = rng.uniform(1, 5)
+        shape = np.cos(k * lam + rng.uniform(0, 2 * np.pi)) * np.cos(
+            l * phi + rng.uniform(0, 2 * np.pi)
+        )
+        field += (amp * np.cos(2 * np.pi * t / period))[:, None, None] * shape
+    return field
+
+
+def reanalysis_year(year, var="uwnd", seed=0):
+    """One year of 6-hourly 850 hPa reanalysis V2 winds
+    """
+    rng = np.random.RandomState(seed + year)
+    time = pd.date_range(
+        "{}-01-01".format(year), "{}-12-31 18:00".format(year), freq="6h"
+    ).values
+    lat = np.arange(90, -90.1, -2.5, dtype="float32")
+    lon = np.arange(0, 360, 2.5, dtype="float32")
+    values = 5 * _waves(time, lat, lon, rng)
+    data = xr.DataArray(
+        values,
+        dims=("time", "lat", "lon"),
+        coords=dict(time=time, lat=lat, lon=lon, level=np.float32(850)),
+        name=var,
+        attrs=dict(units="m/s", long_name="6-Hourly Forecast of U-wind"),
+    )
+    data.encoding = dict(
+        dtype="int16", scale_factor=0.01, add_offset=202.66, _FillValue=32766
+    )
+    return data
+
+
+def cpc_year(year, seed=0):
+    """One year of daily 0.5 degree CPC rainfall over the rain domain
+    """
+    rng = np.random.RandomState(seed + year)
+    (rain,) = mkconfig.read_boxes(os.path.join(CONFIG, "rain_region.mk"), ["RAIN"])
+    lonmin, lonmax, latmin, latmax = rain["box"]
+    time = pd.date_range("{}-01-01".format(year), "{}-12-31".format(year)).values
+    lat = np.arange(latmin, latmax + 0.01, 0.5, dtype="float32")
+    lon = np.arange(lonmin, lonmax + 0.01, 0.5, dtype="float32")
+    values = np.maximum(_waves(time, lat, lon, rng), 0) ** 2
+    # the ocean is missing as in the gauge-based data; the fixed coastlines
+    # keep the continent, and so the study area, as land
+    ocean = (lon < COAST_WEST) | (lon > COAST_EAST)
+    values[:, :, ocean] = np.nan
+    data = xr.DataArray(
+        values,
+        dims=("time", "lat", "lon"),
+        coords=dict(time=time, lat=lat, lon=lon),
+        name="rain",
+        attrs=dict(units="mm", year=year),
+    )
+    return data
+
+
+def ssta_monthly(syear, eyear, seed=0):
+    """Monthly 1 degree global SST anomalies
+    """
+    rng = np.random.RandomState(seed)
+    time = pd.date_range("{}-01-01".format(syear), "{}-12-01".format(eyear), freq="MS")
+    lat = np.arange(-89.5, 90, 1.0, dtype="float32")
+    lon = np.arange(-179.5, 180, 1.0, dtype="float32")
+    values = 0.5 * _waves(time.values, lat, lon, rng)
+    return xr.DataArray(
+        values,
+        dims=("time", "lat", "lon"),
+        coords=dict(time=time, lat=lat, lon=lon),
+        name="ssta",
+    )
+
+
+def write_all(outdir, syear, eyear, seed=0):
+    """Write every fixture for the years syear to eyear
+
+    Returns:
+        a dict of the paths written, by kind
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    paths = dict(uwnd=[], vwnd=[], cpc=[])
+    for year in range(syear, eyear + 1):
+        for i, var in enumerate(["uwnd", "vwnd"]):
+            fname = os.path.join(outdir, "reanalysisv2_{}_850_{}.nc".format(var, year))
+            if not os.path.isfile(fname):
+                reanalysis_year(year, var=var, seed=seed + 1000 * i).to_netcdf(fname)
+            paths[var].append(fname)
+        fname = os.path.join(outdir, "cpc_rain_{}.nc".format(year))
+        if not os.path.isfile(fname):
+            cpc_year(year, seed=seed).to_netcdf(fname)
+        paths["cpc"].append(fname)
+    fname = os.path.join(outdir, "ssta_cmb_{}_{}.nc".format(syear, eyear))
+    if not os.path.isfile(fname):
+        ssta_monthly(syear, eyear, seed=seed).to_netcdf(fname)
+    paths["ssta"] = fname
+    return paths
+
+
+def main():
+    """Parse the command line arguments and run write_all().
+    """
+    args = parser.parse_args()
+    write_all(args.outdir, args.syear, args.eyear)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare file size and read times of plain and compressed NetCDF output
+
+Copies a data file once the old way (plain to_netcdf) and once with
+dataio.write_netcdf, then times reading time series at a few grid points and
+maps at a few time steps from each copy. Results are printed as JSON.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import xarray as xr
+from dataio import write_netcdf
+
+parser = argparse.ArgumentParser()  # pylint: disable=C0103
+parser.add_argument("--infile", help="the data file to copy")
+parser.add_argument("--layout", default="time", help="time, map, or none")
+parser.add_argument("--pack", type=int, default=0, help="1 to pack into int16")
+parser.add_argument("--n_reads", type=int, default=5, help="reads of each kind")
+parser.add_argument("--outfile", default=None, help="save the JSON here")
+
+
+def time_reads(fname, n_reads):
+    """Time point time series reads and single time step map reads
+    """
+    result = {}
+    with xr.open_dataset(fname) as ds:
+        var = ds[list(ds.data_vars.keys())[0]]
+        other = [d for d in var.dims if d != "time"]
+        rng = np.random.RandomState(0)
+
+        start = time.perf_counter()
+        for _ in range(n_reads):
+            point = {d: rng.randint(var.sizes[d]) for d in other}
+            var.isel(point).load()
+        result["time_series_s"] = (time.perf_counter() - start) / n_reads
+
+        start = time.perf_counter()
+        for _ in range(n_reads):
+            var.isel(time=rng.randint(var.sizes["time"])).load()
+        result["map_s"] = (time.perf_counter() - start) / n_reads
+    result["size_bytes"] = os.path.getsize(fname)
+    return result
+
+
+def benchmark(infile, layout="time", pack=False, n_reads=5):
+    """Write both copies of infile and time reading them
+    """
+    layout = None if layout == "none" else layout
+    tmpdir = tempfile.mkdtemp()
+    try:
+        before = os.path.join(tmpdir, "before.nc")
+        after = os.path.join(tmpdir, "after.nc")
+        with xr.open_dataset(infile) as ds:
+            ds.load()
+            start = time.perf_counter()
+            ds.to_netcdf(before, format="NETCDF4")
+            write_before = time.perf_counter() - start
+            start = time.perf_counter()
+            write_netcdf(ds, after, layout=layout, pack=pack)
+            write_after = time.perf_counter() - start
+        results = dict(
+            infile=os.path.abspath(infile),
+            layout=layout,
+            pack=bool(pack),
+            before=time_reads(before, n_reads),
+            after=time_reads(after, n_reads),
+        )
+        results["before"]["write_s"] = write_before
+        results["after"]["write_s"] = write_after
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def main():
+    """Parse the command line arguments and run benchmark().
+    """
+    args = parser.parse_args()
+    results = benchmark(
+        args.infile, layout=args.layout, pack=bool(args.pack), n_reads=args.n_reads
+    )
+    text = json.dumps(results, indent=2)
+    if args.outfile is None:
+        print(text)
+    else:
+        with open(args.outfile, "w") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
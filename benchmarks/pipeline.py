@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time and memory profile of the processing stages on synthetic data
+
+For each record length (a number of NDJF seasons) the fixtures of
+fixtures.py are written and the stages are run on them in the order of the
+Makefile: daily means, anomalies, streamfunction, area averages, the dipole
+and the weather type PCA, KMeans ensemble and classifiability. Each stage is
+timed over --repeat runs (the best wall and CPU times are kept), then run
+once more under tracemalloc for the peak memory allocated by Python and
+numpy. The streamfunction is skipped when spharm is not installed, and the
+weather types are then computed from the zonal wind anomalies instead.
+
+The results are saved as JSON with the library versions and git commit, so
+that runs of different versions can be compared. Run with PYTHONPATH=src, as
+the Makefile does.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from glob import glob
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src", "process"))
+
+# pylint: disable=C0413
+import numpy as np
+import xarray as xr
+import mkconfig
+import regions
+from dataio import read_dataset
+from fixtures import CONFIG, write_all
+from make_anomaly import calc_anomaly, hourly_to_daily, subset_region
+from make_dipole import make_dipole
+from make_time_series import make_subset
+from make_weather_type import calc_pcs, loop_kmeans, matrix_classifiability
+
+parser = argparse.ArgumentParser()  # pylint: disable=C0103
+parser.add_argument(
+    "--seasons", type=int, nargs="+", default=[1, 2, 4], help="record lengths"
+)
+parser.add_argument("--syear", type=int, default=1979, help="first year")
+parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage")
+parser.add_argument("--n_sim", type=int, default=50, help="KMeans runs")
+parser.add_argument("--n_cluster", type=int, default=6, help="number of clusters")
+parser.add_argument("--var_xpl", type=float, default=0.95, help="PCA variance")
+parser.add_argument("--stages", nargs="+", help="only run these stages")
+parser.add_argument("--fixtures", help="keep the synthetic data in this directory")
+parser.add_argument("--outfile", default=None, help="save the JSON here")
+
+
+def _box(name):
+    """A box defined in the config files
+    """
+    (region,) = mkconfig.read_boxes(glob(os.path.join(CONFIG, "*.mk")), [name])
+    return region["box"]
+
+
+def stage_hourly_to_daily(ctx):
+    """Daily means of the 6-hourly zonal wind over the reanalysis domain
+    """
+    return hourly_to_daily(ctx["uwnd_hourly"])
+
+
+def stage_calc_anomaly(ctx):
+    """Anomalies of the rainfall and of the 6-hourly zonal wind
+    """
+    for name, pattern, box, to_daily in [
+        ("rain", "cpc_rain_*.nc", "RAIN", 0),
+        ("uwnd", "reanalysisv2_uwnd_850_*.nc", "RNLS", 1),
+    ]:
+        calc_anomaly(
+            os.path.join(ctx["fixtures"], pattern),
+            ctx["out"][name],
+            ctx["syear"],
+            ctx["eyear"],
+            *_box(box),
+            to_daily=to_daily
+        )
+
+
+def stage_calculate_streamfunction(ctx):
+    """Streamfunction of the daily NDJF winds and its anomaly
+    """
+    from calculate_streamfunction import calculate_batch
+
+    psi_files = [
+        os.path.join(ctx["workdir"], "psi_{}.nc".format(year))
+        for year in range(ctx["syear"], ctx["eyear"] + 1)
+    ]
+    calculate_batch(ctx["paths"]["uwnd"], ctx["paths"]["vwnd"], psi_files, daily=True)
+    calc_anomaly(
+        os.path.join(ctx["workdir"], "psi_*.nc"),
+        ctx["out"]["psi"],
+        ctx["syear"],
+        ctx["eyear"],
+        *_box("RNLS")
+    )
+
+
+def stage_make_time_series(ctx):
+    """Rainfall averaged over the lower Paraguay River basin
+    """
+    make_subset(
+        ctx["out"]["rain"], ctx["out"]["rpy"], [regions.box("LPR", *_box("LPR"))]
+    )
+
+
+def stage_make_dipole(ctx):
+    """The South Central Atlantic dipole of the SST anomalies
+    """
+    region = regions.box("SCAD", *_box("SCAD"))
+    make_dipole(ctx["paths"]["ssta"], ctx["out"]["dipole"], region)
+
+
+def stage_calc_pcs(ctx):
+    """PCA of the anomalies over the weather type domain
+    """
+    return calc_pcs(ctx["wt_field"], var_xpl=ctx["var_xpl"])[0]
+
+
+def stage_loop_kmeans(ctx):
+    """The ensemble of KMeans partitions of the PCs
+    """
+    return loop_kmeans(ctx["calc_pcs"], ctx["n_cluster"], ctx["n_sim"])[0]
+
+
+def stage_matrix_classifiability(ctx):
+    """Classifiability of the KMeans ensemble
+    """
+    return matrix_classifiability(ctx["loop_kmeans"])
+
+
+STAGES = [
+    ("hourly_to_daily", stage_hourly_to_daily),
+    ("calc_anomaly", stage_calc_anomaly),
+    ("calculate_streamfunction", stage_calculate_streamfunction),
+    ("make_time_series", stage_make_time_series),
+    ("make_dipole", stage_make_dipole),
+    ("calc_pcs", stage_calc_pcs),
+    ("loop_kmeans", stage_loop_kmeans),
+    ("matrix_classifiability", stage_matrix_classifiability),
+]
+
+
+def measure(func, ctx, repeat=3):
+    """Best wall and CPU time over repeat runs, and peak traced memory
+
+    Returns:
+        the timings and the value returned by the last run
+    """
+    wall = []
+    cpu = []
+    for _ in range(repeat):
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        func(ctx)
+        wall.append(time.perf_counter() - wall0)
+        cpu.append(time.process_time() - cpu0)
+    tracemalloc.start()
+    try:
+        value = func(ctx)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return dict(wall_s=min(wall), cpu_s=min(cpu), peak_bytes=peak), value
+
+
+def _wt_field(ctx):
+    """The daily anomalies the weather types are computed from
+    """
+    name = "psi" if os.path.exists(ctx["out"]["psi"]) else "uwnd"
+    with read_dataset(ctx["out"][name]) as data:
+        box = regions.box("WT", *_box("WT"))
+        return name, regions.subset(data["anomaly"], box).load()
+
+
+def run_seasons(n_seasons, fixtures, args):
+    """Run the stages on a record of n_seasons NDJF seasons
+
+    Returns:
+        a list of one dict per stage
+    """
+    eyear = args.syear + n_seasons
+    # one directory per record, so the anomaly globs see only its own years
+    fixtures = os.path.join(fixtures, "{}_{}".format(args.syear, eyear))
+    paths = write_all(fixtures, args.syear, eyear)
+    workdir = tempfile.mkdtemp(dir=fixtures, prefix=".bench_")
+    ctx = dict(
+        fixtures=fixtures,
+        paths=paths,
+        workdir=workdir,
+        syear=args.syear,
+        eyear=eyear,
+        var_xpl=args.var_xpl,
+        n_cluster=args.n_cluster,
+        n_sim=args.n_sim,
+        out={
+            name: os.path.join(workdir, name + ".nc")
+            for name in ["rain", "uwnd", "psi", "rpy", "dipole"]
+        },
+    )
+    with xr.open_mfdataset(paths["uwnd"]) as uwnd:
+        ctx["uwnd_hourly"] = subset_region(uwnd["uwnd"], *_box("RNLS")).load()
+    results = []
+    try:
+        for name, func in STAGES:
+            if args.stages is not None and name not in args.stages:
+                continue
+            if name == "calc_pcs":
+                ctx["wt_source"], ctx["wt_field"] = _wt_field(ctx)
+            result = dict(
+                stage=name,
+                seasons=n_seasons,
+                n_time_hourly=ctx["uwnd_hourly"].sizes["time"],
+            )
+            try:
+                timing, ctx[name] = measure(func, ctx, repeat=args.repeat)
+            except ImportError as err:
+                result["skipped"] = str(err)
+            else:
+                result.update(timing)
+            if name == "calc_pcs":
+                result["source"] = ctx["wt_source"]
+                result["n_components"] = int(ctx["calc_pcs"].shape[1])
+            results.append(result)
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+def _git_commit():
+    """The commit of the repository, or None outside a git checkout
+    """
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], cwd=HERE, stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata():
+    """What the results depend on besides the code
+    """
+    versions = {}
+    for module in ["numpy", "pandas", "xarray", "dask", "sklearn", "scipy", "netCDF4"]:
+        try:
+            versions[module] = __import__(module).__version__
+        except ImportError:
+            versions[module] = None
+    return dict(
+        commit=_git_commit(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpu_count=os.cpu_count(),
+        versions=versions,
+    )
+
+
+def benchmark(args):
+    """Run every record length and collect the results
+    """
+    fixtures = args.fixtures or tempfile.mkdtemp()
+    try:
+        results = []
+        for n_seasons in args.seasons:
+            results.extend(run_seasons(n_seasons, fixtures, args))
+    finally:
+        if args.fixtures is None:
+            shutil.rmtree(fixtures)
+    meta = metadata()
+    meta.update(
+        n_sim=args.n_sim,
+        n_cluster=args.n_cluster,
+        var_xpl=args.var_xpl,
+        repeat=args.repeat,
+        max_rss_bytes=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    )
+    return dict(meta=meta, results=results)
+
+
+def main():
+    """Parse the command line arguments and run benchmark().
+    """
+    args = parser.parse_args()
+    np.random.seed(0)
+    text = json.dumps(benchmark(args), indent=2)
+    if args.outfile is None:
+        print(text)
+    else:
+        with open(args.outfile, "w") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Startup time of the scripts in src/get and src/process
+
+Each script is started --repeat times as python -X importtime <script>
+--help, which imports everything the script imports at the top and then
+stops after printing the usage. The best wall time is kept with the import
+time of the modules the script imported directly or through src/ modules,
+the slowest first. Run from the top of the repository with PYTHONPATH=src,
+as the Makefile does; a script whose imports fail (e.g. a missing optional
+library) is recorded with its error.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from glob import glob
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, "..", "src")
+
+parser = argparse.ArgumentParser()  # pylint: disable=C0103
+parser.add_argument("--scripts", nargs="+", help="only these scripts")
+parser.add_argument("--repeat", type=int, default=5, help="runs per script")
+parser.add_argument("--top", type=int, default=8, help="modules listed per script")
+parser.add_argument("--outfile", default=None, help="save the JSON here")
+
+
+def find_scripts():
+    """The scripts with a command line, relative to the repository
+    """
+    scripts = []
+    for directory in ["get", "process"]:
+        for path in sorted(glob(os.path.join(SRC, directory, "*.py"))):
+            with open(path) as fpy:
+                if "__main__" in fpy.read():
+                    scripts.append(os.path.relpath(path, os.path.join(HERE, "..")))
+    return scripts + [os.path.join("src", "pipeline.py")]
+
+
+def parse_importtime(text):
+    """The cumulative import time in microseconds of the modules imported at
+    the top level, by name
+
+    Modules imported by modules of src/ count as top level too, so that a
+    script importing dataio shows xarray rather than only dataio.
+    """
+    paths = glob(os.path.join(SRC, "*.py")) + glob(os.path.join(SRC, "*", "*.py"))
+    local = set(os.path.splitext(os.path.basename(path))[0] for path in paths)
+    times = {}
+    stack = []  # the module names of the enclosing imports, innermost last
+    # importtime lists a module after the modules it imported
+    for line in reversed(text.splitlines()):
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue  # the header
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        del stack[depth:]
+        if all(parent in local for parent in stack) and name not in local:
+            times[name] = times.get(name, 0) + int(cumulative)
+        stack.append(name)
+    return times
+
+
+def time_script(script, repeat=5, top=8):
+    """Best wall time of script --help and what its imports cost
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [SRC] + [path for path in env.get("PYTHONPATH", "").split(os.pathsep) if path]
+    )
+    command = [sys.executable, "-X", "importtime", script, "--help"]
+    walls = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run(
+            command, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        walls.append(time.perf_counter() - start)
+    stderr = proc.stderr.decode()
+    result = dict(script=script, wall_s=min(walls))
+    if proc.returncode != 0:
+        errors = [line for line in stderr.splitlines() if "Error" in line]
+        result["error"] = errors[-1] if errors else "exit {}".format(proc.returncode)
+    times = parse_importtime(stderr)
+    heaviest = sorted(times.items(), key=lambda item: -item[1])[:top]
+    result["imports_s"] = sum(times.values()) / 1e6
+    result["heaviest"] = [dict(module=name, s=us / 1e6) for name, us in heaviest]
+    return result
+
+
+def main():
+    """Parse the command line arguments and time every script.
+    """
+    args = parser.parse_args()
+    os.chdir(os.path.join(HERE, ".."))
+    results = []
+    for script in args.scripts or find_scripts():
+        result = time_script(script, repeat=args.repeat, top=args.top)
+        print(
+            "{:<45} {:6.2f} s  {}".format(
+                result["script"],
+                result["wall_s"],
+                ", ".join(item["module"] for item in result["heaviest"][:4]),
+            )
+        )
+        results.append(result)
+    if args.outfile is not None:
+        from pipeline import metadata  # pylint: disable=C0415
+
+        with open(args.outfile, "w") as f:
+            f.write(json.dumps(dict(meta=metadata(), results=results), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,4 +2,6 @@
 SCADX0=-30
 SCADX1=-10
 SCADY0=-40
-SCADY1=-15
\ No newline at end of file
+SCADY1=-15
+# the dipole is the meridional gradient of SST anomalies over the box
+SCADDIM=lat
@@ -5,3 +5,5 @@
 VARXPL2 = 0.95
 NSIM2 = 75
 WTK := $(shell seq 2 1 10) # all years
+# number of red-noise surrogates for the classifiability significance test
+NSURR = 100
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Write data to compressed, chunked NetCDF4 files or Zarr stores
+
+All scripts in src/get and src/process save their output with write_netcdf
+(or write_dataset), which compresses every data variable, picks chunk shapes
+that suit the way the file will be read, optionally packs floats into int16,
+and writes to a temporary file that is only moved into place once complete.
+
+Paths inside a Zarr store, such as data/processed/processed.zarr/rain, are
+written as a group of that store instead. The store keeps consolidated
+metadata at its root, so opening any group costs a single metadata read.
+
+Every write is measured as an instrument phase called "write" (which, for
+lazy data, includes computing it) and registers its path as an output.
+"""
+
+import os
+import numpy as np
+import instrument
+
+CHUNK_BYTES = 2 ** 20  # aim for chunks of about 1 MB
+PACK_DTYPE = "int16"
+PACK_FILL = np.iinfo(PACK_DTYPE).min
+
+# encoding inherited from the source that would clash with ours
+_STALE_ENCODING = [
+    "chunks",
+    "preferred_chunks",
+    "compressor",
+    "compressors",
+    "filters",
+    "chunksizes",
+    "contiguous",
+    "zlib",
+    "complevel",
+    "shuffle",
+    "fletcher32",
+    "original_shape",
+    "source",
+]
+
+
+def chunk_shape(var, layout):
+    """Chunk sizes for a variable
+
+    Args:
+        var: the variable to chunk
+        layout: "time" for reading long time series over small areas, "map"
+            for reading whole maps at a few time steps
+    Returns:
+        a tuple with one chunk size per dimension, or None for the default
+    """
+    if layout is None or "time" not in var.dims or var.ndim < 2:
+        return None
+    n_values = max(1, CHUNK_BYTES // var.dtype.itemsize)
+    other = [d for d in var.dims if d != "time"]
+    if layout == "time":
+        n_time = min(var.sizes["time"], n_values)
+        side = int(max(1, n_values // n_time) ** (1.0 / len(other)))
+        sizes = {d: min(var.sizes[d], max(1, side)) for d in other}
+        sizes["time"] = n_time
+    elif layout == "map":
+        n_map = int(np.prod([var.sizes[d] for d in other]))
+        sizes = {d: var.sizes[d] for d in other}
+        sizes["time"] = min(var.sizes["time"], max(1, n_values // n_map))
+    else:
+        raise ValueError("unknown layout {}".format(layout))
+    return tuple(sizes[d] for d in var.dims)
+
+
+def pack_encoding(var):
+    """Scale and offset that map the range of var onto int16
+    """
+    vmin = float(var.min())
+    vmax = float(var.max())
+    if not np.isfinite(vmin) or vmax == vmin:
+        scale = 1.0
+    else:
+        scale = (vmax - vmin) / (2.0 * (np.iinfo(PACK_DTYPE).max - 1))
+    return dict(
+        dtype=PACK_DTYPE,
+        scale_factor=scale,
+        add_offset=(vmax + vmin) / 2.0 if np.isfinite(vmin) else 0.0,
+        _FillValue=PACK_FILL,
+    )
+
+
+def netcdf_encoding(data, layout=None, complevel=4, pack=False):
+    """Encoding that compresses (and optionally packs) every data variable
+
+    Args:
+        data: the Dataset to encode
+        layout: the chunk layout, see chunk_shape
+        complevel: the zlib compression level, 0 to turn compression off
+        pack: if True, store floating point variables as int16 with a scale
+            and offset (lossy, to about 1 part in 65000 of their range)
+    """
+    encoding = {}
+    for name, var in data.data_vars.items():
+        enc = {"zlib": complevel > 0, "shuffle": complevel > 0}
+        if complevel > 0:
+            enc["complevel"] = complevel
+        chunks = chunk_shape(var, layout)
+        if chunks is not None:
+            enc["chunksizes"] = chunks
+        if pack and np.issubdtype(var.dtype, np.floating):
+            enc.update(pack_encoding(var))
+        encoding[name] = enc
+    return encoding
+
+
+def write_netcdf(data, outfile, layout=None, complevel=4, pack=False):
+    """Save a DataArray or Dataset to a compressed NetCDF4 file, atomically
+
+    The file is written next to outfile and renamed once complete, so an
+    interrupted write never leaves a partial outfile behind. Packing that the
+    data inherited from the source (e.g. the int16 reanalysis fields) is kept
+    unless pack is True, in which case it is recomputed.
+
+    Args:
+        data: the DataArray or Dataset to save
+        outfile: the filename of the data to save
+        layout: the chunk layout, see chunk_shape
+        complevel: the zlib compression level, 0 to turn compression off
+        pack: if True, pack floating point variables into int16
+    """
+    data = _clean(data, pack)
+    encoding = netcdf_encoding(data, layout=layout, complevel=complevel, pack=pack)
+    tmpfile = outfile + ".part"
+    with instrument.phase("write"):
+        data.to_netcdf(tmpfile, format="NETCDF4", mode="w", encoding=encoding)
+    os.replace(tmpfile, outfile)
+    instrument.add_output(outfile)
+
+
+def split_store(path):
+    """Split a path like store.zarr/group into the store and the group
+
+    Returns:
+        (store, group), where store is None if path is not inside a Zarr store
+        and group is None for the root of the store
+    """
+    parts = os.path.normpath(path).split(os.sep)
+    for i, part in enumerate(parts):
+        if part.endswith(".zarr"):
+            store = os.sep.join(parts[: i + 1])
+            group = "/".join(parts[i + 1 :]) or None
+            return store, group
+    return None, None
+
+
+def exists(path):
+    """Whether a file, or a group of a Zarr store, exists
+    """
+    store, group = split_store(path)
+    if store is None:
+        return os.path.isfile(path)
+    return os.path.isdir(os.path.join(store, *(group or "").split("/")))
+
+
+def _clean(data, pack):
+    """A shallow copy of data as a Dataset without stale encoding
+    """
+    import xarray as xr  # pylint: disable=C0415
+
+    if isinstance(data, xr.DataArray):
+        name = data.name if data.name is not None else "__xarray_dataarray_variable__"
+        data = data.to_dataset(name=name)
+    data = data.copy()
+    for var in data.data_vars.values():
+        for key in _STALE_ENCODING:
+            var.encoding.pop(key, None)
+        if pack:
+            var.encoding = {}
+    return data
+
+
+def _consolidate(store):
+    """Gather the metadata of every group of a store at its root
+    """
+    import zarr  # pylint: disable=C0415
+
+    zarr.consolidate_metadata(store)
+
+
+def write_zarr(data, path, layout=None, pack=False):
+    """Save a DataArray or Dataset as a group of a Zarr store
+
+    Any existing group of that name is replaced; other groups are untouched.
+
+    Args:
+        data: the DataArray or Dataset to save
+        path: the store and group, e.g. data/processed/processed.zarr/rain
+        layout: the chunk layout, see chunk_shape
+        pack: if True, pack floating point variables into int16
+    """
+    store, group = split_store(path)
+    data = _clean(data, pack)
+    encoding = {}
+    for name, var in data.data_vars.items():
+        enc = {}
+        chunks = chunk_shape(var, layout)
+        if chunks is not None:
+            enc["chunks"] = chunks
+            if var.chunks is not None:
+                # each zarr chunk must be written by a single dask chunk
+                data[name] = var.chunk(dict(zip(var.dims, chunks)))
+        if pack and np.issubdtype(var.dtype, np.floating):
+            enc.update(pack_encoding(var))
+        encoding[name] = enc
+    with instrument.phase("write"):
+        data.to_zarr(
+            store, group=group, mode="w", encoding=encoding, consolidated=False
+        )
+        _consolidate(store)
+    instrument.add_output(path)
+
+
+def append_zarr(data, path, dim="time"):
+    """Extend a group of a Zarr store along dim, in place
+
+    Only the part of data beyond the last value of dim already in the store
+    is written. The encoding (chunks, packing) of the store is kept.
+
+    Returns:
+        the number of entries appended
+    """
+    store, group = split_store(path)
+    with read_dataset(path) as existing:
+        last = existing[dim].values[-1]
+    new = data.sel({dim: data[dim] > last}).load()
+    if new.sizes[dim] > 0:
+        new = _clean(new, pack=False)
+        with instrument.phase("write"):
+            new.to_zarr(store, group=group, append_dim=dim, consolidated=False)
+            _consolidate(store)
+        instrument.add_output(path)
+    return new.sizes[dim]
+
+
+def update_zarr(data, path, region):
+    """Overwrite part of the variables of a group of a Zarr store in place
+
+    Args:
+        data: the Dataset holding the new values
+        path: the store and group
+        region: a dict mapping a dimension to the slice of it to overwrite
+    """
+    store, group = split_store(path)
+    data = _clean(data, pack=False)
+    with read_dataset(path) as existing:
+        for name, var in data.data_vars.items():
+            chunks = existing[name].encoding.get("chunks")
+            if chunks is not None and var.chunks is not None:
+                data[name] = var.chunk(dict(zip(var.dims, chunks)))
+    # only variables along the region's dimensions can be written
+    drop = [
+        name
+        for name, var in data.variables.items()
+        if not set(region).issubset(var.dims)
+    ]
+    data = data.drop_vars(drop)
+    with instrument.phase("write"):
+        data.to_zarr(store, group=group, region=region, consolidated=False)
+        _consolidate(store)
+    instrument.add_output(path)
+
+
+def write_dataset(data, path, layout=None, complevel=4, pack=False):
+    """Save data to a NetCDF4 file or to a group of a Zarr store
+
+    Paths inside a directory ending in .zarr are written with write_zarr,
+    anything else with write_netcdf.
+    """
+    if split_store(path)[0] is not None:
+        write_zarr(data, path, layout=layout, pack=pack)
+    else:
+        write_netcdf(data, path, layout=layout, complevel=complevel, pack=pack)
+
+
+def write_groups(datasets, path, layout=None, complevel=4, pack=False):
+    """Save several Datasets as named groups of one NetCDF4 file or Zarr store
+
+    Args:
+        datasets: a dict mapping group names to DataArrays or Datasets
+        path: a NetCDF file, or a Zarr store (or group) to write the groups in
+    """
+    if split_store(path)[0] is not None:
+        for name, data in datasets.items():
+            write_zarr(data, os.path.join(path, name), layout=layout, pack=pack)
+        return
+    tmpfile = path + ".part"
+    mode = "w"
+    for name, data in datasets.items():
+        data = _clean(data, pack)
+        encoding = netcdf_encoding(
+            data, layout=layout, complevel=complevel, pack=pack
+        )
+        with instrument.phase("write"):
+            data.to_netcdf(
+                tmpfile, format="NETCDF4", mode=mode, group=name, encoding=encoding
+            )
+        mode = "a"
+    os.replace(tmpfile, path)
+    instrument.add_output(path)
+
+
+def read_dataset(path, chunks=None):
+    """Open a NetCDF4 file or a group of a Zarr store
+
+    Zarr groups are opened lazily from the store's consolidated metadata,
+    with one dask chunk per stored chunk so that reads are decoded in
+    parallel. NetCDF files are opened as usual unless chunks is given.
+    """
+    import xarray as xr  # pylint: disable=C0415
+
+    store, group = split_store(path)
+    if store is None:
+        return xr.open_dataset(path, chunks=chunks)
+    return xr.open_zarr(store, group=group, consolidated=True, chunks=chunks or {})
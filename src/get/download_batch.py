@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Download many years (and variables) of gridded data concurrently
+
+Each year is fetched with the same code as the single-year scripts, but
+the downloads share a bounded pool of worker processes, failed downloads are
+retried with exponential backoff, and files that already exist are skipped
+so that an interrupted batch can simply be run again.
+"""
+
+import argparse
+import os
+import time
+from multiprocessing import Pool
+import download_cpc_year
+import download_reanalysis_year
+import instrument
+
+parser = argparse.ArgumentParser()  # pylint: disable=C0103
+parser.add_argument(
+    "--source", choices=["cpc", "reanalysis"], help="the data set to download"
+)
+parser.add_argument(
+    "--outfile",
+    help="the filenames of the data to save, with {year} and {var} placeholders",
+)
+parser.add_argument("--years", type=int, nargs="+", help="the years to download")
+parser.add_argument("--var", nargs="+", default=[None], help="the variable names")
+parser.add_argument(
+    "--coord_system", default="pressure", help="the reanalysis coordinate system"
+)
+parser.add_argument("--level", type=int, help="the reanalysis pressure level")
+parser.add_argument("--X0", type=float, default=None, help="lon min")
+parser.add_argument("--X1", type=float, default=None, help="lon max")
+parser.add_argument("--Y0", type=float, default=None, help="lat min")
+parser.add_argument("--Y1", type=float, default=None, help="lat max")
+parser.add_argument("--base_url", default=None, help="override the data source")
+parser.add_argument("--n_workers", type=int, default=4, help="concurrent downloads")
+parser.add_argument("--retries", type=int, default=3, help="retries per download")
+parser.add_argument(
+    "--backoff", type=float, default=10.0, help="seconds before the first retry"
+)
+
+
+def fetch_one(task):
+    """Download one file, retrying with exponential backoff
+
+    The partial file of a failed attempt is removed before the next one.
+
+    Returns:
+        None on success, otherwise a description of the last error
+    """
+    outfile, retries, backoff = task["outfile"], task["retries"], task["backoff"]
+    kwargs = dict(year=task["year"], outfile=outfile, **task["region"])
+    if task["base_url"] is not None:
+        kwargs["base_url"] = task["base_url"]
+    for attempt in range(retries + 1):
+        try:
+            if task["source"] == "cpc":
+                download_cpc_year.download_data(**kwargs)
+            else:
+                download_reanalysis_year.download_data(
+                    coord_system=task["coord_system"],
+                    var=task["var"],
+                    level=task["level"],
+                    **kwargs
+                )
+            return None
+        except (IOError, OSError, RuntimeError) as err:
+            # a write cut short must not be left next to the output
+            if os.path.isfile(outfile + ".part"):
+                os.remove(outfile + ".part")
+            if attempt == retries:
+                return "{}: {}".format(outfile, err)
+            time.sleep(backoff * 2 ** attempt)
+
+
+def _fetch_and_collect(task):
+    """Run fetch_one and hand its instrument records back to the parent
+    """
+    return fetch_one(task), instrument.collect()
+
+
+def download_batch(
+    source,
+    outfile,
+    years,
+    var=(None,),
+    coord_system="pressure",
+    level=None,
+    region=None,
+    base_url=None,
+    n_workers=4,
+    retries=3,
+    backoff=10.0,
+):
+    """Download every (variable, year) whose output does not exist yet
+
+    Tasks are ordered so that consecutive years of one variable go to the same
+    worker, which then reuses its open connection to the source when the
+    years are served from the same URL. region is an optional dict of
+    lonmin, lonmax, latmin and latmax passed on to the fetchers.
+    """
+    tasks = []
+    for varname in var:
+        for year in sorted(years):
+            fname = os.path.abspath(outfile.format(year=year, var=varname))
+            if os.path.isfile(fname):
+                continue
+            tasks.append(
+                dict(
+                    source=source,
+                    outfile=fname,
+                    year=year,
+                    var=varname,
+                    coord_system=coord_system,
+                    level=level,
+                    region=region or {},
+                    base_url=base_url,
+                    retries=retries,
+                    backoff=backoff,
+                )
+            )
+    if not tasks:
+        return []
+    chunksize = max(1, len(tasks) // n_workers)
+    with Pool(min(n_workers, len(tasks))) as pool:
+        results = pool.map(_fetch_and_collect, tasks, chunksize=chunksize)
+    for _, records in results:
+        instrument.merge(records)
+    return [err for err, _ in results if err is not None]
+
+
+def main():
+    """Parse the command line arguments and run download_batch().
+    """
+    args = parser.parse_args()
+    errors = download_batch(
+        source=args.source,
+        outfile=args.outfile,
+        years=args.years,
+        var=args.var,
+        coord_system=args.coord_system,
+        level=args.level,
+        region=dict(lonmin=args.X0, lonmax=args.X1, latmin=args.Y0, latmax=args.Y1),
+        base_url=args.base_url,
+        n_workers=args.n_workers,
+        retries=args.retries,
+        backoff=args.backoff,
+    )
+    if errors:
+        raise RuntimeError("failed downloads:\n" + "\n".join(errors))
+
+
+if __name__ == "__main__":
+    instrument.run(main)
@@ -8,36 +8,65 @@ http://iridl.ldeo.columbia.edu/SOURCES/.NOAA/.NCEP/.CPC/.UNIFIED_PRCP/.GAUGE_BAS
 import argparse
 import datetime
 import os
-import xarray as xr
 import numpy as np
+import instrument
+import iri_time
 
 parser = argparse.ArgumentParser()  # pylint: disable=C0103
 parser.add_argument("--outfile", help="the filename of the data to save")
 parser.add_argument("--year", help="the year of data to download")
+parser.add_argument("--X0", type=float, default=None, help="lon min")
+parser.add_argument("--X1", type=float, default=None, help="lon max")
+parser.add_argument("--Y0", type=float, default=None, help="lat min")
+parser.add_argument("--Y1", type=float, default=None, help="lat max")
+
+BASE_URL = "http://iridl.ldeo.columbia.edu/SOURCES/.NOAA/.NCEP/.CPC/"
+BASE_URL += ".UNIFIED_PRCP/.GAUGE_BASED/.GLOBAL/.v1p0"
 
 
 def convert_t_to_time(time_vec):
     """Parse the times from the IRI Data Library
     """
-    time = np.array(
-        [datetime.date(1960, 1, 1) + datetime.timedelta(np.int(ti)) for ti in time_vec]
-    )
-    return np.array(time)
+    return iri_time.days_to_datetime64(time_vec)
 
 
 def convert_time_to_t(date):
     """Turn a date into the appropriate IRI Data Library Format
     """
-    date_diff = date - datetime.date(1960, 1, 1)
-    time_dl = date_diff.days
-    return time_dl
+    return int(iri_time.datetime64_to_days(date))
 
 
-def download_data(year, outfile):
-    """Download data for a single year
+_OPEN_URLS = {}  # remote data sets already opened by this process
+
+
+def open_url(url):
+    """Open a remote data set, reusing the connection if already open
+    """
+    if url not in _OPEN_URLS:
+        import xarray as xr  # pylint: disable=C0415
+
+        _OPEN_URLS[url] = xr.open_dataarray(url, decode_times=False)
+    return _OPEN_URLS[url]
+
+
+def close_url(url):
+    """Forget a remote data set, so that the next open_url connects again
+    """
+    data = _OPEN_URLS.pop(url, None)
+    if data is not None:
+        data.close()
+
+
+def fetch_year(
+    year, base_url=BASE_URL, lonmin=None, lonmax=None, latmin=None, latmax=None
+):
+    """Read the data for a single year from the data library
+
+    If a region is given only that part of the grid is requested from the
+    server; otherwise the whole globe is downloaded.
     """
-    base_url = "http://iridl.ldeo.columbia.edu/SOURCES/.NOAA/.NCEP/.CPC/"
-    base_url += ".UNIFIED_PRCP/.GAUGE_BASED/.GLOBAL/.v1p0"
+    from hyperslab import select_region  # pylint: disable=C0415
+
     if year >= 1979 and year <= 2005:
         url = base_url + "/.RETRO/.rain/dods"
     elif year >= 2006 and year <= 2019:
@@ -50,26 +79,46 @@ def download_data(year, outfile):
     dt_end = convert_time_to_t(datetime.date(year, 12, 31))
 
     # Read in the raw data, rename the variables
-    rain_year = xr.open_dataarray(url, decode_times=False)
-    rain_year = rain_year.sel(T=slice(dt_start, dt_end)).load()
+    rain_year = open_url(url)
+    try:
+        rain_year = select_region(
+            rain_year, lonmin, lonmax, latmin, latmax, lon="X", lat="Y"
+        )
+        rain_year = rain_year.sel(T=slice(dt_start, dt_end)).load()
+    except (IOError, OSError, RuntimeError):
+        # the connection may be broken; a retry must not reuse it
+        close_url(url)
+        raise
     rain_year = rain_year.rename({"X": "lon", "Y": "lat", "T": "time"})
 
     # convert the time data
-    rain_year["time"] = convert_t_to_time(rain_year["time"])
-    rain_year["time"] = rain_year["time"].astype("datetime64")
+    rain_year["time"] = convert_t_to_time(rain_year["time"].values).astype(
+        "datetime64[ns]"
+    )
 
     # standardize longitudes and latitudes
     lon_new = rain_year["lon"].values.copy()
     lon_new[np.where(lon_new > 180.0)] -= 360
-    rain_year["lon"].values = lon_new
+    rain_year = rain_year.assign_coords(lon=lon_new)
     rain_year = rain_year.sortby("lon")
     rain_year = rain_year.sortby("lat")
     rain_year.attrs["year"] = year
+    return rain_year
+
+
+def download_data(year, outfile, base_url=BASE_URL, **region):
+    """Download data for a single year
+
+    The data are written atomically, so an interrupted download never
+    leaves a partial outfile.
+    """
+    from dataio import write_netcdf  # pylint: disable=C0415
+
+    with instrument.phase("fetch"):
+        rain_year = fetch_year(year, base_url=base_url, **region)
 
     # save the data to file
-    if os.path.isfile(outfile):
-        os.remove(outfile)
-    rain_year.to_netcdf(outfile, format="NETCDF4", mode="w")
+    write_netcdf(rain_year, outfile, layout="map")
 
 
 def main():
@@ -78,8 +127,15 @@ def main():
     args = parser.parse_args()
     outfile = os.path.abspath(args.outfile)
     year = int(args.year)
-    download_data(year, outfile)
+    download_data(
+        year,
+        outfile,
+        lonmin=args.X0,
+        lonmax=args.X1,
+        latmin=args.Y0,
+        latmax=args.Y1,
+    )
 
 
 if __name__ == "__main__":
-    main()
+    instrument.run(main)
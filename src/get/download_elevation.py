@@ -6,9 +6,7 @@ http://iridl.ldeo.columbia.edu/SOURCES/.NOAA/.NGDC/.GLOBE/.topo/X/-180/0.025/180
 
 import argparse
 import os
-import xarray as xr
-import numpy as np
-import pandas as pd
+import instrument
 
 parser = argparse.ArgumentParser()  # pylint: disable=C0103
 parser.add_argument("--outfile", help="the filename of the data to save")
@@ -17,15 +15,16 @@ parser.add_argument("--outfile", help="the filename of the data to save")
 def download_data(outfile):
     """Download the elevation data
     """
+    import xarray as xr  # pylint: disable=C0415
+    from dataio import write_netcdf  # pylint: disable=C0415
+
     # read in the data
     url = "http://iridl.ldeo.columbia.edu/SOURCES/.NOAA/.NGDC/.GLOBE/.topo/"
     url += "X/-180/0.025/180/GRID/Y/-90/0.025/90/GRID/dods"
     data = xr.open_dataarray(url)  # doesn't follow time conventions
 
     # save to file
-    if os.path.isfile(outfile):
-        os.remove(outfile)
-    data.to_netcdf(outfile, format="NETCDF4", mode="w")
+    write_netcdf(data, outfile)
 
 
 def main():
@@ -37,4 +36,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    instrument.run(main)
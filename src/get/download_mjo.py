@@ -8,32 +8,38 @@ and parse it
 import argparse
 import os
 from datetime import datetime
-import pandas as pd
-import xarray as xr
+import instrument
 
 parser = argparse.ArgumentParser()  # pylint: disable=C0103
 parser.add_argument("--syear", help="the first year to retain")
 parser.add_argument("--eyear", help="the last year to retain")
 parser.add_argument("--outfile", help="the path to the raw MJO data")
 parser.add_argument("--infile", help="the filename of the data to save")
+parser.add_argument("--store", help="keep the parsed table here between runs")
 
 
-def download_data(sdate, edate, infile, outfile):
-    """Download the MJO data"""
-    col_names = ["year", "month", "day", "RMM1", "RMM2", "phase", "amplitude", "source"]
-    mjo_df = pd.read_table(
-        infile, delim_whitespace=True, index_col=None, skiprows=2, names=col_names
-    )
-    mjo_df["time"] = pd.to_datetime(mjo_df[["year", "month", "day"]])
-    mjo_df.set_index("time", inplace=True)
+def download_data(sdate, edate, infile, outfile, store=None):
+    """Download the MJO data
+
+    The parsed table is kept in store (see indexstore), so that it is only
+    parsed again where the text file has changed.
+    """
+    import indexstore  # pylint: disable=C0415
+    from dataio import write_netcdf  # pylint: disable=C0415
+
+    with instrument.phase("parse"):
+        if store is None:
+            with open(infile) as fin:
+                columns = indexstore.parse_rmm(fin.read())
+        else:
+            columns = indexstore.update(store, infile, indexstore.parse_rmm)
+    columns = indexstore.date_range(columns, sdate, edate)
+    mjo_df = indexstore.to_dataframe(columns)
     mjo_df = mjo_df[["RMM1", "RMM2", "phase", "amplitude"]]
-    mjo_df = mjo_df.loc[sdate:edate]
     mjo_ds = mjo_df.to_xarray()
 
     # save to file
-    if os.path.isfile(outfile):
-        os.remove(outfile)
-    mjo_ds.to_netcdf(outfile, format="NETCDF4", mode="w")
+    write_netcdf(mjo_ds, outfile)
 
 
 def main():
@@ -44,8 +50,10 @@ def main():
     infile = os.path.abspath(args.infile)
     sdate = datetime(int(args.syear), 1, 1)
     edate = datetime(int(args.eyear), 12, 31)
-    download_data(sdate=sdate, edate=edate, infile=infile, outfile=outfile)
+    download_data(
+        sdate=sdate, edate=edate, infile=infile, outfile=outfile, store=args.store
+    )
 
 
 if __name__ == "__main__":
-    main()
+    instrument.run(main)
@@ -4,7 +4,7 @@
 """
 
 import argparse
-import xarray as xr
+import instrument
 
 parser = argparse.ArgumentParser()  # pylint: disable=C0103
 parser.add_argument("--model", help="name of the model")
@@ -24,6 +24,8 @@ def get_forecast(model, type):
         url += ".IGNProbFcsts/dods"
     else:
         raise ValueError("type is not valid")
+    import xarray as xr  # pylint: disable=C0415
+
     ds = xr.open_dataarray(url)
     ds = ds.sortby(["X", "Y"])  # be more consistent
     if ds.ndim > 2:
@@ -44,4 +46,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    instrument.run(main)
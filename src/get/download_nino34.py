@@ -7,44 +7,49 @@ and parse it
 
 import argparse
 import os
-import pandas as pd
-import numpy as np
 from datetime import datetime
+from urllib.request import urlopen
+import instrument
+
+URL = "http://iridl.ldeo.columbia.edu/SOURCES/.Indices/.nino/.EXTENDED/.NINO34/gridtable.tsv"
 
 parser = argparse.ArgumentParser()  # pylint: disable=C0103
 parser.add_argument("--syear", help="the first year to retain")
 parser.add_argument("--eyear", help="the last year to retain")
 parser.add_argument("--outfile", help="the filename of the data to save")
+parser.add_argument("--infile", help="a local copy of the table (default: fetch it)")
+parser.add_argument("--store", help="keep the parsed table here between runs")
 
 
-def download_data(sdate, edate, outfile):
+def download_data(sdate, edate, outfile, infile=None, store=None):
     """Load in the NINO 3.4 Data
+
+    If infile is given the table is read from there rather than fetched,
+    and, if store is also given, kept parsed between runs (see indexstore).
     """
-    url = "http://iridl.ldeo.columbia.edu/SOURCES/.Indices/.nino/.EXTENDED/.NINO34/gridtable.tsv"
-    col_name = "nino_34"
-    nino_34 = pd.read_table(
-        url,
-        delim_whitespace=True,
-        index_col=None,
-        skiprows=2,
-        names=["time", "{}".format(col_name)],
-    )
+    import indexstore  # pylint: disable=C0415
+    from dataio import write_netcdf  # pylint: disable=C0415
 
-    # the times don't make sense, parse them in
-    nino_34["time"] = np.int_(np.floor(nino_34["time"]))
-    nino_34["year"] = 1960 + nino_34["time"] // 12
-    nino_34["month"] = 1 + nino_34["time"] % 12
-    nino_34["day"] = 1
-    nino_34["time"] = pd.to_datetime(nino_34[["year", "month", "day"]])
-    nino_34.set_index("time", inplace=True)
-    nino_34 = nino_34[["{}".format(col_name)]]
-    nino_34 = nino_34.loc[sdate:edate]
+    if infile is None:
+        with instrument.phase("fetch"):
+            text = urlopen(URL).read().decode()
+        with instrument.phase("parse"):
+            columns = indexstore.parse_iri_monthly(text)
+    else:
+        with instrument.phase("parse"):
+            if store is None:
+                with open(infile) as fin:
+                    columns = indexstore.parse_iri_monthly(fin.read())
+            else:
+                columns = indexstore.update(
+                    store, infile, indexstore.parse_iri_monthly
+                )
+    columns = indexstore.date_range(columns, sdate, edate)
+    nino_34 = indexstore.to_dataframe(columns)[["nino_34"]]
     nino_34 = nino_34.to_xarray()
 
     # save to file
-    if os.path.isfile(outfile):
-        os.remove(outfile)
-    nino_34.to_netcdf(outfile, format="NETCDF4", mode="w")
+    write_netcdf(nino_34, outfile)
 
 
 def main():
@@ -54,8 +59,11 @@ def main():
     outfile = os.path.abspath(args.outfile)
     sdate = datetime(int(args.syear), 1, 1)
     edate = datetime(int(args.eyear), 12, 31)
-    download_data(sdate=sdate, edate=edate, outfile=outfile)
+    infile = None if args.infile is None else os.path.abspath(args.infile)
+    download_data(
+        sdate=sdate, edate=edate, outfile=outfile, infile=infile, store=args.store
+    )
 
 
 if __name__ == "__main__":
-    main()
+    instrument.run(main)
@@ -6,8 +6,7 @@ https://www.esrl.noaa.gov/psd/thredds/dodsC/Datasets/ncep.reanalysis2
 
 import argparse
 import os
-import xarray as xr
-import numpy as np
+import instrument
 
 parser = argparse.ArgumentParser()  # pylint: disable=C0103
 parser.add_argument("--outfile", help="the filename of the data to save")
@@ -15,15 +14,37 @@ parser.add_argument("--year", help="the year of data to download")
 parser.add_argument("--coord_system", help="the coordinate system containing the data")
 parser.add_argument("--var", help="the name of the variable")
 parser.add_argument("--level", help="the pressure level")
+parser.add_argument("--X0", type=float, default=None, help="lon min")
+parser.add_argument("--X1", type=float, default=None, help="lon max")
+parser.add_argument("--Y0", type=float, default=None, help="lat min")
+parser.add_argument("--Y1", type=float, default=None, help="lat max")
 
+BASE_URL = "https://www.esrl.noaa.gov/psd/thredds/dodsC/Datasets/ncep.reanalysis2"
 
-def download_data(coord_system, var, year, level, outfile):
-    """Download a single year of reanalysis V2 data
+
+def fetch_year(
+    coord_system,
+    var,
+    year,
+    level,
+    base_url=BASE_URL,
+    lonmin=None,
+    lonmax=None,
+    latmin=None,
+    latmax=None,
+):
+    """Read a single year of reanalysis V2 data
+
+    If a region is given only that part of the grid is requested from the
+    server. Winds used for the streamfunction must stay global.
     """
+    import xarray as xr  # pylint: disable=C0415
+    from hyperslab import select_region  # pylint: disable=C0415
+
     # Open a connection with the DODs URL
-    base_url = "https://www.esrl.noaa.gov/psd/thredds/dodsC/Datasets/ncep.reanalysis2"
     full_url = "{}/{}/{}.{}.nc".format(base_url, coord_system, var, year)
     data = xr.open_dataset(full_url, decode_cf=False).sel(level=level)
+    data = select_region(data, lonmin, lonmax, latmin, latmax)
 
     # Need to have the variable name since we created a data set not array
     varname = list(data.data_vars.keys())[0]
@@ -31,11 +52,26 @@ def download_data(coord_system, var, year, level, outfile):
     # Have to mess around a bit with the cf conventions for this data set
     data[varname].attrs.pop("missing_value")
     data = xr.decode_cf(data, mask_and_scale=True, decode_times=True)[varname]
+    return data
+
+
+def download_data(
+    coord_system, var, year, level, outfile, base_url=BASE_URL, **region
+):
+    """Download a single year of reanalysis V2 data
+
+    The data are written atomically, so an interrupted download never
+    leaves a partial outfile.
+    """
+    from dataio import write_netcdf  # pylint: disable=C0415
+
+    with instrument.phase("fetch"):
+        data = fetch_year(
+            coord_system, var, year, level, base_url=base_url, **region
+        ).load()
 
     # Save to file
-    if os.path.isfile(outfile):
-        os.remove(outfile)
-    data.to_netcdf(outfile, format="NETCDF4", mode="w")
+    write_netcdf(data, outfile, layout="map")
 
 
 def main():
@@ -48,9 +84,17 @@ def main():
     var = args.var
     level = int(args.level)
     download_data(
-        year=year, outfile=outfile, coord_system=coord_system, var=var, level=level
+        year=year,
+        outfile=outfile,
+        coord_system=coord_system,
+        var=var,
+        level=level,
+        lonmin=args.X0,
+        lonmax=args.X1,
+        latmin=args.Y0,
+        latmax=args.Y1,
     )
 
 
 if __name__ == "__main__":
-    main()
+    instrument.run(main)
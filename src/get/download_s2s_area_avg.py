@@ -6,10 +6,8 @@ https://www.esrl.noaa.gov/psd/thredds/dodsC/Datasets/ncep.reanalysis2
 
 import argparse
 import os
-import xarray as xr
-import numpy as np
-import pandas as pd
 from datetime import datetime
+import instrument
 
 parser = argparse.ArgumentParser()  # pylint: disable=C0103
 parser.add_argument("--outfile", help="the filename of the data to save")
@@ -21,6 +19,10 @@ parser.add_argument("--Y1", help="lat max")
 
 
 def download_data(outfile, year, lonmin, lonmax, latmin, latmax):
+    import pandas as pd  # pylint: disable=C0415
+    import xarray as xr  # pylint: disable=C0415
+    from dataio import write_netcdf  # pylint: disable=C0415
+
     # Get the URL
     url = "http://iridl.ldeo.columbia.edu/home/.mbell/.ECMWF/.S2Stest/.S2S/.ECMF_ph2/"
     url += ".forecast/.perturbed/.sfc_precip/.tp/"
@@ -38,9 +40,7 @@ def download_data(outfile, year, lonmin, lonmax, latmin, latmax):
     data = data.sel(S=slice(sdate, edate))
     data["S"] = pd.to_datetime(data["S"].values)
     data["L"] = data["L"]
-    if os.path.isfile(outfile):
-        os.remove(outfile)
-    data.to_netcdf(outfile, format="NETCDF4", mode="w")
+    write_netcdf(data, outfile)
 
 
 def main():
@@ -65,4 +65,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    instrument.run(main)
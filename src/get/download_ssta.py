@@ -5,10 +5,9 @@ http://iridl.ldeo.columbia.edu/expert/SOURCES/.NOAA/.NCEP/.EMC/.CMB/.GLOBAL/.Rey
 """
 
 import argparse
-import os
-import xarray as xr
 import numpy as np
-import pandas as pd
+import instrument
+import iri_time
 
 parser = argparse.ArgumentParser()  # pylint: disable=C0103
 parser.add_argument("--outfile", help="the filename of the data to save")
@@ -18,17 +17,17 @@ def main():
     """Parse the command line arguments and run download_data().
     """
     args = parser.parse_args()
+    import xarray as xr  # pylint: disable=C0415
+    from dataio import write_netcdf  # pylint: disable=C0415
 
     url = "http://iridl.ldeo.columbia.edu/expert/SOURCES/.NOAA/.NCEP/.EMC/.CMB/.GLOBAL/"
     url += ".Reyn_SmithOIv2/.monthly/.ssta/dods"  # split lines
     data = xr.open_dataarray(url, decode_times=False)  # doesn't follow time conventions
 
     # parse the time manually
-    time = np.int_(np.floor(data["T"]))
-    year = 1960 + time // 12
-    month = 1 + time % 12
-    time = pd.to_datetime(year * 10000 + month * 100 + 1, format="%Y%m%d")
-    data["T"] = time
+    data["T"] = iri_time.months_to_datetime64(data["T"].values).astype(
+        "datetime64[ns]"
+    )
 
     data = data.rename({"X": "lon", "Y": "lat", "T": "time"})
     longitudes = data["lon"].values
@@ -39,10 +38,8 @@ def main():
     data = data.sortby("lon").sortby("lat").sortby("time")
 
     # save to file
-    if os.path.isfile(args.outfile):
-        os.remove(args.outfile)
-    data.to_netcdf(args.outfile, format="NETCDF4", mode="w")
+    write_netcdf(data, args.outfile, layout="map")
 
 
 if __name__ == "__main__":
-    main()
+    instrument.run(main)
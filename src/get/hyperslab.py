@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Select a longitude/latitude box from a remote data set before loading it
+
+Indexing a lazily opened OPeNDAP data set only transfers the requested
+hyperslab. Sources store longitudes on 0 to 360 while our regions use -180
+to 180, so a box crossing the prime meridian is requested as two pieces.
+"""
+
+import numpy as np
+import xarray as xr
+
+
+def _within(values, vmin, vmax, tol=1e-6):
+    """Whether each of values falls within [vmin, vmax]
+    """
+    return (values >= vmin - tol) & (values <= vmax + tol)
+
+
+def _index_slice(values, vmin, vmax, tol=1e-6):
+    """The contiguous index range of values falling within [vmin, vmax]
+    """
+    idx = np.where(_within(values, vmin, vmax, tol))[0]
+    if idx.size == 0:
+        raise ValueError("no grid points between {} and {}".format(vmin, vmax))
+    return slice(idx.min(), idx.max() + 1)
+
+
+def lon_ranges(lonmin, lonmax, lons):
+    """Express a -180 to 180 longitude range in the convention of lons
+
+    Returns:
+        a list of one or two (min, max) ranges, two when the box wraps and
+        both sides of the wrap hold grid points (a box ending at 0, say, has
+        nothing to take on the eastern side of a grid without a point at 0)
+    """
+    if lonmax - lonmin >= 360:
+        return [(lons.min(), lons.max())]
+    if lons.max() <= 180:
+        return [(lonmin, lonmax)]
+    lon0 = lonmin % 360
+    lon1 = lonmax % 360
+    if lon0 <= lon1:
+        return [(lon0, lon1)]
+    ranges = [(lon0, 360), (0, lon1)]
+    return [rng for rng in ranges if _within(lons, *rng).any()] or ranges
+
+
+def select_region(data, lonmin, lonmax, latmin, latmax, lon="lon", lat="lat"):
+    """Select a box from data without loading anything outside it
+
+    Latitudes may be stored in either order. Any of the bounds may be None,
+    in which case that direction is not subset.
+
+    Args:
+        data: a lazily opened DataArray or Dataset
+        lonmin, lonmax: longitude bounds on -180 to 180
+        latmin, latmax: latitude bounds
+        lon, lat: the names of the longitude and latitude coordinates
+    """
+    if latmin is not None and latmax is not None:
+        data = data.isel({lat: _index_slice(data[lat].values, latmin, latmax)})
+    if lonmin is None or lonmax is None:
+        return data
+    lons = data[lon].values
+    pieces = [
+        data.isel({lon: _index_slice(lons, lon0, lon1)})
+        for lon0, lon1 in lon_ranges(lonmin, lonmax, lons)
+    ]
+    if len(pieces) == 1:
+        return pieces[0]
+    return xr.concat(pieces, dim=lon)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Derivatives on the sphere and area-averaged gradient indices
+
+An index such as the South Central Atlantic Dipole is the average, over a
+box, of the derivative of a field along one direction. The derivative is
+taken only along that direction, with centered differences in metres
+(one-sided at the edges of the box), and is evaluated block by block when
+the field is a dask array, so the whole record never needs to be in memory.
+"""
+
+import numpy as np
+import xarray as xr
+import regions
+
+RADIUS = 6.371e6  # earth radius in m
+
+
+def _gradient(values, coord):
+    """Centered differences of values along their last axis
+    """
+    if values.shape[-1] < 2:
+        return np.full_like(values, np.nan)
+    return np.gradient(values, coord, axis=-1)
+
+
+def derivative(data, dim="lat"):
+    """The derivative of data along lat (d/dy) or lon (d/dx), per metre
+
+    Args:
+        data: a DataArray with lat and lon coordinates in degrees
+        dim: "lat" for the meridional, "lon" for the zonal derivative
+    """
+    if dim not in ("lat", "lon"):
+        raise ValueError("can only differentiate along lat or lon, not {}".format(dim))
+    if data.chunks is not None:
+        data = data.chunk({dim: -1})
+    coord = np.deg2rad(data[dim].values.astype("float64"))
+    ddx = xr.apply_ufunc(
+        _gradient,
+        data,
+        kwargs=dict(coord=coord),
+        input_core_dims=[[dim]],
+        output_core_dims=[[dim]],
+        dask="parallelized",
+        output_dtypes=[data.dtype],
+    ).transpose(*data.dims)
+    if dim == "lat":
+        return ddx / RADIUS
+    return ddx / (RADIUS * np.cos(np.deg2rad(data["lat"])))
+
+
+def gradient_index(data, region, dim="lat", units=None, cache_dir=None):
+    """The area-weighted mean over a box of the derivative of data along dim
+
+    As in the original definition of the dipole, the derivative is taken on
+    the grid cells inside the box only. The index is in units of data per
+    metre (units, or else data.attrs["units"], followed by "m-1").
+    """
+    sub = regions.subset(data, region)
+    ddx = derivative(sub, dim=dim)
+    index = regions.regional_mean(ddx, [region], cache_dir=cache_dir)
+    index = index.squeeze("region", drop=True)
+    units = units or data.attrs.get("units")
+    if units is not None:
+        index.attrs["units"] = "{} m-1".format(units)
+    return index
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A local store of parsed climate index tables (MJO RMM, NINO 3.4)
+
+Each index is kept as one .npz file of columns (time as datetime64[D] plus
+one array per variable) together with the checksum of the source text it
+was parsed from. Updating from an unchanged source reads nothing but the
+checksum; when the source has only grown by new rows at its end (as the BoM
+and IRI tables do), only those rows are parsed and appended; anything else
+triggers a full re-parse.
+
+Lookups work on the sorted time column with searchsorted and boolean masks,
+e.g. mjo_days(columns, phase=4, min_amplitude=1).
+"""
+
+import hashlib
+import io
+import os
+import numpy as np
+import pandas as pd
+import iri_time
+
+RMM_COLUMNS = ["year", "month", "day", "RMM1", "RMM2", "phase", "amplitude"]
+RMM_MISSING = 999  # missing days have phase 999 and amplitude 1.E36
+
+
+def _sha1(data):
+    """The hex digest of some bytes
+    """
+    return hashlib.sha1(data).hexdigest()
+
+
+def parse_rmm(text, skiprows=2):
+    """Parse the lines of the BoM RMM table into columns
+    """
+    table = pd.read_csv(
+        io.StringIO(text),
+        sep=r"\s+",
+        header=None,
+        skiprows=skiprows,
+        usecols=range(len(RMM_COLUMNS)),
+        names=RMM_COLUMNS,
+    )
+    time = pd.to_datetime(table[["year", "month", "day"]]).values
+    columns = {"time": time.astype("datetime64[D]")}
+    for name in ["RMM1", "RMM2", "amplitude"]:
+        columns[name] = table[name].values.astype("float64")
+    columns["phase"] = table["phase"].values.astype("int64")
+    return columns
+
+
+def parse_iri_monthly(text, skiprows=2, name="nino_34"):
+    """Parse an IRI two-column table of months since 1960 and values
+    """
+    table = pd.read_csv(
+        io.StringIO(text), sep=r"\s+", header=None, skiprows=skiprows
+    )
+    return {
+        "time": iri_time.months_to_datetime64(table[0].values),
+        name: table[1].values.astype("float64"),
+    }
+
+
+def load(store):
+    """The columns and metadata of a store file, or None if there is none
+    """
+    if not os.path.isfile(store):
+        return None
+    with np.load(store) as saved:
+        return {key: saved[key] for key in saved.files}
+
+
+def _save(store, columns):
+    """Write a store file atomically
+    """
+    dirname = os.path.dirname(os.path.abspath(store))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmpfile = store + ".part"
+    with open(tmpfile, "wb") as fnpz:
+        np.savez(fnpz, **columns)
+    os.replace(tmpfile, store)
+
+
+def update(store, source, parser, skiprows=2):
+    """Bring a store up to date with its source file and return its columns
+
+    Args:
+        store: the .npz file of the store
+        source: the text file the index is parsed from
+        parser: a function (text, skiprows) -> dict of columns, one of them
+            "time", such as parse_rmm
+        skiprows: the number of header lines of the source
+    """
+    with open(source, "rb") as fsource:
+        raw = fsource.read()
+    # only complete lines are parsed, so a file caught mid-write is safe
+    n_bytes = raw.rfind(b"\n") + 1
+    checksum = _sha1(raw[:n_bytes])
+
+    saved = load(store)
+    if saved is not None and str(saved["_checksum"]) == checksum:
+        return _columns(saved)
+    if (
+        saved is not None
+        and int(saved["_n_bytes"]) <= n_bytes
+        and _sha1(raw[: int(saved["_n_bytes"])]) == str(saved["_checksum"])
+    ):
+        new = parser(raw[int(saved["_n_bytes"]) : n_bytes].decode(), skiprows=0)
+        columns = {
+            key: np.concatenate([value, new[key]])
+            for key, value in _columns(saved).items()
+        }
+    else:
+        columns = parser(raw[:n_bytes].decode(), skiprows=skiprows)
+
+    order = np.argsort(columns["time"], kind="mergesort")
+    columns = {key: value[order] for key, value in columns.items()}
+    _save(store, dict(columns, _checksum=checksum, _n_bytes=n_bytes))
+    return columns
+
+
+def _columns(saved):
+    """The data columns of a loaded store, without its metadata
+    """
+    return {key: value for key, value in saved.items() if not key.startswith("_")}
+
+
+def date_range(columns, sdate=None, edate=None):
+    """The rows of columns with sdate <= time <= edate
+    """
+    time = columns["time"]
+    i0 = 0 if sdate is None else np.searchsorted(time, np.datetime64(sdate, "D"))
+    i1 = (
+        time.size
+        if edate is None
+        else np.searchsorted(time, np.datetime64(edate, "D"), side="right")
+    )
+    return {key: value[i0:i1] for key, value in columns.items()}
+
+
+def mjo_days(columns, phase=None, min_amplitude=None, sdate=None, edate=None):
+    """The dates on which the MJO was in some phase(s) and strong enough
+
+    Args:
+        columns: the columns of the RMM store
+        phase: a phase or a list of phases, or None for any
+        min_amplitude: keep only days with amplitude above this
+        sdate, edate: restrict to this date range
+    """
+    columns = date_range(columns, sdate, edate)
+    keep = columns["phase"] < RMM_MISSING
+    if phase is not None:
+        keep &= np.isin(columns["phase"], np.atleast_1d(phase))
+    if min_amplitude is not None:
+        keep &= columns["amplitude"] > min_amplitude
+    return columns["time"][keep]
+
+
+def to_dataframe(columns):
+    """The columns as a DataFrame indexed by time
+    """
+    frame = pd.DataFrame(
+        {key: value for key, value in columns.items() if key != "time"},
+        index=pd.DatetimeIndex(columns["time"].astype("datetime64[ns]"), name="time"),
+    )
+    return frame
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Record where the time of a script goes, and leave a manifest by its outputs
+
+The scripts wrap the main parts of their work in phase blocks:
+
+    with instrument.phase("fetch"):
+        data = fetch_year(...)
+
+and are started with instrument.run(main). Each phase records its wall
+time, CPU time (including that of worker processes once they have exited),
+peak resident memory and the bytes read and written. The bytes come from
+/proc/self/io, which counts sockets as well as files, so an OPeNDAP fetch
+shows up as bytes read; where it is not available they are left out.
+
+Every file written through dataio is registered as an output (others can be
+added with add_output). When the script ends, run writes the phases of the
+whole run to <output>.manifest.json next to each output. Worker processes
+hand their records back with collect, to be added with merge.
+"""
+
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+
+MANIFEST_SUFFIX = ".manifest.json"
+
+_PHASES = []  # the finished phases of this process
+_OPEN = []  # the phases in progress, outermost first
+_OUTPUTS = []  # the files written by this process
+
+
+def _io_bytes():
+    """Bytes read and written so far by this process, or (None, None)
+    """
+    try:
+        with open("/proc/self/io") as fio:
+            fields = dict(line.split(":", 1) for line in fio if ":" in line)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _peak_rss():
+    """The peak resident memory of this process since the last reset, in bytes
+    """
+    try:
+        with open("/proc/self/status") as fstatus:
+            for line in fstatus:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kB on Linux and cannot be reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss():
+    """Reset the peak resident memory to the current one, where Linux allows it
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fclear:
+            fclear.write("5")
+    except OSError:
+        pass
+
+
+def _snapshot():
+    """The clocks and IO counters of this process
+    """
+    times = os.times()
+    read, written = _io_bytes()
+    return dict(
+        wall=time.perf_counter(),
+        cpu=times.user + times.system + times.children_user + times.children_system,
+        read=read,
+        written=written,
+    )
+
+
+@contextmanager
+def phase(name):
+    """Measure a block of code as the phase called name
+
+    Phases can be nested; the peak memory of an inner phase also counts for
+    the phases around it.
+    """
+    peak = _peak_rss()
+    for outer in _OPEN:
+        outer["peak_rss_bytes"] = max(outer["peak_rss_bytes"], peak)
+    _reset_peak_rss()
+    record = dict(
+        name=name,
+        parent=_OPEN[-1]["name"] if _OPEN else None,
+        pid=os.getpid(),
+        peak_rss_bytes=0,
+    )
+    start = _snapshot()
+    _OPEN.append(record)
+    try:
+        yield record
+    finally:
+        _OPEN.pop()
+        end = _snapshot()
+        record["wall_s"] = end["wall"] - start["wall"]
+        record["cpu_s"] = end["cpu"] - start["cpu"]
+        record["peak_rss_bytes"] = max(record["peak_rss_bytes"], _peak_rss())
+        if start["read"] is not None:
+            record["read_bytes"] = end["read"] - start["read"]
+            record["written_bytes"] = end["written"] - start["written"]
+        for outer in _OPEN:
+            outer["peak_rss_bytes"] = max(
+                outer["peak_rss_bytes"], record["peak_rss_bytes"]
+            )
+        _PHASES.append(record)
+
+
+def add_output(path):
+    """Register a file (or Zarr group) written by this process
+    """
+    path = os.path.abspath(path)
+    if path not in _OUTPUTS:
+        _OUTPUTS.append(path)
+
+
+def drop_outputs(directory):
+    """Stop counting the files below directory (e.g. a cache) as outputs
+    """
+    directory = os.path.join(os.path.abspath(directory), "")
+    _OUTPUTS[:] = [path for path in _OUTPUTS if not path.startswith(directory)]
+
+
+def collect():
+    """Hand over the phases and outputs recorded so far, e.g. by a worker
+
+    Returns:
+        a dict to pass to merge in the parent process
+    """
+    records = dict(phases=list(_PHASES), outputs=list(_OUTPUTS))
+    del _PHASES[:]
+    del _OUTPUTS[:]
+    return records
+
+
+def merge(records):
+    """Add the phases and outputs handed over by collect
+    """
+    _PHASES.extend(records["phases"])
+    for path in records["outputs"]:
+        add_output(path)
+
+
+def _size(path):
+    """The size of a file or of everything in a directory, in bytes
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, _, fnames in os.walk(path):
+        for fname in fnames:
+            total += os.path.getsize(os.path.join(dirpath, fname))
+    return total
+
+
+def manifest(script, argv, started):
+    """The record of this run, as written next to its outputs
+    """
+    outputs = [path for path in _OUTPUTS if os.path.exists(path)]
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return dict(
+        run_id=uuid.uuid4().hex,
+        script=script,
+        argv=list(argv),
+        started=time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+        host=platform.node(),
+        python=platform.python_version(),
+        max_rss_children_bytes=children.ru_maxrss * 1024,
+        phases=list(_PHASES),
+        outputs=[dict(path=path, size_bytes=_size(path)) for path in outputs],
+    )
+
+
+def write_manifests(record):
+    """Write a manifest next to every output of the run
+    """
+    text = json.dumps(record, indent=2)
+    for output in record["outputs"]:
+        fname = output["path"] + MANIFEST_SUFFIX
+        with open(fname + ".part", "w") as fjson:
+            fjson.write(text)
+        os.replace(fname + ".part", fname)
+
+
+def run(main, script=None):
+    """Run the main function of a script as the phase "main", then write
+    the manifests of its outputs
+
+    Nothing is written if main fails.
+    """
+    script = script or os.path.basename(sys.argv[0])
+    started = time.time()
+    with phase("main"):
+        main()
+    write_manifests(manifest(script, sys.argv[1:], started))
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Decode and encode the time axes of the IRI Data Library
+
+The Data Library counts time as "days since 1960-01-01" (daily data such as
+CPC rainfall) or "months since 1960-01-01" (monthly data such as the SST
+anomalies and NINO 3.4), neither of which xarray decodes. These functions
+convert whole arrays with datetime64 arithmetic.
+"""
+
+import numpy as np
+
+EPOCH_DAY = np.datetime64("1960-01-01", "D")
+EPOCH_MONTH = np.datetime64("1960-01", "M")
+
+
+def days_to_datetime64(days):
+    """Dates from days since 1960, dropping any fraction of a day
+    """
+    days = np.trunc(np.asarray(days, dtype="float64")).astype("int64")
+    return EPOCH_DAY + days.astype("timedelta64[D]")
+
+
+def datetime64_to_days(dates):
+    """Days since 1960 of dates (datetime64, datetime.date or strings)
+    """
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    return (dates - EPOCH_DAY).astype("int64")
+
+
+def months_to_datetime64(months):
+    """The first day of each month from months since 1960
+
+    The Data Library puts monthly values at the middle of the month (e.g.
+    0.5 for January 1960), so the fraction is dropped by rounding down.
+    """
+    months = np.floor(np.asarray(months, dtype="float64")).astype("int64")
+    return (EPOCH_MONTH + months.astype("timedelta64[M]")).astype("datetime64[D]")
+
+
+def datetime64_to_months(dates):
+    """Months since 1960 of the month of each date
+    """
+    dates = np.asarray(dates, dtype="datetime64[M]")
+    return (dates - EPOCH_MONTH).astype("int64")
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Read the parameters kept in the config/*.mk files
+
+The Makefile includes these files, so they stay the single place where
+regions and other parameters are defined; scripts that need more than a
+few of them can read them here instead of taking each one on the command
+line.
+"""
+
+import re
+from collections import OrderedDict
+import regions
+
+_ASSIGNMENT = re.compile(r"^\s*([A-Za-z_][A-Za-z0-9_]*)\s*(?::=|\?=|=)\s*(.*?)\s*$")
+_BOX_KEYS = ("X0", "X1", "Y0", "Y1")
+
+
+def read_mk(paths):
+    """The variables assigned in one or more Makefile fragments
+
+    Comments are dropped and values are returned as strings, unexpanded (a
+    value such as $(shell seq 1 10) is returned as written).
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    variables = OrderedDict()
+    for path in paths:
+        with open(path) as fmk:
+            for line in fmk:
+                match = _ASSIGNMENT.match(line.split("#", 1)[0])
+                if match is not None:
+                    variables[match.group(1)] = match.group(2)
+    return variables
+
+
+def box_names(variables):
+    """The prefixes P for which PX0, PX1, PY0 and PY1 are all defined
+    """
+    return [
+        name[:-2]
+        for name in variables
+        if name.endswith("X0")
+        and all(name[:-2] + key in variables for key in _BOX_KEYS)
+    ]
+
+
+def read_boxes(paths, names=None):
+    """The lon/lat boxes defined in config files, as regions
+
+    Args:
+        paths: the .mk files to read
+        names: the prefixes of the boxes to return, e.g. ["LPR", "WT"]; by
+            default every box that is defined
+    """
+    variables = read_mk(paths)
+    if names is None:
+        names = box_names(variables)
+    boxes = []
+    for name in names:
+        try:
+            bounds = [float(variables[name + key]) for key in _BOX_KEYS]
+        except KeyError:
+            raise ValueError("{} is not a box in {}".format(name, paths))
+        boxes.append(regions.box(name, *bounds))
+    return boxes
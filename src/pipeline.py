@@ -0,0 +1,843 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Run the get and process steps of the Makefile from a single interpreter
+
+The targets are the same as in the Makefile (CPC_RAW, PSI_RAW, RAIN, WT_CI,
+get, process, ...) and each task calls the same function as the script that
+Make would start (download_data, process_year, calc_anomaly, make_subset,
+...), or its main with the same arguments where the script has no separate
+function. Tasks whose inputs are ready run on a pool of worker processes
+that have imported the stage modules once, instead of one new interpreter
+per file. The steps that spread their work over their own pool (WT_CI,
+WT_SIG and WT) run in the main process, with the --n_jobs workers shared
+between them and the tasks still running on the pool.
+
+A task is up to date when its outputs exist with the content they had when
+it last ran and its inputs (data, config files, its script and the modules
+of src/ the script imports) have the same content hashes as then. Hashes
+are kept in a state file and only computed again for files whose size or
+modification time changed, so touching a file without changing it does not
+rerun anything. Downloads that exist before the first run are taken as
+they are rather than fetched again.
+
+Run from the top of the repository, e.g. python src/pipeline.py process.
+"""
+
+import argparse
+import ast
+import hashlib
+import importlib
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime
+from glob import glob
+from multiprocessing import Pool
+from urllib.request import urlopen
+
+SRC = os.path.dirname(os.path.abspath(__file__))
+STAGE_DIRS = [os.path.join(SRC, "get"), os.path.join(SRC, "process")]
+sys.path[:0] = [path for path in STAGE_DIRS if path not in sys.path]
+
+# pylint: disable=C0413
+import instrument
+import mkconfig
+import regions
+
+parser = argparse.ArgumentParser()  # pylint: disable=C0103
+parser.add_argument("targets", nargs="*", default=["process"], help="what to make")
+parser.add_argument("--n_jobs", type=int, default=4, help="worker processes")
+parser.add_argument(
+    "--state", default="data/interim/pipeline_state.json", help="the hashes file"
+)
+parser.add_argument(
+    "--dry_run", action="store_true", help="list the tasks that are out of date"
+)
+parser.add_argument(
+    "--force", nargs="*", default=[], help="run these tasks even if up to date"
+)
+
+# the modules the workers import once, before their first task
+STAGE_MODULES = [
+    "download_cpc_year",
+    "download_reanalysis_year",
+    "download_elevation",
+    "download_ssta",
+    "download_mjo",
+    "download_nino34",
+    "download_s2s_area_avg",
+    "calculate_streamfunction",
+    "make_anomaly",
+    "make_time_series",
+    "make_regions",
+    "make_subset",
+    "make_weather_type",
+    "make_wt_significance",
+    "make_composite",
+    "make_dipole",
+    "make_store",
+]
+
+EXT = "data/external/"
+PROC = "data/processed/"
+SST = EXT + "ssta_cmb.nc"
+INDEX_STORE = "data/interim/indices/"
+ANOM_CACHE = "data/interim/anomaly/"
+ANOMALIES = dict(
+    RAIN=PROC + "rain.nc",
+    PSI=PROC + "streamfunction.nc",
+    UWND=PROC + "uwnd.nc",
+    VWND=PROC + "vwnd.nc",
+)
+
+MJO_URL = "http://www.bom.gov.au/climate/mjo/graphics/rmm.74toRealtime.txt"
+NINO34_URL = "http://iridl.ldeo.columbia.edu/SOURCES/.Indices/.nino/.EXTENDED/"
+NINO34_URL += ".NINO34/gridtable.tsv"
+
+
+def fetch_url(url, outfile):
+    """Download a text file, atomically (the wget steps of the Makefile)
+    """
+    with instrument.phase("fetch"):
+        data = urlopen(url).read()
+    with open(outfile + ".part", "wb") as fout:
+        fout.write(data)
+    os.replace(outfile + ".part", outfile)
+    instrument.add_output(outfile)
+
+
+def _argv(**options):
+    """A command line from keyword arguments, e.g. infile="a" -> --infile a
+    """
+    argv = []
+    for option, value in options.items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        argv += ["--" + option] + [str(val) for val in values]
+    return argv
+
+
+_IMPORTS = {}  # the src/ modules imported by each script, by path
+
+
+def local_imports(script):
+    """The files of the modules of src/ that a script imports, directly or
+    through other modules of src/, lazy imports included
+    """
+    if script in _IMPORTS:
+        return _IMPORTS[script]
+    _IMPORTS[script] = []  # import cycles end here
+    with open(script) as fpy:
+        tree = ast.parse(fpy.read(), filename=script)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.add(node.module.split(".")[0])
+    files = []
+    for name in sorted(names):
+        for directory in [SRC] + STAGE_DIRS:
+            path = os.path.join(directory, name + ".py")
+            if os.path.isfile(path):
+                path = os.path.relpath(path, os.path.join(SRC, ".."))
+                files += [path] + local_imports(path)
+                break
+    _IMPORTS[script] = sorted(set(files) - {script})
+    return _IMPORTS[script]
+
+
+def task(name, module, function, inputs=(), outputs=(), inline=False, **kwargs):
+    """A step of the pipeline
+
+    Args:
+        name: the name of the task
+        module, function: what to call; a function "main" is called with
+            kwargs["argv"] as its command line
+        inputs: the files the task reads, such as data and config; its script
+            and the modules of src/ that the script imports are added
+        outputs: the files the task writes
+        inline: run in the main process rather than on the worker pool
+        kwargs: the keyword arguments of the function
+    """
+    script = os.path.join("src", "get", module + ".py")
+    if not os.path.isfile(script):
+        script = os.path.join("src", "process", module + ".py")
+    if not os.path.isfile(script):
+        script = os.path.join("src", module + ".py")
+    return dict(
+        name=name,
+        module=module,
+        function=function,
+        kwargs=kwargs,
+        inputs=[script] + local_imports(script) + list(inputs),
+        outputs=list(outputs),
+        inline=inline,
+    )
+
+
+def read_config(config_dir="config"):
+    """The parameters of the config/*.mk files that the tasks need
+    """
+    mk_files = sorted(glob(os.path.join(config_dir, "*.mk")))
+    variables = mkconfig.read_mk(mk_files)
+    syear, eyear = int(variables["SYEAR"]), int(variables["EYEAR"])
+    return dict(
+        dir=config_dir,
+        variables=variables,
+        boxes={region["name"]: region for region in mkconfig.read_boxes(mk_files)},
+        syear=syear,
+        eyear=eyear,
+        years=list(range(syear, eyear + 1)),
+        wtk=_seq(variables["WTK"]),
+    )
+
+
+def _seq(value):
+    """The numbers of a $(shell seq first step last) Make value
+    """
+    words = value.split("seq", 1)[1].replace(")", " ").split()
+    first, step, last = [int(word) for word in words[:3]]
+    return list(range(first, last + 1, step))
+
+
+def _mk(config, name):
+    """The path of a config file
+    """
+    return os.path.join(config["dir"], name + ".mk")
+
+
+def _bounds(config, name):
+    """The lonmin, lonmax, latmin and latmax keyword arguments of a box
+    """
+    box = config["boxes"][name]["box"]
+    return dict(zip(["lonmin", "lonmax", "latmin", "latmax"], box))
+
+
+def raw_file(var, year):
+    """The downloaded file of one year of cpc rain, uwnd or vwnd
+    """
+    if var == "cpc":
+        return EXT + "cpc_rain_{}.nc".format(year)
+    return EXT + "reanalysisv2_{}_850_{}.nc".format(var, year)
+
+
+def get_tasks(config):
+    """The tasks of the get section of the Makefile, and their targets
+    """
+    years = config["years"]
+    tasks = []
+    targets = {}
+    for year in years:
+        outfile = raw_file("cpc", year)
+        tasks.append(
+            task(
+                "cpc_rain_{}".format(year),
+                "download_cpc_year",
+                "download_data",
+                inputs=[_mk(config, "rain_region")],
+                outputs=[outfile],
+                year=year,
+                outfile=outfile,
+                **_bounds(config, "RAIN")
+            )
+        )
+        for var in ["uwnd", "vwnd"]:
+            outfile = raw_file(var, year)
+            tasks.append(
+                task(
+                    "{}_{}".format(var, year),
+                    "download_reanalysis_year",
+                    "download_data",
+                    outputs=[outfile],
+                    coord_system="pressure",
+                    var=var,
+                    year=year,
+                    level=850,
+                    outfile=outfile,
+                )
+            )
+    targets["CPC_RAW"] = ["cpc_rain_{}".format(year) for year in years]
+    targets["UWND_RAW"] = ["uwnd_{}".format(year) for year in years]
+    targets["VWND_RAW"] = ["vwnd_{}".format(year) for year in years]
+
+    mjo_raw = EXT + "mjo_raw_unedited.txt"
+    nino34_raw = EXT + "nino34_raw_unedited.tsv"
+    sdate = datetime(config["syear"], 1, 1)
+    edate = datetime(config["eyear"], 12, 31)
+    tasks += [
+        task(
+            "ELEV",
+            "download_elevation",
+            "download_data",
+            outputs=[EXT + "elevation.nc"],
+            outfile=EXT + "elevation.nc",
+        ),
+        task("SST", "download_ssta", "main", outputs=[SST], argv=_argv(outfile=SST)),
+        task(
+            "mjo_raw",
+            "pipeline",
+            "fetch_url",
+            outputs=[mjo_raw],
+            url=MJO_URL,
+            outfile=mjo_raw,
+        ),
+        task(
+            "MJO",
+            "download_mjo",
+            "download_data",
+            inputs=[mjo_raw],
+            outputs=[EXT + "mjo.nc"],
+            sdate=sdate,
+            edate=edate,
+            infile=mjo_raw,
+            outfile=EXT + "mjo.nc",
+            store=INDEX_STORE + "mjo.npz",
+        ),
+        task(
+            "nino34_raw",
+            "pipeline",
+            "fetch_url",
+            outputs=[nino34_raw],
+            url=NINO34_URL,
+            outfile=nino34_raw,
+        ),
+        task(
+            "NINO34",
+            "download_nino34",
+            "download_data",
+            inputs=[nino34_raw],
+            outputs=[EXT + "nino34.nc"],
+            sdate=sdate,
+            edate=edate,
+            infile=nino34_raw,
+            outfile=EXT + "nino34.nc",
+            store=INDEX_STORE + "nino34.npz",
+        ),
+        task(
+            "S2SAA",
+            "download_s2s_area_avg",
+            "download_data",
+            inputs=[_mk(config, "rpy_region")],
+            outputs=[EXT + "s2s_area_avg.nc"],
+            outfile=EXT + "s2s_area_avg.nc",
+            year=2015,
+            **_bounds(config, "LPR")
+        ),
+    ]
+    targets["get"] = (
+        targets["CPC_RAW"]
+        + targets["UWND_RAW"]
+        + targets["VWND_RAW"]
+        + ["ELEV", "SST", "MJO", "NINO34", "S2SAA"]
+    )
+    return tasks, targets
+
+
+def process_tasks(config, n_jobs=4):
+    """The tasks of the processed data section of the Makefile, and their
+    targets
+
+    Args:
+        config: the output of read_config
+        n_jobs: the number of workers of the steps that have their own pool
+    """
+    years = config["years"]
+    variables = config["variables"]
+    tasks = []
+    targets = {}
+    psi_raw = [PROC + "reanalysisv2_psi_850_{}.nc".format(year) for year in years]
+    for i, year in enumerate(years):
+        prev = dict(prev_uwnd=None, prev_vwnd=None)
+        if i > 0:
+            prev = dict(
+                prev_uwnd=raw_file("uwnd", year - 1),
+                prev_vwnd=raw_file("vwnd", year - 1),
+            )
+        wind = [raw_file("uwnd", year), raw_file("vwnd", year)]
+        tasks.append(
+            task(
+                "psi_{}".format(year),
+                "calculate_streamfunction",
+                "process_year",
+                inputs=wind + [path for path in prev.values() if path is not None],
+                outputs=[psi_raw[i]],
+                uwnd=wind[0],
+                vwnd=wind[1],
+                outfile=psi_raw[i],
+                last=i == len(years) - 1,
+                daily=True,
+                **prev
+            )
+        )
+    targets["PSI_RAW"] = ["psi_{}".format(year) for year in years]
+
+    rain = ANOMALIES["RAIN"]
+    psi = ANOMALIES["PSI"]
+    psi_wt = PROC + "psi_wtype.nc"
+    wtype = PROC + "weather_type.nc"
+    wt_model = PROC + "weather_type_model.npz"
+    for name, files, pattern, box, to_daily in [
+        ("RAIN", "cpc", EXT + "cpc_rain_*.nc", "RAIN", 0),
+        ("PSI", None, PROC + "reanalysisv2_psi_850_*.nc", "RNLS", 0),
+        ("UWND", "uwnd", EXT + "reanalysisv2_uwnd_850_*.nc", "RNLS", 1),
+        ("VWND", "vwnd", EXT + "reanalysisv2_vwnd_850_*.nc", "RNLS", 1),
+    ]:
+        files = psi_raw if files is None else [raw_file(files, y) for y in years]
+        region_mk = "rain_region" if box == "RAIN" else "reanalysis_region"
+        tasks.append(
+            task(
+                name,
+                "make_anomaly",
+                "calc_anomaly",
+                inputs=files + [_mk(config, "time"), _mk(config, region_mk)],
+                outputs=[ANOMALIES[name]],
+                path=pattern,
+                outfile=ANOMALIES[name],
+                syear=config["syear"],
+                eyear=config["eyear"],
+                to_daily=to_daily,
+                cache_dir=ANOM_CACHE + name.lower(),
+                **_bounds(config, box)
+            )
+        )
+
+    wt_ci = [PROC + "wt_k_{}.nc".format(k) for k in config["wtk"]]
+    wt_sig = PROC + "wt_significance.nc"
+    tasks += [
+        task(
+            "RAIN_RPY",
+            "make_time_series",
+            "make_subset",
+            inputs=[rain, _mk(config, "rpy_region")],
+            outputs=[PROC + "rain_rpy.nc"],
+            infile=rain,
+            outfile=PROC + "rain_rpy.nc",
+            region_list=[regions.box("box", *config["boxes"]["LPR"]["box"])],
+        ),
+        task(
+            "RAIN_REGIONS",
+            "make_regions",
+            "make_regions",
+            inputs=[rain, _mk(config, "rpy_region"), _mk(config, "wt_region")],
+            outputs=[PROC + "rain_regions.nc"],
+            infile=rain,
+            outfile=PROC + "rain_regions.nc",
+            region_list=[config["boxes"][name] for name in ["LPR", "WT"]],
+            mode="mean",
+        ),
+        task(
+            "PSI_WT",
+            "make_subset",
+            "make_subset",
+            inputs=[psi, _mk(config, "wt_region")],
+            outputs=[psi_wt],
+            infile=psi,
+            outfile=psi_wt,
+            **_bounds(config, "WT")
+        ),
+    ]
+    # all values of k share one PCA and one pool of workers, as in the Makefile
+    tasks += [
+        task(
+            "WT_CI",
+            "make_weather_type",
+            "main",
+            inputs=[psi_wt, _mk(config, "wtype2")],
+            outputs=wt_ci,
+            inline=True,
+            argv=_argv(
+                infile=psi_wt,
+                var_xpl=variables["VARXPL2"],
+                n_cluster=config["wtk"],
+                n_sim=variables["NSIM2"],
+                n_jobs=n_jobs,
+                outfile=PROC + "wt_k_{}.nc",
+            ),
+        ),
+        task(
+            "WT_SIG",
+            "make_wt_significance",
+            "main",
+            inputs=wt_ci + [psi_wt, _mk(config, "wtype2")],
+            outputs=[wt_sig],
+            inline=True,
+            argv=_argv(
+                infile=psi_wt,
+                var_xpl=variables["VARXPL2"],
+                n_cluster=config["wtk"],
+                n_sim=variables["NSIM2"],
+                n_surrogate=variables["NSURR"],
+                n_jobs=n_jobs,
+                wtfile=PROC + "wt_k_{}.nc",
+                checkpoint="data/interim/wt_significance.csv",
+                outfile=wt_sig,
+            ),
+        ),
+        task(
+            "WT",
+            "make_weather_type",
+            "main",
+            inputs=[psi_wt, _mk(config, "wtype")],
+            outputs=[wtype, wt_model, "tables/weather_type_centroid.tex"],
+            inline=True,
+            argv=_argv(
+                infile=psi_wt,
+                var_xpl=variables["VARXPL"],
+                n_cluster=variables["NCLUS"],
+                n_sim=variables["NSIM"],
+                n_jobs=n_jobs,
+                outfile=wtype,
+                table="tables/weather_type_centroid.tex",
+                model=wt_model,
+            ),
+        ),
+        task(
+            "RAIN_WT_COMP",
+            "make_composite",
+            "main",
+            inputs=[rain, wtype],
+            outputs=[PROC + "rain_wt_composite.nc"],
+            argv=_argv(
+                infile=rain,
+                catfile=wtype,
+                catvar="wtype",
+                lags=list(range(-5, 6)),
+                n_boot=500,
+                block=10,
+                outfile=PROC + "rain_wt_composite.nc",
+            ),
+        ),
+        task(
+            "DIPOLE",
+            "make_dipole",
+            "make_dipole",
+            inputs=[SST, _mk(config, "dipole_region")],
+            outputs=[PROC + "scad.nc"],
+            infile=SST,
+            outfile=PROC + "scad.nc",
+            region=config["boxes"]["SCAD"],
+            dim=variables.get("SCADDIM", "lat"),
+        ),
+    ]
+    targets["process"] = (
+        targets["PSI_RAW"]
+        + ["RAIN", "PSI", "UWND", "VWND", "RAIN_RPY", "RAIN_REGIONS", "PSI_WT"]
+        + ["WT_CI", "WT_SIG", "WT", "RAIN_WT_COMP", "DIPOLE"]
+    )
+    return tasks, targets
+
+
+def build_tasks(config_dir="config", n_jobs=4):
+    """The tasks of the Makefile and the targets grouping them
+
+    Returns:
+        an OrderedDict of tasks by name, and a dict of lists of task names
+        by target
+    """
+    config = read_config(config_dir)
+    tasks, targets = get_tasks(config)
+    more_tasks, more_targets = process_tasks(config, n_jobs=n_jobs)
+    targets.update(more_targets)
+    return OrderedDict((spec["name"], spec) for spec in tasks + more_tasks), targets
+
+
+def dependencies(tasks):
+    """The tasks each task depends on, through the files it reads
+    """
+    producer = {}
+    for name, spec in tasks.items():
+        for path in spec["outputs"]:
+            producer[os.path.normpath(path)] = name
+    return {
+        name: sorted(
+            set(
+                producer[os.path.normpath(path)]
+                for path in spec["inputs"]
+                if os.path.normpath(path) in producer
+            )
+        )
+        for name, spec in tasks.items()
+    }
+
+
+def select(tasks, targets, wanted):
+    """The names of the tasks needed for the wanted targets or tasks
+    """
+    deps = dependencies(tasks)
+    needed = set()
+    todo = []
+    for name in wanted:
+        if name in targets:
+            todo.extend(targets[name])
+        elif name in tasks:
+            todo.append(name)
+        else:
+            raise ValueError("no target or task called {}".format(name))
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(deps[name])
+    return [name for name in tasks if name in needed]
+
+
+class Hashes:
+    """Content hashes of files, reused while their size and mtime are unchanged
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache or {}
+
+    def file(self, path):
+        """The sha1 of the content of a file, or None if it does not exist
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = os.path.abspath(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        cached = self.cache.get(key)
+        if cached is not None and cached[:2] == stamp:
+            return cached[2]
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as fin:
+            for block in iter(lambda: fin.read(2 ** 20), b""):
+                sha1.update(block)
+        self.cache[key] = stamp + [sha1.hexdigest()]
+        return sha1.hexdigest()
+
+    def path(self, path):
+        """The hash of a file, or of the names and contents of a directory
+        """
+        if not os.path.isdir(path):
+            return self.file(path)
+        sha1 = hashlib.sha1()
+        for dirpath, dirnames, fnames in os.walk(path):
+            dirnames.sort()
+            for fname in sorted(fnames):
+                full = os.path.join(dirpath, fname)
+                sha1.update(os.path.relpath(full, path).encode("utf-8"))
+                sha1.update(self.file(full).encode("utf-8"))
+        return sha1.hexdigest()
+
+
+def _settings(kwargs):
+    """The arguments of a task without those that only change its speed
+    """
+    kwargs = {key: value for key, value in kwargs.items() if key != "n_jobs"}
+    if "argv" in kwargs:
+        argv = list(kwargs["argv"])
+        if "--n_jobs" in argv:
+            i = argv.index("--n_jobs")
+            del argv[i : i + 2]
+        kwargs["argv"] = argv
+    return kwargs
+
+
+def with_jobs(spec, n_jobs):
+    """A copy of a main task whose --n_jobs is replaced by n_jobs
+    """
+    argv = list(spec["kwargs"]["argv"])
+    if "--n_jobs" in argv:
+        argv[argv.index("--n_jobs") + 1] = str(n_jobs)
+    return dict(spec, kwargs=dict(spec["kwargs"], argv=argv))
+
+
+def task_key(spec, hashes):
+    """The hash of what a task does and of the content of its inputs
+
+    The number of workers is left out, so a run with another --n_jobs does
+    not redo anything.
+    """
+    text = json.dumps(
+        [
+            spec["module"],
+            spec["function"],
+            _settings(spec["kwargs"]),
+            [[path, hashes.path(path)] for path in spec["inputs"]],
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def up_to_date(spec, key, state, hashes):
+    """Whether a task ran with these inputs and its outputs are unchanged since
+    """
+    done = state["tasks"].get(spec["name"])
+    if done is None or done["key"] != key:
+        return False
+    return all(
+        os.path.exists(path) and hashes.path(path) == done["outputs"].get(path)
+        for path in spec["outputs"]
+    )
+
+
+def read_state(path):
+    """The saved task keys and file hashes
+    """
+    if os.path.isfile(path):
+        with open(path) as fjson:
+            return json.load(fjson)
+    return dict(tasks={}, files={})
+
+
+def write_state(path, state):
+    """Save the task keys and file hashes, atomically
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path + ".part", "w") as fjson:
+        json.dump(state, fjson, indent=1, sort_keys=True)
+    os.replace(path + ".part", path)
+
+
+def _warm(modules):
+    """Import the stage modules once per worker
+    """
+    sys.path[:0] = [path for path in STAGE_DIRS if path not in sys.path]
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass  # the tasks that need it will report the error
+
+
+def run_task(spec):
+    """Run one task and write the manifests of its outputs
+
+    Returns:
+        the name of the task
+    """
+    module = importlib.import_module(spec["module"])
+    started = time.time()
+    if spec["function"] == "main":
+        argv = list(spec["kwargs"]["argv"])
+    else:
+        argv = ["{}={}".format(*item) for item in sorted(spec["kwargs"].items())]
+    with instrument.phase("main"):
+        if spec["function"] == "main":
+            saved, sys.argv = sys.argv, [module.__file__] + argv
+            try:
+                module.main()
+            finally:
+                sys.argv = saved
+        else:
+            getattr(module, spec["function"])(**spec["kwargs"])
+    record = instrument.manifest(spec["module"] + ".py", argv, started)
+    instrument.collect()
+    instrument.write_manifests(record)
+    return spec["name"]
+
+
+def run(tasks, names, state_file, n_jobs=4, force=(), dry_run=False):
+    """Run the named tasks that are out of date, each once its inputs are made
+
+    With dry_run nothing is run; the tasks that are out of date, or that
+    depend on one that is, are listed instead.
+
+    Returns:
+        the names of the tasks that ran (or would run)
+    """
+    deps = dependencies(tasks)
+    state = read_state(state_file)
+    hashes = Hashes(state["files"])
+    waiting = list(names)
+    finished = set(name for name in tasks if name not in names)
+    running = {}
+    ran = []
+
+    def record(name):
+        spec = tasks[name]
+        state["tasks"][name] = dict(
+            key=task_key(spec, hashes),
+            outputs={path: hashes.path(path) for path in spec["outputs"]},
+        )
+
+    def adopt(name):
+        # downloads made before the pipeline ran are taken as they are
+        spec = tasks[name]
+        return (
+            not deps[name]
+            and name not in state["tasks"]
+            and all(os.path.exists(path) for path in spec["outputs"])
+        )
+
+    pool = None
+    if not dry_run:
+        pool = Pool(n_jobs, initializer=_warm, initargs=(STAGE_MODULES,))
+    try:
+        while waiting or running:
+            for name in [n for n in waiting if set(deps[n]) <= finished]:
+                waiting.remove(name)
+                spec = tasks[name]
+                key = task_key(spec, hashes)
+                stale = dry_run and any(dep in ran for dep in deps[name])
+                if name not in force and not stale and adopt(name):
+                    if not dry_run:
+                        record(name)
+                    finished.add(name)
+                elif (
+                    name not in force
+                    and not stale
+                    and up_to_date(spec, key, state, hashes)
+                ):
+                    finished.add(name)
+                elif dry_run:
+                    print(name)
+                    ran.append(name)
+                    finished.add(name)
+                elif spec["inline"]:
+                    # share the CPUs with the tasks still running on the pool
+                    share = max(1, n_jobs // (len(running) + 1))
+                    print("running {} (main process, {} jobs)".format(name, share))
+                    run_task(with_jobs(spec, share))
+                    record(name)
+                    ran.append(name)
+                    finished.add(name)
+                else:
+                    print("running {}".format(name))
+                    running[name] = pool.apply_async(run_task, (spec,))
+            for name, result in list(running.items()):
+                if result.ready():
+                    result.get()  # raise the task's error, if any
+                    del running[name]
+                    record(name)
+                    ran.append(name)
+                    finished.add(name)
+            if running:
+                time.sleep(0.1)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if not dry_run:
+            write_state(state_file, state)
+    return ran
+
+
+def main():
+    """Parse the command line arguments and run the targets.
+    """
+    args = parser.parse_args()
+    tasks, targets = build_tasks(n_jobs=args.n_jobs)
+    names = select(tasks, targets, args.targets)
+    ran = run(
+        tasks,
+        names,
+        args.state,
+        n_jobs=args.n_jobs,
+        force=args.force,
+        dry_run=args.dry_run,
+    )
+    if not ran:
+        print("everything is up to date")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Assign new days to the weather types of a saved model
+
+The model is the .npz file written by make_weather_type --model; nothing is
+fitted again, each day is projected onto the saved EOFs and given the
+weather type of the nearest centroid (see wtmodel). The anomalies must be
+computed against the same climatology as those the model was fitted on.
+"""
+
+import argparse
+import os
+from collections import OrderedDict
+import instrument
+import wtmodel
+from dataio import read_dataset, write_netcdf
+
+parser = argparse.ArgumentParser()  # pylint: disable=C0103
+parser.add_argument("--model", help="the model written by make_weather_type")
+parser.add_argument("--infile", help="the streamfunction anomalies to classify")
+parser.add_argument("--var", default="anomaly", help="the variable of infile")
+parser.add_argument("--outfile", help="the filename of the data to save")
+
+
+def assign_weather_type(model, infile, outfile, var="anomaly"):
+    """Classify every time step of infile and save the weather types
+    """
+    with instrument.phase("read"):
+        model_arrays = wtmodel.load(model)
+        anomaly = read_dataset(infile)[var].load()
+    with instrument.phase("assign"):
+        wtype = wtmodel.assign(model_arrays, anomaly)
+    wtype.attrs = OrderedDict(model=os.path.basename(model))
+    write_netcdf(wtype, outfile)
+
+
+def main():
+    """Parse the command line arguments and run assign_weather_type().
+    """
+    args = parser.parse_args()
+    assign_weather_type(
+        model=os.path.abspath(args.model),
+        infile=os.path.abspath(args.infile),
+        outfile=os.path.abspath(args.outfile),
+        var=args.var,
+    )
+
+
+if __name__ == "__main__":
+    instrument.run(main)
@@ -1,45 +1,297 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-"""Download a single year of 6-Hour Reanalysis V2 data from
-https://www.esrl.noaa.gov/psd/thredds/dodsC/Datasets/ncep.reanalysis2
+"""Calculate the 850 hPa streamfunction from the 6-Hour Reanalysis V2 winds
+
+Several years can be processed in one run: the spherical harmonic transform
+is set up once per worker process and reused for every year it handles, and
+each year is transformed a block of time steps at a time.
+
+With --daily 1 the winds are first averaged to daily and restricted to the
+NDJF season, as make_anomaly would do to the streamfunction afterwards. The
+streamfunction is linear in the wind, so this gives the same daily values
+from roughly twelve times fewer transforms; --check 1 verifies that.
 """
 
 import argparse
 import os
+from multiprocessing import Pool
 import xarray as xr
 import numpy as np
-from windspharm.xarray import VectorWind
+import instrument
+from dataio import write_netcdf
+from make_anomaly import daily_index, hourly_to_daily, select_season, split_days
+
+RSPHERE = 6.3712e6  # the earth radius used by windspharm
+CHUNK_SIZE = 240  # time steps transformed at once
 
 parser = argparse.ArgumentParser()  # pylint: disable=C0103
-parser.add_argument("--outfile", help="the filename of the data to save")
-parser.add_argument("--uwnd", help="path to zonal wind file")
-parser.add_argument("--vwnd", help="path to meridional wind file")
+parser.add_argument("--outfile", nargs="+", help="the filenames of the data to save")
+parser.add_argument("--uwnd", nargs="+", help="paths to zonal wind files")
+parser.add_argument("--vwnd", nargs="+", help="paths to meridional wind files")
+parser.add_argument(
+    "--n_jobs", type=int, default=1, help="years to process at the same time"
+)
+parser.add_argument(
+    "--chunk_size", type=int, default=CHUNK_SIZE, help="time steps per transform"
+)
+parser.add_argument(
+    "--daily", type=int, default=0, help="1 to average the winds to daily NDJF first"
+)
+parser.add_argument(
+    "--prev_uwnd", default=None, help="with --daily 1, the uwnd file of the year before"
+)
+parser.add_argument(
+    "--prev_vwnd", default=None, help="with --daily 1, the vwnd file of the year before"
+)
+parser.add_argument(
+    "--last",
+    type=int,
+    default=1,
+    help="with --daily 1, 0 if the year after the last file will follow",
+)
+parser.add_argument(
+    "--check",
+    type=int,
+    default=0,
+    help="1 to compare the daily-first result with the 6-hourly one for each year",
+)
 
+_TRANSFORMS = {}  # Spharmt instances of this process, by grid
 
-def calculate_streamfunction(uwnd, vwnd):
-    """Calculate the Streamfunction
+
+def get_transform(nlon, nlat, gridtype):
+    """The spherical harmonic transform for a grid, built on first use
+    """
+    key = (nlon, nlat, gridtype)
+    if key not in _TRANSFORMS:
+        from spharm import Spharmt  # pylint: disable=C0415
+
+        _TRANSFORMS[key] = Spharmt(
+            nlon, nlat, gridtype=gridtype, rsphere=RSPHERE, legfunc="stored"
+        )
+    return _TRANSFORMS[key]
+
+
+def _gridtype(lat):
+    """'regular' for equally spaced latitudes including the poles
+    """
+    dlat = np.diff(lat)
+    regular = np.allclose(dlat, dlat[0]) and np.isclose(abs(lat).max(), 90)
+    return "regular" if regular else "gaussian"
+
+
+def streamfunction(uwnd, vwnd, chunk_size=CHUNK_SIZE):
+    """Calculate the streamfunction of global wind fields
+
+    Gives the same result as windspharm's VectorWind(uwnd, vwnd).streamfunction()
+    (see benchmarks/check_streamfunction.py) but reuses the transform between
+    calls and only holds chunk_size time steps of the transform's work arrays
+    at once. The latitudes are returned in the order of the input.
+
+    Args:
+        uwnd, vwnd: DataArrays on the same global grid, with dimensions
+            time, lat and lon
+        chunk_size: the number of time steps to transform at once
     """
-    uwnd_ds = xr.open_dataarray(uwnd)
-    vwnd_ds = xr.open_dataarray(vwnd)
-    wind = VectorWind(uwnd_ds, vwnd_ds)
-    psi = wind.streamfunction()
+    south_first = uwnd["lat"].values[0] < uwnd["lat"].values[-1]
+    if south_first:
+        # spharm wants latitudes from north to south
+        uwnd = uwnd.isel(lat=slice(None, None, -1))
+        vwnd = vwnd.isel(lat=slice(None, None, -1))
+    uwnd = uwnd.transpose("time", "lat", "lon")
+    vwnd = vwnd.transpose("time", "lat", "lon")
+    transform = get_transform(
+        uwnd.sizes["lon"], uwnd.sizes["lat"], _gridtype(uwnd["lat"].values)
+    )
+    psi = np.empty(uwnd.shape, dtype=np.result_type(uwnd.dtype, np.float32))
+    for i0 in range(0, uwnd.sizes["time"], chunk_size):
+        block = slice(i0, i0 + chunk_size)
+        # spharm works on (lat, lon, time) arrays
+        u_block = np.moveaxis(uwnd.isel(time=block).values, 0, -1)
+        v_block = np.moveaxis(vwnd.isel(time=block).values, 0, -1)
+        psi_block, _ = transform.getpsichi(u_block, v_block)
+        psi[block] = np.moveaxis(psi_block, -1, 0)
+    psi = xr.DataArray(
+        psi,
+        dims=uwnd.dims,
+        coords={d: uwnd[d] for d in uwnd.dims},
+        name="stream",
+        attrs=dict(
+            standard_name="atmosphere_horizontal_streamfunction",
+            long_name="streamfunction",
+            units="m2 s-1",
+        ),
+    )
+    if south_first:
+        psi = psi.isel(lat=slice(None, None, -1))
     return psi
 
 
+def calculate_streamfunction(uwnd, vwnd, chunk_size=CHUNK_SIZE):
+    """Calculate the Streamfunction
+    """
+    with xr.open_dataarray(uwnd) as uwnd_ds, xr.open_dataarray(vwnd) as vwnd_ds:
+        return streamfunction(uwnd_ds, vwnd_ds, chunk_size=chunk_size)
+
+
+def read_last_day(path, offset=12):
+    """The time steps of the last (possibly incomplete) day of a file
+    """
+    with xr.open_dataarray(path) as wind:
+        day = daily_index(wind["time"].values, offset=offset)
+        return wind.isel(time=np.where(day == day.max())[0]).load()
+
+
+def daily_wind(path, prev_path=None, last=True, offset=12):
+    """Average one file of winds to daily and keep the NDJF days
+
+    Days are split between files as in make_anomaly: the last day of the
+    previous file is completed with the first steps of this one, and this
+    file's own last day is left to the next file unless last is True.
+    """
+    carry = None if prev_path is None else read_last_day(prev_path, offset=offset)
+    with xr.open_dataarray(path) as wind:
+        daily, carry = split_days(wind.load(), carry=carry, offset=offset)
+    if last:
+        tail = hourly_to_daily(carry, offset=offset)
+        daily = tail if daily is None else xr.concat([daily, tail], dim="time")
+    return select_season(daily)
+
+
+def check_daily_first(uwnd, vwnd, chunk_size=CHUNK_SIZE, offset=12):
+    """Compare the two orders of operations on one pair of wind files
+
+    Returns:
+        the largest difference between the daily NDJF means of the 6-hourly
+        streamfunction and the streamfunction of the daily NDJF mean winds,
+        relative to the largest absolute value of the former
+    """
+    with xr.open_dataarray(uwnd) as uwnd_ds, xr.open_dataarray(vwnd) as vwnd_ds:
+        uwnd_ds = uwnd_ds.load()
+        vwnd_ds = vwnd_ds.load()
+    psi = streamfunction(uwnd_ds, vwnd_ds, chunk_size=chunk_size)
+    expected = select_season(hourly_to_daily(psi, offset=offset))
+    actual = streamfunction(
+        select_season(hourly_to_daily(uwnd_ds, offset=offset)),
+        select_season(hourly_to_daily(vwnd_ds, offset=offset)),
+        chunk_size=chunk_size,
+    )
+    diff = abs(actual - expected.transpose(*actual.dims)).max()
+    return float(diff / abs(expected).max())
+
+
+def process_year(
+    uwnd,
+    vwnd,
+    outfile,
+    prev_uwnd=None,
+    prev_vwnd=None,
+    last=True,
+    chunk_size=CHUNK_SIZE,
+    daily=False,
+):
+    """Calculate and save the streamfunction of one pair of wind files
+
+    With daily, prev_uwnd and prev_vwnd are the files of the year before
+    (None for the first year), whose last day is completed with this one,
+    and last says whether this is the last year (see daily_wind).
+    """
+    if daily:
+        with instrument.phase("read"):
+            uwnd = daily_wind(uwnd, prev_path=prev_uwnd, last=last)
+            vwnd = daily_wind(vwnd, prev_path=prev_vwnd, last=last)
+        with instrument.phase("transform"):
+            psi = streamfunction(uwnd, vwnd, chunk_size=chunk_size)
+    else:
+        with instrument.phase("transform"):
+            psi = calculate_streamfunction(uwnd, vwnd, chunk_size=chunk_size)
+    write_netcdf(psi, outfile, layout="map")
+
+
+def _process_year(task):
+    """Run process_year in a worker
+
+    Returns:
+        the instrument records of the task, see instrument.collect
+    """
+    process_year(**task)
+    return instrument.collect()
+
+
+def calculate_batch(
+    uwnd,
+    vwnd,
+    outfile,
+    n_jobs=1,
+    chunk_size=CHUNK_SIZE,
+    daily=False,
+    prev_uwnd=None,
+    prev_vwnd=None,
+    last=True,
+):
+    """Calculate the streamfunction for many pairs of wind files
+
+    Args:
+        uwnd, vwnd, outfile: lists of equal length of the paths of the zonal
+            and meridional wind files and of the output files, in time order
+        n_jobs: the number of worker processes
+        chunk_size: the number of time steps to transform at once
+        daily: if True, save the streamfunction of the daily NDJF mean winds.
+            Each task reads the last day of the previous year's files, so
+            the years can still be processed in any order.
+        prev_uwnd, prev_vwnd: with daily, the files of the year before the
+            first, if any, so that one year can be processed on its own
+        last: with daily, False if the year after the last one will be
+            processed too, which then completes the last day
+    """
+    if not len(uwnd) == len(vwnd) == len(outfile):
+        raise ValueError("need one uwnd, vwnd and outfile per year")
+    prev_uwnd = [prev_uwnd] + list(uwnd[:-1])
+    prev_vwnd = [prev_vwnd] + list(vwnd[:-1])
+    tasks = [
+        dict(
+            uwnd=uwnd[i],
+            vwnd=vwnd[i],
+            prev_uwnd=prev_uwnd[i],
+            prev_vwnd=prev_vwnd[i],
+            last=last and i == len(uwnd) - 1,
+            outfile=outfile[i],
+            chunk_size=chunk_size,
+            daily=daily,
+        )
+        for i in range(len(uwnd))
+    ]
+    if n_jobs == 1 or len(tasks) == 1:
+        results = [_process_year(task) for task in tasks]
+    else:
+        with Pool(min(n_jobs, len(tasks))) as pool:
+            results = pool.map(_process_year, tasks, chunksize=1)
+    for records in results:
+        instrument.merge(records)
+
+
 def main():
     """Run everything
     """
     args = parser.parse_args()
-    uwnd = os.path.abspath(args.uwnd)
-    vwnd = os.path.abspath(args.vwnd)
-    outfile = os.path.abspath(args.outfile)
-    psi = calculate_streamfunction(uwnd, vwnd)
-
-    if os.path.isfile(outfile):
-        os.remove(outfile)
-
-    psi.to_netcdf(outfile, format="NETCDF4", mode="w")
+    uwnd = [os.path.abspath(fname) for fname in args.uwnd]
+    vwnd = [os.path.abspath(fname) for fname in args.vwnd]
+    if args.check:
+        for uwnd_file, vwnd_file in zip(uwnd, vwnd):
+            rel_diff = check_daily_first(uwnd_file, vwnd_file, args.chunk_size)
+            print("{}: relative difference {:.2e}".format(uwnd_file, rel_diff))
+    calculate_batch(
+        uwnd=uwnd,
+        vwnd=vwnd,
+        outfile=[os.path.abspath(fname) for fname in args.outfile],
+        n_jobs=args.n_jobs,
+        chunk_size=args.chunk_size,
+        daily=bool(args.daily),
+        prev_uwnd=None if args.prev_uwnd is None else os.path.abspath(args.prev_uwnd),
+        prev_vwnd=None if args.prev_vwnd is None else os.path.abspath(args.prev_vwnd),
+        last=bool(args.last),
+    )
 
 
 if __name__ == "__main__":
-    main()
+    instrument.run(main)
@@ -4,12 +4,21 @@
 """
 
 import argparse
+import hashlib
+import json
 import os
+import re
+import shutil
+import tempfile
 from glob import glob
 import calendar
+from collections import OrderedDict
 import xarray as xr
 import numpy as np
 import pandas as pd
+import dataio
+import instrument
+from dataio import write_netcdf
 
 parser = argparse.ArgumentParser()  # pylint: disable=C0103
 parser.add_argument("--outfile", help="the filename of the data to save")
@@ -21,89 +30,366 @@ parser.add_argument("--X0", type=float)
 parser.add_argument("--X1", type=float)
 parser.add_argument("--Y0", type=float)
 parser.add_argument("--Y1", type=float)
+parser.add_argument(
+    "--cache_dir", help="keep per-file intermediate results here between runs"
+)
+parser.add_argument(
+    "--pack", type=int, default=0, help="1 to pack the output into int16 (lossy)"
+)
 
+# the files cache_pieces writes, and so the only ones it may delete
+PIECE_NAME = re.compile(r"^anomaly_piece_[0-9a-f]{16}(\.carry|\.last)?\.nc$")
 
-def read_netcdfs(files, dim, transform_func=None):
-    """From http://xarray.pydata.org/en/stable/io.html#netcdf
+
+def subset_region(ds, lonmin, lonmax, latmin, latmax):
+    """Put longitudes on -180 to 180, sort, and subset geographically
     """
+    # Step 1: Adjust Longitudes
+    longitudes = ds["lon"].values.copy()
+    longitudes[np.where(longitudes > 180)] -= 360
+    ds = ds.assign_coords(lon=longitudes)
 
-    def process_one_path(path):
-        """Helper
-        """
-        with xr.open_dataset(path) as ds:
-            if transform_func is not None:
-                ds = transform_func(ds)
-            ds.load()
-            return ds
+    # Step 2: Sort
+    sub = ds.sortby("lon").sortby("lat").sortby("time")
 
-    paths = sorted(glob(files))
-    datasets = [process_one_path(p) for p in paths]
-    combined = xr.concat(datasets, dim)
-    return combined
+    # Step 3: sub-set
+    sub = sub.sel(lon=slice(lonmin, lonmax), lat=slice(latmin, latmax))
+    return sub
 
 
-def hourly_to_daily(hourly, offset=12):
-    """Convert data to daily time step
+def split_days(sub, carry=None, offset=12):
+    """Average the complete days of sub, carrying over its last day
+
+    The last day of a file may continue into the next file (each step is
+    shifted by offset hours), so its time steps are returned as the carry for
+    the next file rather than averaged early.
+
+    Returns:
+        daily: the daily averages of the complete days, or None
+        carry: the time steps of the last, possibly incomplete, day
     """
-    old_time = pd.to_datetime(hourly["time"].values)
-    new_time = old_time + pd.DateOffset(hours=offset)
-    new_time = new_time.date
-    hourly["time"] = new_time
-    daily = hourly.groupby("time").mean(dim="time")
-    daily["time"] = pd.to_datetime(daily.time.values)
-    return daily
+    if carry is not None:
+        sub = xr.concat([carry, sub], dim="time")
+    day = daily_index(sub["time"].values, offset=offset)
+    complete = day < day.max()
+    carry = sub.isel(time=np.where(~complete)[0])
+    daily = None
+    if complete.any():
+        daily = hourly_to_daily(sub.isel(time=np.where(complete)[0]), offset=offset)
+    return daily, carry
 
 
-def calc_anomaly(
-    path, outfile, syear, eyear, lonmin, lonmax, latmin, latmax, to_daily=0
+def read_subset(path, lonmin, lonmax, latmin, latmax):
+    """Read the geographical subset of the first variable of a file
+    """
+    with xr.open_dataset(path) as ds:
+        varname = list(ds.data_vars.keys())[0]
+        return subset_region(ds, lonmin, lonmax, latmin, latmax)[varname].load()
+
+
+def iter_subsets(paths, lonmin, lonmax, latmin, latmax, to_daily=0, offset=12):
+    """Read the files one at a time, yielding each one's (daily) subset
+
+    Only one file is held in memory at once. When converting to daily, days
+    that straddle two files are carried over (see split_days), so the daily
+    values are the same as if all files were combined first.
+    """
+    carry = None
+    for path in paths:
+        sub = read_subset(path, lonmin, lonmax, latmin, latmax)
+        if not to_daily:
+            yield sub
+            continue
+        daily, carry = split_days(sub, carry=carry, offset=offset)
+        if daily is not None:
+            yield daily
+    if carry is not None:
+        yield hourly_to_daily(carry, offset=offset)
+
+
+def select_season(raw, sdate=None, edate=None):
+    """Keep only NDJF days between sdate and edate
+    """
+    raw = raw.sel(time=np.isin(raw["time.month"], np.array([11, 12, 1, 2])))
+    return raw.sel(time=slice(sdate, edate))
+
+
+def _piece_key(path, prev_key, params):
+    """Identify a file's cached piece by the file, the settings, and the
+    key of the previous file (whose last day is carried into this one)
+    """
+    stat = os.stat(path)
+    text = json.dumps(
+        [os.path.abspath(path), stat.st_size, stat.st_mtime_ns, prev_key, params],
+        sort_keys=True,
+    )
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def _piece_path(cache_dir, key, kind=""):
+    """The path of a cached piece (kind "") or of its carry or last day
+    """
+    return os.path.join(cache_dir, "anomaly_piece_{}{}.nc".format(key, kind))
+
+
+def _write_piece(raw, piece):
+    """Save one file's NDJF days together with their sum and count
+    """
+    raw = select_season(raw)
+    stats = xr.Dataset(
+        {
+            "raw": raw,
+            "sum": raw.astype("float64").sum(dim="time"),
+            "count": raw.notnull().sum(dim="time"),
+        }
+    )
+    write_netcdf(stats, piece)
+
+
+def cache_pieces(
+    paths, cache_dir, lonmin, lonmax, latmin, latmax, to_daily=0, offset=12
 ):
-    """Decompose into anomaly and subset geographically
+    """Subset each file, convert it to daily, and cache the NDJF days
+
+    Each file gets a piece in cache_dir holding its NDJF days with their sum
+    and count. Pieces no longer used are deleted, but no other file of
+    cache_dir is touched. Pieces whose file and settings are unchanged are reused
+    without reading the file, so appending a year only reads that year.
+    The trailing steps of each file's last day are cached too, so that the
+    next file can be processed without re-reading its predecessor.
+
+    Returns:
+        the paths of the pieces, in time order
     """
+    params = dict(
+        lonmin=lonmin,
+        lonmax=lonmax,
+        latmin=latmin,
+        latmax=latmax,
+        to_daily=int(bool(to_daily)),
+        offset=offset,
+    )
+    pieces = []
+    carry_files = []
+    key = ""
+    carry = None
+    carry_file = None
+    for path in paths:
+        key = _piece_key(path, key, params)
+        piece = _piece_path(cache_dir, key)
+        if os.path.isfile(piece):
+            carry = None
+            carry_file = _piece_path(cache_dir, key, ".carry")
+            carry_files.append(carry_file)
+            pieces.append(piece)
+            continue
+
+        sub = read_subset(path, lonmin, lonmax, latmin, latmax)
+        if to_daily:
+            if carry is None and carry_file is not None:
+                carry = xr.open_dataarray(carry_file).load()
+            sub, carry = split_days(sub, carry=carry, offset=offset)
+            carry_file = _piece_path(cache_dir, key, ".carry")
+            carry_files.append(carry_file)
+            write_netcdf(carry, carry_file)
+        if sub is not None:
+            _write_piece(sub, piece)
+            pieces.append(piece)
+
+    # the last day of the last file has nowhere else to go
+    if to_daily and paths:
+        if carry is None and carry_file is not None:
+            carry = xr.open_dataarray(carry_file).load()
+        piece = _piece_path(cache_dir, key, ".last")
+        if not os.path.isfile(piece):
+            _write_piece(hourly_to_daily(carry, offset=offset), piece)
+        pieces.append(piece)
 
-    # Read in the data
-    def subset_function(ds):
-        # Step 1: Adjust Longitudes
-        longitudes = ds["lon"].values
-        longitudes[np.where(longitudes > 180)] -= 360
-        ds["lon"].values = longitudes
+    # forget pieces that no longer belong to any file, leaving other files be
+    keep = set(os.path.basename(p) for p in pieces)
+    keep.update(os.path.basename(p) for p in carry_files)
+    for fname in os.listdir(cache_dir):
+        if PIECE_NAME.match(fname) and fname not in keep:
+            os.remove(os.path.join(cache_dir, fname))
+    return pieces
 
-        # Step 2: Sort
-        sub = ds.sortby("lon").sortby("lat").sortby("time")
 
-        # Step 3: sub-set
-        sub = sub.sel(lon=slice(lonmin, lonmax), lat=slice(latmin, latmax))
+def daily_index(time, offset=12):
+    """The day to which each time step belongs, once shifted by offset hours
+    """
+    time = np.asarray(time, dtype="datetime64[ns]")
+    return (time + np.timedelta64(offset, "h")).astype("datetime64[D]")
+
 
-        return sub
+def hourly_to_daily(hourly, offset=12):
+    """Convert data to daily time step
 
-    raw = read_netcdfs(path, dim="time", transform_func=subset_function)
-    varname = list(raw.data_vars.keys())[0]
-    raw = raw[varname]
+    Each time step is shifted by offset hours and assigned to the resulting
+    date, and the non-missing values of each date are averaged. Everything is
+    done on datetime64 and integer indices: with a regular cadence (the same
+    number of steps every day) the data are reshaped to (day, step, ...),
+    otherwise each day's contiguous segment is summed with reduceat.
+    """
+    day = daily_index(hourly["time"].values, offset=offset)
+    order = np.argsort(day, kind="mergesort")
+    day = day[order]
+    days, start, counts = np.unique(day, return_index=True, return_counts=True)
+
+    axis = hourly.get_axis_num("time")
+    values = np.moveaxis(hourly.values, axis, 0)[order]
+    if not np.issubdtype(values.dtype, np.floating):
+        values = values.astype("float64")
+    valid = ~np.isnan(values)
+    values = np.where(valid, values, 0)
+    if np.all(counts == counts[0]):
+        shape = (days.size, counts[0]) + values.shape[1:]
+        total = values.reshape(shape).sum(axis=1)
+        count = valid.reshape(shape).sum(axis=1)
+    else:
+        total = np.add.reduceat(values, start, axis=0)
+        count = np.add.reduceat(valid, start, axis=0, dtype=np.int64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = (total / count).astype(values.dtype)
+
+    coords = OrderedDict(
+        (name, coord)
+        for name, coord in hourly.coords.items()
+        if "time" not in coord.dims
+    )
+    coords["time"] = days.astype("datetime64[ns]")
+    daily = xr.DataArray(
+        np.moveaxis(mean, 0, axis), dims=hourly.dims, coords=coords, name=hourly.name
+    )
+    return daily
 
-    # Convert to daily data?
-    if to_daily is 1:
-        raw = hourly_to_daily(raw)
 
-    year = raw["time.year"]
-    month = raw["time.month"]
-    year_adj = year
-    year_adj[np.in1d(month, [11, 12])] += 1
-    raw.coords["year_adj"] = year_adj
+def write_anomaly(combined, outfile, pack=False):
+    """Save the raw data and anomalies to a NetCDF file or a Zarr group
 
-    # Sub-set by date
-    raw = raw.sel(time=np.in1d(raw["time.month"], np.array([11, 12, 1, 2])))
+    If outfile is a group of a Zarr store that already holds the start of
+    the same record, the new days are appended to it in place. Of the earlier
+    days only the anomalies, which change with the climatology, and the last
+    day, which may have been incomplete, are rewritten.
+    """
+    store, _ = dataio.split_store(outfile)
+    if store is not None and dataio.exists(outfile):
+        with dataio.read_dataset(outfile) as existing:
+            n_old = existing.sizes["time"]
+            extends = (
+                n_old <= combined.sizes["time"]
+                and np.array_equal(existing["time"], combined["time"][:n_old])
+                and np.array_equal(existing["lon"], combined["lon"])
+                and np.array_equal(existing["lat"], combined["lat"])
+            )
+        if extends:
+            dataio.append_zarr(combined, outfile, dim="time")
+            dataio.update_zarr(
+                combined[["anomaly"]].isel(time=slice(0, n_old)),
+                outfile,
+                region={"time": slice(0, n_old)},
+            )
+            dataio.update_zarr(
+                combined.isel(time=slice(n_old - 1, n_old)).load(),
+                outfile,
+                region={"time": slice(n_old - 1, n_old)},
+            )
+            return
+    dataio.write_dataset(combined, outfile, layout="time", pack=pack)
+
+
+def calc_anomaly(
+    path,
+    outfile,
+    syear,
+    eyear,
+    lonmin,
+    lonmax,
+    latmin,
+    latmax,
+    to_daily=0,
+    cache_dir=None,
+    pack=False,
+):
+    """Decompose into anomaly and subset geographically
+
+    The files are streamed one at a time: each one is subset, converted to
+    daily and restricted to the season, and set aside on disk along with its
+    sum and count (see cache_pieces). The climatology is built from those
+    sums, and the anomalies are written from the pieces through dask, so that
+    peak memory is bounded by about one file rather than by the whole record.
+
+    If cache_dir is given the pieces are kept there between runs and only
+    new or modified files are read again; otherwise they are discarded. The
+    output is chunked for reading time series, and packed into int16 if pack.
+    """
     sdate = pd.Timestamp("{}-11-01".format(syear))
     if calendar.isleap(eyear):
         edate = pd.Timestamp("{}-02-29".format(eyear))
     else:
         edate = pd.Timestamp("{}-02-28".format(eyear))
-    raw = raw.sel(time=slice(sdate, edate)).load()
 
-    # Get the data set
-    anomaly = raw - raw.mean(dim="time")
-    combined = xr.Dataset({"raw": raw, "anomaly": anomaly})
-    if os.path.isfile(outfile):
-        os.remove(outfile)
-    combined.to_netcdf(outfile, format="NETCDF4")
+    if cache_dir is None:
+        # next to outfile, or to its store, never inside a Zarr store
+        store, _ = dataio.split_store(os.path.abspath(outfile))
+        outdir = os.path.dirname(store or os.path.abspath(outfile))
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        tmpdir = tempfile.mkdtemp(dir=outdir, prefix=".anomaly_")
+    else:
+        tmpdir = None
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+    try:
+        with instrument.phase("read"):
+            pieces = cache_pieces(
+                sorted(glob(path)),
+                cache_dir=tmpdir or cache_dir,
+                lonmin=lonmin,
+                lonmax=lonmax,
+                latmin=latmin,
+                latmax=latmax,
+                to_daily=to_daily,
+            )
+        instrument.drop_outputs(tmpdir or cache_dir)
+
+        # add up the cached sums, except for pieces cut by sdate or edate
+        used = []
+        total = None
+        count = None
+        with instrument.phase("climatology"):
+            for piece in pieces:
+                with xr.open_dataset(piece) as stats:
+                    time = stats["time"].values
+                    if time.size == 0 or time[0] > edate or time[-1] < sdate:
+                        continue
+                    if time[0] >= sdate and time[-1] <= edate:
+                        piece_sum = stats["sum"].load()
+                        piece_count = stats["count"].load()
+                    else:
+                        raw = select_season(stats["raw"], sdate, edate).load()
+                        piece_sum = raw.astype("float64").sum(dim="time")
+                        piece_count = raw.notnull().sum(dim="time")
+                total = piece_sum if total is None else total + piece_sum
+                count = piece_count if count is None else count + piece_count
+                used.append(piece)
+        if not used:
+            raise ValueError("no data between {} and {}".format(sdate, edate))
+
+        with xr.open_mfdataset(used, preprocess=lambda ds: ds[["raw"]]) as pieced:
+            raw = select_season(pieced["raw"], sdate, edate)
+            climatology = (total / count).astype(raw.dtype)
+
+            year_adj = raw["time.year"].copy()
+            year_adj[np.isin(raw["time.month"], [11, 12])] += 1
+            raw.coords["year_adj"] = year_adj
+
+            # Get the data set
+            anomaly = raw - climatology
+            combined = xr.Dataset({"raw": raw, "anomaly": anomaly})
+            write_anomaly(combined, outfile, pack=pack)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
 
 
 def main():
@@ -120,8 +406,10 @@ def main():
         latmin=args.Y0,
         latmax=args.Y1,
         to_daily=args.to_daily,
+        cache_dir=args.cache_dir,
+        pack=bool(args.pack),
     )
 
 
 if __name__ == "__main__":
-    main()
+    instrument.run(main)
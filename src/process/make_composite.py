@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Composite anomalies by category (weather type, MJO phase, ENSO state) and lag
+
+The composite of category k at lag L is the mean anomaly L days after the
+days in category k. All categories and lags are computed together: a sparse
+one-hot matrix with one row per (category, lag) and one column per day
+selects and sums the anomalies in a single matrix product.
+
+Significance comes from a circular block bootstrap of the category series,
+which keeps its persistence: many resampled series are stacked into one
+sparse matrix, so each batch of resamples costs one more matrix product.
+"""
+
+import argparse
+import os
+import numpy as np
+import xarray as xr
+import instrument
+from dataio import read_dataset, write_netcdf
+
+parser = argparse.ArgumentParser()  # pylint: disable=C0103
+parser.add_argument("--infile", help="the anomaly data")
+parser.add_argument("--var", default="anomaly", help="the variable to composite")
+parser.add_argument("--catfile", help="the file holding the category series")
+parser.add_argument("--catvar", help="the category variable, e.g. wtype or phase")
+parser.add_argument(
+    "--bins", type=float, nargs="+", help="bin a continuous series at these values"
+)
+parser.add_argument(
+    "--min_amplitude", type=float, help="drop days whose amplitude is below this"
+)
+parser.add_argument(
+    "--missing",
+    type=float,
+    nargs="*",
+    default=[999],
+    help="category values meaning missing (999 is the missing MJO phase)",
+)
+parser.add_argument("--lags", type=int, nargs="+", default=[0], help="lags in days")
+parser.add_argument("--n_boot", type=int, default=0, help="bootstrap resamples")
+parser.add_argument("--block", type=int, default=10, help="bootstrap block in days")
+parser.add_argument("--batch", type=int, default=50, help="resamples per batch")
+parser.add_argument("--seed", type=int, default=1085, help="random seed")
+parser.add_argument("--outfile", help="the filename of the data to save")
+
+def align_categories(categories, time, bins=None, tolerance=31):
+    """The category of each day of time
+
+    A coarser series (e.g. monthly NINO 3.4) is carried forward to every day
+    until the next value, for at most tolerance days. A continuous series is
+    binned with bins. A series along a
+    single dimension of another name (such as the "index" that some pandas
+    versions leave on files written from a Series) is taken to be along time.
+
+    Returns:
+        the integer category of each day, and whether the day has one; any
+        value, negative ones included, is a category
+    """
+    if "time" not in categories.dims and categories.ndim == 1:
+        categories = categories.rename({categories.dims[0]: "time"})
+    categories = categories.sortby("time").reindex(
+        time=time, method="ffill", tolerance=np.timedelta64(tolerance, "D")
+    )
+    values = categories.values
+    valid = ~np.isnan(values.astype("float64"))
+    if bins is not None:
+        values = np.digitize(values, bins)
+    codes = np.zeros(values.shape, dtype="int64")
+    codes[valid] = values[valid].astype("int64")
+    return codes, valid
+
+
+def lag_index(time, lags):
+    """For each lag and day, the index of the day lag days later, or -1
+    """
+    time = np.asarray(time, dtype="datetime64[D]")
+    index = np.full((len(lags), time.size), -1, dtype="int64")
+    for i, lag in enumerate(lags):
+        target = time + np.timedelta64(lag, "D")
+        pos = np.searchsorted(time, target)
+        found = pos < time.size
+        found[found] = time[pos[found]] == target[found]
+        index[i, found] = pos[found]
+    return index
+
+
+def selector(cat, n_label, lagged):
+    """The sparse one-hot matrix of (resample, category, lag) by day
+
+    Args:
+        cat: (n_resample, n_day) position of the category of each day among
+            the categories composited, -1 for days in none
+        n_label: the number of categories composited
+        lagged: (n_lag, n_day) output of lag_index
+    """
+    from scipy import sparse  # pylint: disable=C0415
+
+    n_sample, n_day = cat.shape
+    n_lag = lagged.shape[0]
+    rows = (
+        (np.arange(n_sample)[:, None, None] * n_label + cat[:, None, :]) * n_lag
+        + np.arange(n_lag)[None, :, None]
+    )
+    cols = np.broadcast_to(lagged[None, :, :], rows.shape)
+    keep = (np.broadcast_to(cat[:, None, :], rows.shape) >= 0) & (cols >= 0)
+    return sparse.csr_matrix(
+        (np.ones(keep.sum()), (rows[keep], cols[keep])),
+        shape=(n_sample * n_label * n_lag, n_day),
+    )
+
+
+def _composite(matrix, values, valid):
+    """Means of the rows of values selected by each row of a sparse matrix
+    """
+    total = matrix.dot(values)
+    count = matrix.dot(valid)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return total / count, count
+
+
+def block_resample(codes, n_boot, block, rng):
+    """n_boot circular block bootstrap resamples of a category series
+    """
+    n_day = codes.size
+    n_block = -(-n_day // block)
+    starts = rng.randint(0, n_day, size=(n_boot, n_block))
+    index = (starts[:, :, None] + np.arange(block)) % n_day
+    return codes[index.reshape((n_boot, -1))[:, :n_day]]
+
+
+def composite(data, codes, valid, lags, n_boot=0, block=10, batch=50, seed=1085):
+    """Composite data by category and lag, with bootstrap p-values
+
+    Args:
+        data: a DataArray with a daily time dimension
+        codes, valid: the category of each day of data and whether it has
+            one (see align_categories)
+        lags: the lags, in days
+        n_boot: the number of bootstrap resamples, 0 for no p-values
+        block: the bootstrap block length, in days
+        batch: the number of resamples handled at once
+        seed: the random seed of the bootstrap
+    Returns:
+        a Dataset of the composites, the number of days in each, and (if
+        n_boot) the two-sided p-value of each composite, out of the resamples
+        whose composite is defined
+    """
+    labels = np.unique(codes[valid])
+    cat = np.where(valid, np.searchsorted(labels, codes), -1)
+    lagged = lag_index(data["time"].values, lags)
+    other = [dim for dim in data.dims if dim != "time"]
+    values = data.transpose("time", *other).values.reshape((data.sizes["time"], -1))
+    finite = ~np.isnan(values)
+    values = np.where(finite, values, 0)
+    finite = finite.astype("float64")
+
+    shape = (len(labels), len(lags))
+    mean, count = _composite(
+        selector(cat[None, :], len(labels), lagged), values, finite
+    )
+
+    out_shape = shape + tuple(data.sizes[dim] for dim in other)
+    coords = dict(category=labels, lag=np.asarray(lags))
+    coords.update({dim: data[dim] for dim in other})
+    dims = ["category", "lag"] + other
+    result = xr.Dataset(
+        {
+            "composite": (dims, mean.reshape(out_shape).astype(data.dtype)),
+            "count": (dims, count.reshape(out_shape).astype("int64")),
+        },
+        coords=coords,
+    )
+
+    if n_boot > 0:
+        rng = np.random.RandomState(seed)
+        exceed = np.zeros(mean.shape)
+        n_draw = np.zeros(mean.shape)  # resamples with a defined composite
+        for i0 in range(0, n_boot, batch):
+            resampled = block_resample(cat, min(batch, n_boot - i0), block, rng)
+            matrix = selector(resampled, len(labels), lagged)
+            null, _ = _composite(matrix, values, finite)
+            null = null.reshape((-1,) + mean.shape)
+            exceed += (np.abs(null) >= np.abs(mean)).sum(axis=0)
+            n_draw += np.isfinite(null).sum(axis=0)
+        p_value = np.where(np.isnan(mean), np.nan, (exceed + 1) / (n_draw + 1))
+        result["p_value"] = (dims, p_value.reshape(out_shape))
+        result.attrs.update(n_boot=n_boot, block=block, seed=seed)
+    return result
+
+
+def main():
+    """Parse the command line arguments and run composite().
+    """
+    args = parser.parse_args()
+    with instrument.phase("read"):
+        data = read_dataset(os.path.abspath(args.infile))[args.var].load()
+        with xr.open_dataset(os.path.abspath(args.catfile)) as catfile:
+            categories = catfile[args.catvar].load()
+            categories = categories.where(~categories.isin(args.missing))
+            if args.min_amplitude is not None:
+                strong = catfile["amplitude"] >= args.min_amplitude
+                categories = categories.where(strong)
+    codes, valid = align_categories(categories, data["time"].values, bins=args.bins)
+    with instrument.phase("composite"):
+        result = composite(
+            data,
+            codes,
+            valid,
+            lags=args.lags,
+            n_boot=args.n_boot,
+            block=args.block,
+            batch=args.batch,
+            seed=args.seed,
+        )
+    write_netcdf(result, os.path.abspath(args.outfile))
+
+
+if __name__ == "__main__":
+    instrument.run(main)
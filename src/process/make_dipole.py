@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """Area-averaged gradient
+
+The box and the direction of the gradient are given either on the command
+line or, with --config and --index, by the PX0, PX1, PY0, PY1 and PDIM
+variables of a config file (e.g. SCADX0 ... SCADDIM for the dipole).
 """
 
 import argparse
 import os
-import xarray as xr
-import numpy as np
+import gradient
+import instrument
+import mkconfig
+import regions
+from dataio import read_dataset, write_netcdf
 
 parser = argparse.ArgumentParser()  # pylint: disable=C0103
 parser.add_argument("--outfile", help="the filename of the data to save")
@@ -15,19 +22,49 @@ parser.add_argument("--X0", type=float, help="lon min")
 parser.add_argument("--X1", type=float, help="lon max")
 parser.add_argument("--Y0", type=float, help="lat min")
 parser.add_argument("--Y1", type=float, help="lat max")
+parser.add_argument("--dim", default="lat", help="differentiate along lat or lon")
+parser.add_argument("--config", nargs="+", help="the .mk files defining the index")
+parser.add_argument("--index", help="the name of the index in the config files")
+parser.add_argument(
+    "--chunk_size", type=int, default=120, help="time steps read at once"
+)
+
+
+def make_dipole(infile, outfile, region, dim="lat", chunk_size=120):
+    """Calculate the index and save it
+
+    The input is read lazily in blocks of chunk_size time steps, and the
+    index is computed and written one block at a time. The index is the
+    area-weighted mean of the derivative in K per metre (units "K m-1", or
+    those of the input per metre when it has any), so its values are not
+    comparable with the unweighted differences per grid step that earlier
+    versions of this script wrote.
+    """
+    with read_dataset(infile, chunks={"time": chunk_size}) as data:
+        varname = list(data.data_vars.keys())[0]
+        units = data[varname].attrs.get("units", "K")
+        index = gradient.gradient_index(data[varname], region, dim=dim, units=units)
+        write_netcdf(index, outfile)
 
 
 def main():
-    """Parse the command line arguments and run download_data().
+    """Parse the command line arguments and run make_dipole().
     """
     args = parser.parse_args()
-    ds = xr.open_dataarray(args.infile)
-    ds = ds.sel(lon=slice(args.X0, args.X1), lat=slice(args.Y0, args.Y1))
-    ddy = np.gradient(ds.values)[1]
-    ddy = xr.DataArray(ddy, coords=ds.coords, dims=ds.dims)
-    ddy = ddy.mean(dim=["lon", "lat"])
-    ddy.to_netcdf(args.outfile, format="NETCDF4", mode="w")
+    if args.index is not None:
+        (region,) = mkconfig.read_boxes(args.config, names=[args.index])
+        dim = mkconfig.read_mk(args.config).get(args.index + "DIM", args.dim)
+    else:
+        region = regions.box("dipole", args.X0, args.X1, args.Y0, args.Y1)
+        dim = args.dim
+    make_dipole(
+        infile=os.path.abspath(args.infile),
+        outfile=os.path.abspath(args.outfile),
+        region=region,
+        dim=dim,
+        chunk_size=args.chunk_size,
+    )
 
 
 if __name__ == "__main__":
-    main()
+    instrument.run(main)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Extract many regions from one data set in a single read
+
+The regions are the boxes defined in the config/*.mk files (and optionally
+the polygons of a GeoJSON file). The source is opened once and read in
+blocks of at most --chunk_size time steps, and every region is taken from
+each block before the next one is read. Averages (--mode mean) are saved together along
+a region dimension; subsets (--mode subset) have different shapes, so each
+is saved as a group of the output named after its region.
+"""
+
+import argparse
+import os
+import warnings
+from collections import OrderedDict
+import instrument
+import mkconfig
+import regions
+from dataio import read_dataset, write_dataset, write_groups
+
+parser = argparse.ArgumentParser()  # pylint: disable=C0103
+parser.add_argument("--infile", help="the input data")
+parser.add_argument("--outfile", help="the filename of the data to save")
+parser.add_argument("--config", nargs="+", help="the .mk files defining the boxes")
+parser.add_argument(
+    "--regions", nargs="+", help="the boxes to extract (default: all defined)"
+)
+parser.add_argument("--geojson", help="also average over these polygons")
+parser.add_argument("--mode", choices=["mean", "subset"], default="mean")
+parser.add_argument(
+    "--chunk_size",
+    type=int,
+    default=1000,
+    help="most time steps read at once, rounded down to whole stored chunks",
+)
+parser.add_argument("--weight_cache", help="keep the averaging weights here")
+
+
+def time_block(infile, chunk_size):
+    """The number of time steps to read at once from infile
+
+    At most chunk_size, which bounds memory. Where the stored chunks are no
+    longer than that, the block is a whole number of them, so no stored chunk
+    is split between blocks and decompressed more than once; longer stored
+    chunks (e.g. the whole time axis of a file written with layout="time")
+    are split and decompressed once per block.
+    """
+    with read_dataset(infile) as data:
+        stored = []
+        for var in data.data_vars.values():
+            shape = var.encoding.get("chunksizes") or var.encoding.get("chunks")
+            if shape and "time" in var.dims:
+                stored.append(shape[var.dims.index("time")])
+    if not stored:
+        return chunk_size
+    step = max(stored)
+    if step > chunk_size:
+        return chunk_size
+    return step * (chunk_size // step)
+
+
+def make_regions(
+    infile, outfile, region_list, mode="mean", chunk_size=1000, cache_dir=None
+):
+    """Average or subset data over every region in one pass
+
+    The results are built lazily on blocks of at most chunk_size time steps
+    (see time_block) and computed together, so each block is read from disk
+    once whatever the number of regions.
+    """
+    import dask  # pylint: disable=C0415
+
+    with warnings.catch_warnings():
+        # splitting long stored chunks is the price of bounded memory
+        warnings.filterwarnings("ignore", message="The specified chunks separate")
+        data = read_dataset(infile, chunks={"time": time_block(infile, chunk_size)})
+    if mode == "mean":
+        with instrument.phase("compute"):
+            (result,) = dask.compute(
+                regions.regional_mean(data, region_list, cache_dir=cache_dir)
+            )
+        write_dataset(result, outfile)
+    else:
+        if any("box" not in region for region in region_list):
+            raise ValueError("subsets can only be taken over boxes")
+        names = [region["name"] for region in region_list]
+        with instrument.phase("compute"):
+            subsets = dask.compute(
+                *[regions.subset(data, reg) for reg in region_list]
+            )
+        write_groups(OrderedDict(zip(names, subsets)), outfile, layout="time")
+
+
+def main():
+    """Parse the command line arguments and run make_regions().
+    """
+    args = parser.parse_args()
+    region_list = mkconfig.read_boxes(args.config, names=args.regions)
+    if args.geojson is not None:
+        region_list += regions.read_geojson(args.geojson)
+    make_regions(
+        infile=os.path.abspath(args.infile),
+        outfile=os.path.abspath(args.outfile),
+        region_list=region_list,
+        mode=args.mode,
+        chunk_size=args.chunk_size,
+        cache_dir=args.weight_cache,
+    )
+
+
+if __name__ == "__main__":
+    instrument.run(main)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Summarize where the time of the whole pipeline went
+
+Reads the manifests that instrument.run leaves next to every output, counts
+each run once (a run with several outputs leaves identical manifests), and
+adds up the phases by script and phase name. The totals are printed with
+the slowest first and optionally saved as JSON.
+"""
+
+import argparse
+import json
+import os
+from collections import OrderedDict
+from instrument import MANIFEST_SUFFIX
+
+parser = argparse.ArgumentParser()  # pylint: disable=C0103
+parser.add_argument(
+    "--root", nargs="+", default=["data", "tables"], help="where to look for runs"
+)
+parser.add_argument("--outfile", default=None, help="save the JSON here")
+
+_SUMMED = ["wall_s", "cpu_s", "read_bytes", "written_bytes"]
+_ROW = "{:<28} {:<16} {:>5} {:>10} {:>10} {:>9} {:>9} {:>9}"
+
+
+def find_manifests(roots):
+    """The paths of every manifest below the roots
+    """
+    found = []
+    for root in roots:
+        for dirpath, _, fnames in os.walk(root):
+            found.extend(
+                os.path.join(dirpath, fname)
+                for fname in fnames
+                if fname.endswith(MANIFEST_SUFFIX)
+            )
+    return sorted(found)
+
+
+def read_runs(paths):
+    """The distinct runs recorded in the manifests, by run_id
+    """
+    runs = OrderedDict()
+    for path in paths:
+        with open(path) as fjson:
+            record = json.load(fjson)
+        runs.setdefault(record["run_id"], record)
+    return runs
+
+
+def aggregate(runs):
+    """Totals of the phases of all runs, by script and phase name
+
+    Wall times of phases run side by side in worker processes add up to more
+    than the time that passed; the peak memory is the largest of any one.
+    """
+    totals = OrderedDict()
+    for record in runs.values():
+        for phase in record["phases"]:
+            key = (record["script"], phase["name"])
+            total = totals.setdefault(
+                key,
+                OrderedDict(
+                    script=key[0], phase=key[1], count=0, peak_rss_bytes=0
+                ),
+            )
+            total["count"] += 1
+            total["peak_rss_bytes"] = max(
+                total["peak_rss_bytes"], phase["peak_rss_bytes"]
+            )
+            for field in _SUMMED:
+                if field in phase:
+                    total[field] = total.get(field, 0) + phase[field]
+    return sorted(totals.values(), key=lambda total: -total["wall_s"])
+
+
+def format_table(totals):
+    """The totals as a text table
+    """
+    header = ["script", "phase", "n", "wall (s)", "cpu (s)", "rss (MB)"]
+    lines = [_ROW.format(*(header + ["in (MB)", "out (MB)"]))]
+    for total in totals:
+        megabytes = [
+            total.get(field, float("nan")) / 2 ** 20
+            for field in ["peak_rss_bytes", "read_bytes", "written_bytes"]
+        ]
+        numbers = [total["wall_s"], total["cpu_s"]] + megabytes
+        lines.append(
+            _ROW.format(
+                total["script"],
+                total["phase"],
+                total["count"],
+                *["{:.1f}".format(number) for number in numbers]
+            )
+        )
+    return "\n".join(lines)
+
+
+def main():
+    """Parse the command line arguments and print the report.
+    """
+    args = parser.parse_args()
+    runs = read_runs(find_manifests(args.root))
+    totals = aggregate(runs)
+    print(format_table(totals))
+    if args.outfile is not None:
+        report = dict(
+            runs=[
+                OrderedDict(
+                    run_id=run_id,
+                    script=record["script"],
+                    argv=record["argv"],
+                    started=record["started"],
+                    outputs=[output["path"] for output in record["outputs"]],
+                )
+                for run_id, record in runs.items()
+            ],
+            phases=totals,
+        )
+        with open(args.outfile, "w") as f:
+            f.write(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
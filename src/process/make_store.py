@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Gather processed data products into one consolidated Zarr store
+
+Each input file becomes a group of the store named after the file, so that
+e.g. data/processed/rain.nc is read back with
+read_dataset("data/processed/processed.zarr/rain").
+"""
+
+import argparse
+import os
+import instrument
+from dataio import read_dataset, write_dataset
+
+parser = argparse.ArgumentParser()  # pylint: disable=C0103
+parser.add_argument("--infile", nargs="+", help="the processed files to copy")
+parser.add_argument("--store", help="the Zarr store to write to")
+parser.add_argument(
+    "--layout", default="time", help="the chunk layout, 'time' or 'map'"
+)
+
+
+def make_store(infiles, store, layout="time"):
+    """Copy each infile into a group of store, replacing any older copy
+    """
+    for infile in infiles:
+        group = os.path.splitext(os.path.basename(infile))[0]
+        with read_dataset(infile, chunks={}) as data:
+            write_dataset(data, os.path.join(store, group), layout=layout)
+
+
+def main():
+    """Parse the command line arguments and run make_store().
+    """
+    args = parser.parse_args()
+    make_store(
+        infiles=[os.path.abspath(fname) for fname in args.infile],
+        store=os.path.abspath(args.store),
+        layout=args.layout,
+    )
+
+
+if __name__ == "__main__":
+    instrument.run(main)
@@ -5,7 +5,8 @@
 
 import argparse
 import os
-import xarray as xr
+import instrument
+from dataio import read_dataset, write_dataset
 
 parser = argparse.ArgumentParser()  # pylint: disable=C0103
 parser.add_argument("--outfile", help="the filename of the data to save")
@@ -20,11 +21,9 @@ def make_subset(infile, outfile, lonmin, lonmax, latmin, latmax):
     """Carry out the subsetting
     """
     # Read in the data
-    data = xr.open_dataset(infile)
+    data = read_dataset(infile)
     data = data.sel(lon=slice(lonmin, lonmax), lat=slice(latmin, latmax))
-    if os.path.isfile(outfile):
-        os.remove(outfile)
-    data.to_netcdf(outfile, format="NETCDF4")
+    write_dataset(data, outfile, layout="time")
 
 
 def main():
@@ -42,4 +41,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    instrument.run(main)
@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """Get a time series averaged over some area
+
+The average is weighted by grid cell area and skips missing values. The area
+is either a lon/lat box or, with --geojson, the polygons of a GeoJSON file
+(one time series per feature, along a region dimension).
 """
 
 import argparse
 import os
-import xarray as xr
+import instrument
+import regions
+from dataio import read_dataset, write_dataset
 
 parser = argparse.ArgumentParser()  # pylint: disable=C0103
 parser.add_argument("--outfile", help="the filename of the data to save")
@@ -14,33 +20,41 @@ parser.add_argument("--X0", type=float, help="lon min")
 parser.add_argument("--X1", type=float, help="lon max")
 parser.add_argument("--Y0", type=float, help="lat min")
 parser.add_argument("--Y1", type=float, help="lat max")
+parser.add_argument("--geojson", help="average over these polygons instead")
+parser.add_argument(
+    "--name_field", default="name", help="the GeoJSON property naming each region"
+)
+parser.add_argument("--weight_cache", help="keep the averaging weights here")
+
 
+def make_subset(infile, outfile, region_list, cache_dir=None):
+    """Carry out the averaging
 
-def make_subset(infile, outfile, lonmin, lonmax, latmin, latmax):
-    """Carry out the subsetting
+    A single region is saved without the region dimension.
     """
     # Read in the data
-    data = xr.open_dataset(infile)
-    data = data.sel(lon=slice(lonmin, lonmax), lat=slice(latmin, latmax))
-    data = data.mean(dim=["lon", "lat"])
-    if os.path.isfile(outfile):
-        os.remove(outfile)
-    data.to_netcdf(outfile, format="NETCDF4")
+    data = read_dataset(infile)
+    data = regions.regional_mean(data, region_list, cache_dir=cache_dir)
+    if len(region_list) == 1:
+        data = data.squeeze("region")
+    write_dataset(data, outfile)
 
 
 def main():
     """Parse the command line arguments and run download_data().
     """
     args = parser.parse_args()
+    if args.geojson is not None:
+        region_list = regions.read_geojson(args.geojson, name_field=args.name_field)
+    else:
+        region_list = [regions.box("box", args.X0, args.X1, args.Y0, args.Y1)]
     make_subset(
         infile=os.path.abspath(args.infile),
         outfile=os.path.abspath(args.outfile),
-        lonmin=args.X0,
-        lonmax=args.X1,
-        latmin=args.Y0,
-        latmax=args.Y1,
+        region_list=region_list,
+        cache_dir=args.weight_cache,
     )
 
 
 if __name__ == "__main__":
-    main()
+    instrument.run(main)
@@ -4,42 +4,148 @@
 """
 
 import argparse
-import os
 from collections import OrderedDict
-import xarray as xr
+from multiprocessing import Pool
 import numpy as np
-import pandas as pd
-from scipy.stats import pearsonr as correl
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
-from numba import jit
+import instrument
+import wtmodel
+from dataio import read_dataset, write_netcdf
+
+PCA_TOL = 0.05  # largest difference of the re-scaled PCs allowed by check_pcs
 
 parser = argparse.ArgumentParser()  # pylint: disable=C0103
-parser.add_argument("--outfile", help="the filename of the data to save")
+parser.add_argument(
+    "--outfile",
+    help="the filename of the data to save; with several --n_cluster values "
+    "it must contain {} which is replaced by the number of clusters",
+)
 parser.add_argument(
     "--table", help="the filename of the latex table to write", default=None
 )
+parser.add_argument(
+    "--model",
+    default=None,
+    help="save the fitted classification here (.npz, see wtmodel), to assign "
+    "new days with assign_weather_type; may contain {} like --outfile",
+)
 parser.add_argument("--infile", help="the input data")
 parser.add_argument(
     "--var_xpl", type=float, help="Min amount of variance that must be retained"
 )
-parser.add_argument("--n_cluster", type=int, help="Number of clusters to create")
+parser.add_argument(
+    "--n_cluster", type=int, nargs="+", help="Number(s) of clusters to create"
+)
 parser.add_argument("--n_sim", type=int, help="Number of simulations to create")
+parser.add_argument(
+    "--n_jobs", type=int, default=1, help="Number of worker processes for KMeans"
+)
+parser.add_argument(
+    "--pca_solver",
+    default="full",
+    choices=["full", "randomized", "incremental"],
+    help="randomized or incremental avoid a full SVD for long records",
+)
+parser.add_argument(
+    "--pca_check",
+    action="store_true",
+    help="fail if the chosen solver is further than --pca_tol from the full PCA",
+)
+parser.add_argument(
+    "--pca_tol",
+    type=float,
+    default=PCA_TOL,
+    help="the largest difference allowed by --pca_check",
+)
+
+SEED = 1085  # master seed for the KMeans ensemble
+
+_POOL_PC_TS = None  # PC time series shared with the worker processes
+
+
+def _init_worker(pc_ts):
+    """Store the PC time series once per worker rather than once per task
+    """
+    global _POOL_PC_TS  # pylint: disable=W0603
+    _POOL_PC_TS = pc_ts
+
+
+def _fit_one(task):
+    """Fit a single member of the KMeans ensemble
+    """
+    from sklearn.cluster import KMeans  # pylint: disable=C0415
+
+    n_cluster, seed = task
+    km = KMeans(n_clusters=n_cluster, random_state=seed).fit(_POOL_PC_TS)
+    return km.cluster_centers_, km.labels_
+
+
+def ensemble_seeds(n_sim, seed=SEED):
+    """Derive one seed per ensemble member from the master seed
+
+    The seeds depend only on the master seed and on the member index, so the
+    ensemble is identical no matter how the fits are split across workers.
+    """
+    rng = np.random.RandomState(seed)
+    return rng.randint(0, np.iinfo(np.int32).max, size=n_sim)
+
+
+def make_pool(pc_ts, n_jobs):
+    """Create a worker pool holding the PC time series
+
+    The same pool can be passed to several calls of loop_kmeans, e.g. one per
+    number of clusters, so the workers are only started once.
+    """
+    return Pool(n_jobs, initializer=_init_worker, initargs=(np.asarray(pc_ts),))
 
 
-@jit
-def loop_kmeans(X, pc_ts, n_cluster, n_sim, n_components_keep):
-    centroids = np.zeros(shape=(n_sim, n_cluster, n_components_keep))
-    w_types = np.zeros(shape=(n_sim, X.shape[0]))
-    for i in np.arange(n_sim):
-        km = KMeans(n_clusters=n_cluster).fit(pc_ts)
-        centroids[i, :, :] = km.cluster_centers_
-        w_types[i, :] = km.labels_
+def loop_kmeans(pc_ts, n_cluster, n_sim, seed=SEED, n_jobs=1, pool=None):
+    """Fit an ensemble of n_sim KMeans partitions of the PC time series
+
+    Args:
+        pc_ts: the (time, component) PC time series to cluster
+        n_cluster: the number of clusters of each partition
+        n_sim: the number of ensemble members
+        seed: the master seed from which each member's seed is derived
+        n_jobs: the number of worker processes to spread the fits over
+        pool: an existing pool from make_pool(pc_ts, ...) to use instead
+    Returns:
+        centroids: (n_sim, n_cluster, n_components) array of cluster centers
+        w_types: (n_sim, time) array of cluster labels
+    """
+    pc_ts = np.asarray(pc_ts)
+    tasks = [(n_cluster, s) for s in ensemble_seeds(n_sim, seed=seed)]
+    if pool is not None:
+        fits = pool.map(_fit_one, tasks)
+    elif n_jobs > 1:
+        chunksize = max(1, n_sim // (4 * n_jobs))
+        with make_pool(pc_ts, n_jobs) as pool:
+            fits = pool.map(_fit_one, tasks, chunksize=chunksize)
+    else:
+        _init_worker(pc_ts)
+        fits = [_fit_one(task) for task in tasks]
+
+    centroids = np.zeros(shape=(n_sim, n_cluster, pc_ts.shape[1]))
+    w_types = np.zeros(shape=(n_sim, pc_ts.shape[0]))
+    for i, (centers, labels) in enumerate(fits):
+        centroids[i, :, :] = centers
+        w_types[i, :] = labels
     return centroids, w_types
 
 
-@jit
+def standardize_centroids(centroids):
+    """Scale each centroid to zero mean and unit norm over its components
+
+    With this scaling the Pearson correlation between two centroids is simply
+    their dot product, so whole blocks of correlations become one matmul.
+
+    Args:
+        centroids: (..., n_components) array of cluster centroids
+    """
+    anom = centroids - centroids.mean(axis=-1, keepdims=True)
+    norm = np.sqrt((anom ** 2).sum(axis=-1, keepdims=True))
+    return anom / norm
+
+
 def calc_classifiability(P, Q):
     """Implement the Michaelangeli (1995) Classifiability Index
 
@@ -51,28 +157,38 @@ def calc_classifiability(P, Q):
         P: a cluster centroid
         Q: another cluster centroid
     """
-    k = P.shape[0]
-    Aij = np.ones([k, k])
-    for i in range(k):
-        for j in range(k):
-            Aij[i, j], _ = correl(P[i, :], Q[j, :])
+    Aij = standardize_centroids(P).dot(standardize_centroids(Q).T)
     Aprime = Aij.max(axis=0)
     ci = Aprime.min()
     return ci
 
 
-@jit
-def matrix_classifiability(centroids):
+def matrix_classifiability(centroids, block_size=64):
+    """Classifiability of every pair of partitions in the ensemble
+
+    Entry (p, q) is calc_classifiability(P=centroids[p], Q=centroids[q]). The
+    correlations between the clusters of p and q are the transpose of those
+    between q and p, so only blocks on or above the diagonal are computed and
+    each one fills both c_pq[p, q] and c_pq[q, p].
+
+    Args:
+        centroids: (n_sim, n_cluster, n_components) array of cluster centroids
+        block_size: number of partitions per block, which bounds the memory
+            used to block_size * n_sim * n_cluster ** 2 floats
+    Returns:
+        classifiability: the mean classifiability over all pairs p != q
+        best_part: the partition with the highest classifiability
+    """
     nsim = centroids.shape[0]
+    Z = standardize_centroids(np.asarray(centroids, dtype=float))
     c_pq = np.ones([nsim, nsim])
-    for i in range(0, nsim):
-        for j in range(0, nsim):
-            if i == j:
-                c_pq[i, j] = np.nan
-            else:
-                c_pq[i, j] = calc_classifiability(
-                    P=centroids[i, :, :], Q=centroids[j, :, :]
-                )
+    for i0 in range(0, nsim, block_size):
+        i1 = min(i0 + block_size, nsim)
+        # Aij[p, q, a, b] is the correlation of cluster a of p with cluster b of q
+        Aij = np.einsum("pak,qbk->pqab", Z[i0:i1], Z[i0:])
+        c_pq[i0:i1, i0:] = Aij.max(axis=2).min(axis=2)
+        c_pq[i0:, i0:i1] = Aij.max(axis=3).min(axis=2).T
+    np.fill_diagonal(c_pq, np.nan)
     classifiability = np.nanmean(c_pq)
     best_part = np.where(c_pq == np.nanmax(c_pq))[0][0]
     return classifiability, best_part
@@ -98,55 +214,317 @@ def resort_labels(old_labels):
     return new_labels
 
 
-def main():
-    """Parse the command line arguments and run download_data().
+def label_types(old_labels, n_cluster):
+    """The weather type of each KMeans label, as resort_labels numbers them
+
+    Args:
+        old_labels: the KMeans labels of every day of a partition
+        n_cluster: the number of clusters of the partition
+    Returns:
+        an (n_cluster,) array, with 0 for labels no day was given
     """
-    np.random.seed(1085)  # set seed from
-    args = parser.parse_args()
-    psi = xr.open_dataset(args.infile)["anomaly"]
+    old_labels = np.int_(old_labels)
+    wtypes = np.zeros(n_cluster, dtype="int64")
+    wtypes[old_labels] = resort_labels(old_labels)
+    return wtypes
+
+
+def _n_components_keep(explained_variance_ratio, var_xpl):
+    """Number of leading EOFs needed to retain more than var_xpl of the variance
+    """
+    cum_var = np.cumsum(explained_variance_ratio)
+    exceed = np.where(cum_var > var_xpl)[0]
+    if exceed.size == 0:
+        return None
+    return exceed.min() + 1  # compensate for zero indexing
+
+
+def _shape(X):
+    """The (time, grid) shape of a data matrix, see _rows
+    """
+    if hasattr(X, "dims"):
+        return X.sizes["time"], X.size // X.sizes["time"]
+    return X.shape
+
+
+def _rows(X, i0, i1):
+    """Rows i0 to i1 of a data matrix, as an array
+
+    X is either a (time, grid) array or a (time, lon, lat) DataArray, which
+    can be lazily opened: only the time steps asked for are then read, and
+    stacked lon-major as psi.stack(grid=["lon", "lat"]) would.
+    """
+    if hasattr(X, "dims"):
+        block = X.isel(time=slice(i0, i1)).transpose("time", "lon", "lat").values
+        return block.reshape((block.shape[0], -1))
+    return np.asarray(X[i0:i1])
+
+
+def _batches(n_rows, batch_size, min_size):
+    """The (start, end) rows of batches of batch_size rows
+
+    A last batch shorter than min_size is merged into the one before it.
+    """
+    edges = list(range(0, n_rows, batch_size)) + [n_rows]
+    if len(edges) > 2 and edges[-1] - edges[-2] < min_size:
+        del edges[-2]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _fit_truncated(X, n_components, solver, batch_size):
+    """Fit a PCA with a fixed number of components using a non-full solver
+    """
+    from sklearn.decomposition import PCA, IncrementalPCA  # pylint: disable=C0415
+
+    if solver == "randomized":
+        return PCA(
+            n_components=n_components, svd_solver="randomized", random_state=SEED
+        ).fit(_rows(X, 0, _shape(X)[0]))
+    pca = IncrementalPCA(n_components=n_components)
+    # partial_fit needs at least n_components samples per batch
+    for i0, i1 in _batches(_shape(X)[0], batch_size, n_components):
+        pca.partial_fit(_rows(X, i0, i1))
+    return pca
+
+
+def fit_pca(X, var_xpl, solver="full", n_start=16, batch_size=1000):
+    """Fit the EOFs with a single decomposition
+
+    With the full solver one SVD gives both the variance cutoff and the
+    loadings. The randomized and incremental solvers start from n_start
+    components and double them until var_xpl of the total variance is
+    explained; the incremental solver only holds batch_size time steps in
+    memory at a time, and reads them one batch at a time if X is lazy.
+
+    Args:
+        X: the (time, grid) data matrix, or a (time, lon, lat) DataArray
+            (see _rows)
+        var_xpl: the minimum fraction of variance that must be retained
+        solver: one of "full", "randomized" or "incremental"
+        n_start: the initial number of components for the iterative solvers
+        batch_size: the number of time steps per batch of the incremental solver
+    Returns:
+        pc_ts: the (time, n_components_keep) PC time series
+        loadings: the (n_components_keep, grid) EOF loadings
+        mean: the (grid,) mean that was removed before projecting
+    """
+    from sklearn.decomposition import PCA  # pylint: disable=C0415
+
+    n_max = min(_shape(X))
+    if solver == "full":
+        pca = PCA(svd_solver="full").fit(_rows(X, 0, _shape(X)[0]))
+        n_components_keep = _n_components_keep(pca.explained_variance_ratio_, var_xpl)
+    else:
+        if solver == "incremental":
+            n_max = min(n_max, batch_size)
+        n_components = min(n_start, n_max)
+        while True:
+            pca = _fit_truncated(X, n_components, solver, batch_size)
+            n_components_keep = _n_components_keep(
+                pca.explained_variance_ratio_, var_xpl
+            )
+            if n_components_keep is not None or n_components == n_max:
+                break
+            n_components = min(2 * n_components, n_max)
+    if n_components_keep is None:
+        raise ValueError("cannot retain {} of the variance".format(var_xpl))
+
+    loadings = pca.components_[:n_components_keep, :]
+    mean = pca.mean_
+    pc_ts = np.concatenate(
+        [
+            (_rows(X, i0, i1) - mean).dot(loadings.T)
+            for i0, i1 in _batches(_shape(X)[0], batch_size, 1)
+        ]
+    )
+    return pc_ts, loadings, mean
+
+
+def fit_projection(psi, var_xpl, solver="full"):
+    """Project the anomalies onto the leading EOFs, keeping the projection
+
+    Args:
+        psi: the (time, lon, lat) anomaly field, which the incremental
+            solver reads a batch at a time if it is not loaded
+        var_xpl: the minimum fraction of variance that must be retained
+        solver: the PCA solver to use, see fit_pca
+    Returns:
+        pc_ts: the PC time series, re-scaled to standard normal
+        projection: a dict of the grid, mean, loadings, pc_mean and pc_scale
+            that turn an anomaly field into pc_ts (see wtmodel)
+    """
+    from sklearn.preprocessing import StandardScaler  # pylint: disable=C0415
+
+    pc_ts, loadings, mean = fit_pca(psi, var_xpl, solver=solver)
+
+    # Re-Scale the PC Time series to standard normal -- this is not always good
+    scaler = StandardScaler()
+    pc_ts = scaler.fit_transform(pc_ts)
+    projection = dict(
+        lon=psi["lon"].values,
+        lat=psi["lat"].values,
+        mean=mean,
+        loadings=loadings,
+        pc_mean=scaler.mean_,
+        pc_scale=scaler.scale_,
+    )
+    return pc_ts, projection
+
+
+def calc_pcs(psi, var_xpl, solver="full"):
+    """Project the anomalies onto the leading EOFs
+
+    Args:
+        psi: the (time, lon, lat) anomaly field
+        var_xpl: the minimum fraction of variance that must be retained
+        solver: the PCA solver to use, see fit_pca
+    Returns:
+        pc_ts: the PC time series, re-scaled to standard normal
+        n_components_keep: the number of EOFs retained
+    """
+    pc_ts, projection = fit_projection(psi, var_xpl, solver=solver)
+    return pc_ts, projection["loadings"].shape[0]
+
+
+def check_pcs(psi, var_xpl, solver, tolerance=PCA_TOL):
+    """Compare the PCs from a solver with the original two-pass full PCA
+
+    Args:
+        psi: the (time, lon, lat) anomaly field
+        var_xpl: the minimum fraction of variance that must be retained
+        solver: the PCA solver to check, see fit_pca
+        tolerance: the largest difference allowed
+    Returns:
+        a dict with the number of components each path keeps, the largest
+        absolute difference between the common (re-scaled) PC time series,
+        after matching the arbitrary sign of each EOF, and whether both keep
+        the same number of components and differ by at most tolerance
+    """
+    from sklearn.decomposition import PCA  # pylint: disable=C0415
+    from sklearn.preprocessing import StandardScaler  # pylint: disable=C0415
 
-    # carry out PCA
     psi_stacked = psi.stack(grid=["lon", "lat"])
     pca = PCA().fit(psi_stacked)
-    cum_var = pca.explained_variance_ratio_.cumsum()
-    n_components_keep = (
-        np.where(cum_var > args.var_xpl)[0].min() + 1
-    )  # compensate for zero indexing
-    pca = PCA(n_components=n_components_keep).fit(psi_stacked)
-    pc_ts = pca.transform(psi_stacked)
-    loadings = pca.components_
+    n_ref = _n_components_keep(pca.explained_variance_ratio_, var_xpl)
+    pca = PCA(n_components=n_ref).fit(psi_stacked)
+    pc_ref = StandardScaler().fit_transform(pca.transform(psi_stacked))
 
-    # Re-Scale the PC Time series to standard normal -- this is not always good
-    pc_ts = StandardScaler().fit_transform(pc_ts)
-
-    centroids, wtypes = loop_kmeans(
-        X=psi_stacked,
-        pc_ts=pc_ts,
-        n_cluster=args.n_cluster,
-        n_sim=args.n_sim,
-        n_components_keep=n_components_keep,
+    pc_ts, n_components_keep = calc_pcs(psi, var_xpl, solver=solver)
+    n_common = min(n_ref, n_components_keep)
+    pc_ref = pc_ref[:, :n_common]
+    pc_ts = pc_ts[:, :n_common]
+    pc_ts = pc_ts * np.sign((pc_ts * pc_ref).sum(axis=0))
+    max_abs_diff = float(np.abs(pc_ts - pc_ref).max())
+    return OrderedDict(
+        solver=solver,
+        n_components_reference=int(n_ref),
+        n_components=int(n_components_keep),
+        max_abs_diff=max_abs_diff,
+        tolerance=tolerance,
+        passed=bool(n_ref == n_components_keep and max_abs_diff <= tolerance),
     )
-    class_idx, best_part = matrix_classifiability(centroids)
 
-    if args.table is not None:
-        best_centroid = centroids[best_part, :, :]
-        best_centroid = pd.DataFrame(best_centroid)
-        best_centroid.columns = [
-            "EOF {}".format(i) for i in np.arange(1, n_components_keep + 1)
-        ]
-        best_centroid["WT"] = np.arange(1, args.n_cluster + 1)
-        best_centroid.set_index("WT", inplace=True)
-        best_centroid.round(decimals=3).to_latex(args.table)
 
-    best_wt = wtypes[best_part, :]
-    best_wt = pd.Series(resort_labels(best_wt), index=psi["time"]).to_xarray()
-    best_wt.name = "wtype"
-    best_wt.attrs = OrderedDict(class_idx=class_idx)
+def write_table(best_centroid, table):
+    """Write the centroids of the best partition to a latex table
+    """
+    import pandas as pd  # pylint: disable=C0415
+
+    n_cluster, n_components_keep = best_centroid.shape
+    best_centroid = pd.DataFrame(best_centroid)
+    best_centroid.columns = [
+        "EOF {}".format(i) for i in np.arange(1, n_components_keep + 1)
+    ]
+    best_centroid["WT"] = np.arange(1, n_cluster + 1)
+    best_centroid.set_index("WT", inplace=True)
+    best_centroid.round(decimals=3).to_latex(table)
+    instrument.add_output(table)
+
+
+def write_weather_types(best_wt, time, class_idx, outfile):
+    """Re-sort the labels of the best partition and save them to file
+    """
+    import xarray as xr  # pylint: disable=C0415
+
+    best_wt = xr.DataArray(
+        resort_labels(best_wt),
+        dims="time",
+        coords=dict(time=np.asarray(time)),
+        name="wtype",
+        attrs=OrderedDict(class_idx=class_idx),
+    )
+    write_netcdf(best_wt, outfile)
+
+
+def main():
+    """Parse the command line arguments and run download_data().
+    """
+    args = parser.parse_args()
+    if len(args.n_cluster) > 1:
+        if "{}" not in args.outfile:
+            parser.error("--outfile must contain {} when several k are given")
+        if args.table is not None:
+            parser.error("--table needs a single value of --n_cluster")
+        if args.model is not None and "{}" not in args.model:
+            parser.error("--model must contain {} when several k are given")
+
+    with instrument.phase("read"):
+        psi = read_dataset(args.infile)["anomaly"]
+        if args.pca_solver != "incremental":
+            psi = psi.load()
+    with instrument.phase("pca") as pca_phase:
+        if args.pca_check:
+            # kept in the manifest of the outputs
+            pca_phase["check"] = check = check_pcs(
+                psi,
+                var_xpl=args.var_xpl,
+                solver=args.pca_solver,
+                tolerance=args.pca_tol,
+            )
+            if not check["passed"]:
+                raise ValueError("the PCs fail --pca_check: {}".format(dict(check)))
+        pc_ts, projection = fit_projection(
+            psi, var_xpl=args.var_xpl, solver=args.pca_solver
+        )
+
+    # every k is clustered from the same PC time series and the same workers
+    pool = make_pool(pc_ts, args.n_jobs) if args.n_jobs > 1 else None
+    try:
+        for n_cluster in args.n_cluster:
+            with instrument.phase("loop_kmeans"):
+                centroids, wtypes = loop_kmeans(
+                    pc_ts=pc_ts,
+                    n_cluster=n_cluster,
+                    n_sim=args.n_sim,
+                    n_jobs=args.n_jobs,
+                    pool=pool,
+                )
+            with instrument.phase("classifiability"):
+                class_idx, best_part = matrix_classifiability(centroids)
+
+            if args.table is not None:
+                write_table(centroids[best_part, :, :], args.table)
+
+            if args.model is not None:
+                wtmodel.save(
+                    args.model.format(n_cluster),
+                    centroids=centroids[best_part, :, :],
+                    wtypes=label_types(wtypes[best_part, :], n_cluster),
+                    class_idx=class_idx,
+                    **projection
+                )
 
-    if os.path.isfile(args.outfile):
-        os.remove(args.outfile)
-    best_wt.to_netcdf(args.outfile, format="NETCDF4")
+            write_weather_types(
+                wtypes[best_part, :],
+                time=psi["time"],
+                class_idx=class_idx,
+                outfile=args.outfile.format(n_cluster),
+            )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 
 if __name__ == "__main__":
-    main()
+    instrument.run(main)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Red-noise significance test of the weather type classifiability
+
+Following Michelangeli et al. (1995), the classifiability index of the real
+PC time series is compared with its distribution over surrogate series with
+the same lag-1 autocorrelation and variance (independent AR(1) processes,
+one per PC). Each surrogate goes through the same KMeans ensemble and
+classifiability calculation as the real data.
+
+Surrogates are generated and clustered in batches spread over a pool of
+workers, each of which only holds its current batch. Every finished batch
+is appended to a CSV checkpoint, so an interrupted run picks up where it
+stopped, and a later run with more surrogates only computes the new ones.
+Each row carries a hash of the AR(1) parameters, the KMeans settings, the
+seed and the input file, and rows of any other run are discarded.
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+from multiprocessing import Pool
+import numpy as np
+import xarray as xr
+import instrument
+from dataio import read_dataset, write_netcdf
+from make_weather_type import (
+    SEED,
+    calc_pcs,
+    ensemble_seeds,
+    loop_kmeans,
+    matrix_classifiability,
+)
+
+parser = argparse.ArgumentParser()  # pylint: disable=C0103
+parser.add_argument("--infile", help="the input data")
+parser.add_argument("--outfile", help="the filename of the data to save")
+parser.add_argument(
+    "--wtfile",
+    help="weather type file(s) holding the observed class_idx, with {} for the "
+    "number of clusters; if not given it is recomputed",
+)
+parser.add_argument(
+    "--var_xpl", type=float, help="Min amount of variance that must be retained"
+)
+parser.add_argument(
+    "--n_cluster", type=int, nargs="+", help="Number(s) of clusters to test"
+)
+parser.add_argument("--n_sim", type=int, help="KMeans runs per surrogate")
+parser.add_argument("--n_surrogate", type=int, default=100, help="surrogates per k")
+parser.add_argument("--batch", type=int, default=4, help="surrogates per task")
+parser.add_argument("--n_jobs", type=int, default=1, help="worker processes")
+parser.add_argument("--checkpoint", help="CSV file of finished surrogates")
+
+CHECKPOINT_FIELDS = ["key", "n_cluster", "surrogate", "classifiability"]
+
+_AR1 = None  # (phi, sigma, n_time, n_sim) shared with the worker processes
+
+
+def fit_ar1(pc_ts, time):
+    """Lag-1 autocorrelation and standard deviation of each PC
+
+    Only pairs of consecutive days are used, so the gaps between seasons do
+    not count as lags.
+    """
+    pc_ts = np.asarray(pc_ts, dtype="float64")
+    day = np.asarray(time, dtype="datetime64[D]")
+    consecutive = np.diff(day) == np.timedelta64(1, "D")
+    anom = pc_ts - pc_ts.mean(axis=0)
+    lead = anom[1:][consecutive]
+    lag = anom[:-1][consecutive]
+    phi = (lead * lag).sum(axis=0) / np.sqrt(
+        (lead ** 2).sum(axis=0) * (lag ** 2).sum(axis=0)
+    )
+    return phi, pc_ts.std(axis=0)
+
+
+def ar1_surrogates(phi, sigma, n_time, seeds):
+    """AR(1) series with lag-1 autocorrelation phi and standard deviation sigma
+
+    Each surrogate is drawn from its own seed, so it does not depend on which
+    batch it was generated in.
+
+    Returns:
+        a (len(seeds), n_time, n_pc) array
+    """
+    from scipy.signal import lfilter  # pylint: disable=C0415
+
+    phi = np.asarray(phi)
+    sigma = np.asarray(sigma)
+    noise = np.stack(
+        [
+            np.random.RandomState(seed).standard_normal((n_time, phi.size))
+            for seed in seeds
+        ]
+    )
+    # start from the stationary distribution
+    noise[:, 0, :] /= np.sqrt(1 - phi ** 2)
+    series = np.empty_like(noise)
+    for j in range(phi.size):
+        series[:, :, j] = lfilter([1.0], [1.0, -phi[j]], noise[:, :, j], axis=1)
+    return series * (sigma * np.sqrt(1 - phi ** 2))
+
+
+def _init_worker(phi, sigma, n_time, n_sim):
+    """Store the AR(1) parameters once per worker
+    """
+    global _AR1  # pylint: disable=W0603
+    _AR1 = (phi, sigma, n_time, n_sim)
+
+
+def _run_batch(task):
+    """Classifiability of one batch of surrogates for one number of clusters
+
+    The seed of each surrogate is split into one seed for its noise and one
+    for its KMeans ensemble, so that the two are not drawn from the same
+    random stream.
+    """
+    n_cluster, indices, seeds = task
+    phi, sigma, n_time, n_sim = _AR1
+    noise_seeds, fit_seeds = np.array([ensemble_seeds(2, seed=s) for s in seeds]).T
+    results = []
+    for index, fit_seed, series in zip(
+        indices, fit_seeds, ar1_surrogates(phi, sigma, n_time, noise_seeds)
+    ):
+        centroids, _ = loop_kmeans(series, n_cluster, n_sim, seed=fit_seed)
+        results.append((n_cluster, index, matrix_classifiability(centroids)[0]))
+    return results
+
+
+def checkpoint_key(phi, sigma, n_time, n_sim, seed, source=None):
+    """A hash of everything the surrogates depend on
+
+    Args:
+        phi, sigma, n_time: the AR(1) parameters of the surrogates
+        n_sim: the number of KMeans runs per surrogate
+        seed: the master seed of the surrogates
+        source: anything else to tell runs apart, e.g. the input file
+    """
+    digest = hashlib.sha1()
+    digest.update(np.asarray(phi, dtype="float64").tobytes())
+    digest.update(np.asarray(sigma, dtype="float64").tobytes())
+    settings = [int(n_time), int(n_sim), int(seed), source]
+    digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def read_checkpoint(checkpoint, key):
+    """The surrogates already done with this key, as
+    {(n_cluster, surrogate): classifiability}
+
+    Rows written with another key (or before keys were recorded) are left out.
+    """
+    done = {}
+    if checkpoint is not None and os.path.isfile(checkpoint):
+        with open(checkpoint) as fcsv:
+            for row in csv.DictReader(fcsv):
+                if row.get("key") != key:
+                    continue
+                done[(int(row["n_cluster"]), int(row["surrogate"]))] = float(
+                    row["classifiability"]
+                )
+    return done
+
+
+def write_checkpoint(checkpoint, key, done):
+    """Replace the checkpoint with the rows of done, atomically
+    """
+    dirname = os.path.dirname(os.path.abspath(checkpoint))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(checkpoint + ".part", "w") as fcsv:
+        writer = csv.writer(fcsv)
+        writer.writerow(CHECKPOINT_FIELDS)
+        for (k, index), class_idx in sorted(done.items()):
+            writer.writerow([key, k, index, repr(class_idx)])
+    os.replace(checkpoint + ".part", checkpoint)
+
+
+def surrogate_test(
+    pc_ts,
+    time,
+    n_cluster,
+    n_sim,
+    n_surrogate,
+    batch=4,
+    n_jobs=1,
+    checkpoint=None,
+    seed=SEED,
+    source=None,
+):
+    """Classifiability of AR(1) surrogates of the PC time series
+
+    Args:
+        pc_ts: the (time, component) PC time series
+        time: the dates of pc_ts
+        n_cluster: a list of numbers of clusters
+        n_sim: the number of KMeans runs per surrogate
+        n_surrogate: the number of surrogates per number of clusters
+        batch: the number of surrogates generated and clustered per task
+        n_jobs: the number of worker processes
+        checkpoint: a CSV file where finished surrogates are recorded
+        seed: the master seed of the surrogates
+        source: a description of the input, such as its path, modification
+            time and var_xpl, so a checkpoint of other data is not reused
+    Returns:
+        a (len(n_cluster), n_surrogate) array of classifiability indices
+    """
+    phi, sigma = fit_ar1(pc_ts, time)
+    seeds = ensemble_seeds(n_surrogate, seed=seed + 1)
+    key = checkpoint_key(phi, sigma, len(pc_ts), n_sim, seed, source=source)
+    done = read_checkpoint(checkpoint, key)
+    tasks = []
+    for k in n_cluster:
+        todo = [i for i in range(n_surrogate) if (k, i) not in done]
+        for i0 in range(0, len(todo), batch):
+            indices = todo[i0 : i0 + batch]
+            tasks.append((k, indices, [seeds[i] for i in indices]))
+
+    if tasks:
+        params = (phi, sigma, len(pc_ts), n_sim)
+        fcsv = None
+        if checkpoint is not None:
+            # start from the rows of this run only, dropping stale ones
+            write_checkpoint(checkpoint, key, done)
+            fcsv = open(checkpoint, "a")
+            writer = csv.writer(fcsv)
+        pool = None
+        try:
+            if n_jobs > 1:
+                pool = Pool(n_jobs, initializer=_init_worker, initargs=params)
+                batches = pool.imap_unordered(_run_batch, tasks)
+            else:
+                _init_worker(*params)
+                batches = map(_run_batch, tasks)
+            for results in batches:
+                for k, index, class_idx in results:
+                    done[(k, index)] = float(class_idx)
+                    if fcsv is not None:
+                        writer.writerow([key, k, index, repr(float(class_idx))])
+                if fcsv is not None:
+                    fcsv.flush()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if fcsv is not None:
+                fcsv.close()
+
+    return np.array([[done[(k, i)] for i in range(n_surrogate)] for k in n_cluster])
+
+
+def main():
+    """Parse the command line arguments and run surrogate_test().
+    """
+    args = parser.parse_args()
+    with instrument.phase("read"):
+        psi = read_dataset(args.infile)["anomaly"].load()
+    with instrument.phase("pca"):
+        pc_ts, _ = calc_pcs(psi, var_xpl=args.var_xpl)
+    time = psi["time"].values
+
+    observed = []
+    with instrument.phase("observed"):
+        for k in args.n_cluster:
+            if args.wtfile is not None:
+                with xr.open_dataset(args.wtfile.format(k)) as wtfile:
+                    observed.append(float(wtfile["wtype"].attrs["class_idx"]))
+            else:
+                centroids, _ = loop_kmeans(pc_ts, k, args.n_sim, n_jobs=args.n_jobs)
+                observed.append(matrix_classifiability(centroids)[0])
+    observed = np.array(observed)
+
+    with instrument.phase("surrogates"):
+        null = surrogate_test(
+            pc_ts,
+            time,
+            n_cluster=args.n_cluster,
+            n_sim=args.n_sim,
+            n_surrogate=args.n_surrogate,
+            batch=args.batch,
+            n_jobs=args.n_jobs,
+            checkpoint=args.checkpoint,
+            source=dict(
+                infile=os.path.abspath(args.infile),
+                mtime=os.path.getmtime(args.infile),
+                var_xpl=args.var_xpl,
+            ),
+        )
+    result = xr.Dataset(
+        {
+            "observed": ("n_cluster", observed),
+            "surrogate": (("n_cluster", "sample"), null),
+            "p_value": (
+                "n_cluster",
+                ((null >= observed[:, None]).sum(axis=1) + 1) / (null.shape[1] + 1),
+            ),
+        },
+        coords=dict(n_cluster=args.n_cluster, sample=np.arange(null.shape[1])),
+    )
+    write_netcdf(result, os.path.abspath(args.outfile))
+
+
+if __name__ == "__main__":
+    instrument.run(main)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Area-weighted averages over boxes and polygons
+
+The average of a field over a region is a weighted sum over grid cells, so
+the weights of any number of regions form one sparse matrix with a row per
+region and a column per cell. It is built once per grid and region list and
+kept, so averaging many regions, variables and time steps costs one sparse
+matrix product per block of data.
+
+A cell's weight is its area times the fraction of it inside the region.
+Boxes follow the usual lon/lat slicing and take every cell whose center lies
+inside them; polygons (e.g. a river basin read from GeoJSON) take the
+fraction of each cell they cover. Missing values are left out of the
+average rather than counted as zero.
+"""
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+
+N_SUB = 10  # sub-samples per cell side when measuring polygon coverage
+
+_WEIGHTS = {}  # weight matrices of this process, by grid and regions
+
+
+def box(name, lonmin, lonmax, latmin, latmax):
+    """A rectangular region
+    """
+    return dict(name=name, box=[lonmin, lonmax, latmin, latmax])
+
+
+def polygon(name, rings):
+    """A polygonal region
+
+    Args:
+        name: the name of the region
+        rings: a list of polygons, each a list of rings of (lon, lat) pairs
+            where the first ring is the outline and any others are holes, as
+            in the coordinates of a GeoJSON MultiPolygon
+    """
+    return dict(name=name, rings=[[np.asarray(r).tolist() for r in p] for p in rings])
+
+
+def read_geojson(path, name_field="name"):
+    """Read the Polygon and MultiPolygon features of a GeoJSON file as regions
+    """
+    with open(path) as fjson:
+        collection = json.load(fjson)
+    features = collection.get("features", [collection])
+    regions = []
+    for i, feature in enumerate(features):
+        geometry = feature["geometry"]
+        if geometry["type"] == "Polygon":
+            rings = [geometry["coordinates"]]
+        elif geometry["type"] == "MultiPolygon":
+            rings = geometry["coordinates"]
+        else:
+            continue
+        name = feature.get("properties", {}).get(name_field, "region_{}".format(i))
+        regions.append(polygon(name, rings))
+    return regions
+
+
+def subset(data, region):
+    """The grid cells of data whose centers lie inside a box
+    """
+    lonmin, lonmax, latmin, latmax = region["box"]
+    lon = data["lon"]
+    lat = data["lat"]
+    return data.isel(
+        lon=((lon >= lonmin) & (lon <= lonmax)).values,
+        lat=((lat >= latmin) & (lat <= latmax)).values,
+    )
+
+
+def cell_edges(centers):
+    """The edges of the cells around a 1D array of increasing or decreasing
+    centers, half way between neighbours and extended by half a step at
+    either end
+    """
+    centers = np.asarray(centers, dtype="float64")
+    if centers.size == 1:
+        return np.array([centers[0] - 0.5, centers[0] + 0.5])
+    mid = (centers[1:] + centers[:-1]) / 2
+    first = centers[0] - (mid[0] - centers[0])
+    last = centers[-1] + (centers[-1] - mid[-1])
+    return np.concatenate([[first], mid, [last]])
+
+
+def cell_area(lat, lon):
+    """The relative area of each (lat, lon) grid cell
+    """
+    lat_edges = np.deg2rad(np.clip(cell_edges(lat), -90, 90))
+    lon_edges = np.deg2rad(cell_edges(lon))
+    dsin = np.abs(np.diff(np.sin(lat_edges)))
+    dlon = np.abs(np.diff(lon_edges))
+    return np.outer(dsin, dlon)
+
+
+def _inside(rings, lon, lat):
+    """Whether each point is inside a polygon with holes
+    """
+    from matplotlib.path import Path  # pylint: disable=C0415
+
+    points = np.column_stack([lon, lat])
+    inside = Path(np.asarray(rings[0])).contains_points(points)
+    for hole in rings[1:]:
+        inside &= ~Path(np.asarray(hole)).contains_points(points)
+    return inside
+
+
+def coverage(region, lat, lon, n_sub=N_SUB):
+    """The fraction of each (lat, lon) grid cell inside a region
+    """
+    lat = np.asarray(lat, dtype="float64")
+    lon = np.asarray(lon, dtype="float64")
+    if "box" in region:
+        lonmin, lonmax, latmin, latmax = region["box"]
+        in_lat = (lat >= latmin) & (lat <= latmax)
+        in_lon = (lon >= lonmin) & (lon <= lonmax)
+        return np.outer(in_lat, in_lon).astype("float64")
+
+    frac = np.zeros((lat.size, lon.size))
+    lat_edges = cell_edges(lat)
+    lon_edges = cell_edges(lon)
+    offsets = (np.arange(n_sub) + 0.5) / n_sub
+    for rings in region["rings"]:
+        outline = np.asarray(rings[0])
+        # only look at the cells that overlap the polygon's bounding box
+        ilat = np.where(
+            (np.maximum(lat_edges[:-1], lat_edges[1:]) >= outline[:, 1].min())
+            & (np.minimum(lat_edges[:-1], lat_edges[1:]) <= outline[:, 1].max())
+        )[0]
+        ilon = np.where(
+            (np.maximum(lon_edges[:-1], lon_edges[1:]) >= outline[:, 0].min())
+            & (np.minimum(lon_edges[:-1], lon_edges[1:]) <= outline[:, 0].max())
+        )[0]
+        if ilat.size == 0 or ilon.size == 0:
+            continue
+        sub_lat = lat_edges[ilat, None] + np.outer(
+            lat_edges[ilat + 1] - lat_edges[ilat], offsets
+        )
+        sub_lon = lon_edges[ilon, None] + np.outer(
+            lon_edges[ilon + 1] - lon_edges[ilon], offsets
+        )
+        # points ordered (lat cell, lat sub, lon cell, lon sub)
+        shape = sub_lat.shape + sub_lon.shape
+        plat = np.broadcast_to(sub_lat[:, :, None, None], shape)
+        plon = np.broadcast_to(sub_lon[None, None, :, :], shape)
+        inside = _inside(rings, plon.ravel(), plat.ravel()).reshape(plat.shape)
+        frac[np.ix_(ilat, ilon)] += inside.mean(axis=(1, 3))
+    return np.minimum(frac, 1.0)
+
+
+def _weights_key(lat, lon, regions, n_sub):
+    """Identify a weight matrix by its grid and regions
+    """
+    digest = hashlib.sha1()
+    digest.update(np.asarray(lat, dtype="float64").tobytes())
+    digest.update(np.asarray(lon, dtype="float64").tobytes())
+    digest.update(json.dumps([regions, n_sub], sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def weight_matrix(lat, lon, regions, n_sub=N_SUB, cache_dir=None):
+    """The sparse (region, cell) matrix of area times coverage
+
+    Cells are numbered in C order over (lat, lon). Matrices are kept in
+    memory for the life of the process and, if cache_dir is given, on disk.
+    """
+    from scipy import sparse  # pylint: disable=C0415
+
+    key = _weights_key(lat, lon, regions, n_sub)
+    if key in _WEIGHTS:
+        return _WEIGHTS[key]
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, "weights_{}.npz".format(key))
+        if os.path.isfile(cache_file):
+            _WEIGHTS[key] = sparse.load_npz(cache_file).tocsr()
+            return _WEIGHTS[key]
+    area = cell_area(lat, lon).ravel()
+    rows = [
+        sparse.csr_matrix(area * coverage(region, lat, lon, n_sub=n_sub).ravel())
+        for region in regions
+    ]
+    weights = sparse.vstack(rows, format="csr")
+    weights.eliminate_zeros()
+    if cache_file is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        sparse.save_npz(cache_file, weights)
+    _WEIGHTS[key] = weights
+    return weights
+
+
+def _weighted_mean(values, weights):
+    """Average (..., lat, lon) values with a (region, cell) matrix, skipping NaN
+    """
+    shape = values.shape[:-2]
+    flat = values.reshape((-1, values.shape[-2] * values.shape[-1]))
+    valid = ~np.isnan(flat)
+    total = weights.dot(np.where(valid, flat, 0).T)
+    norm = weights.dot(valid.T.astype("float64"))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = (total / norm).T
+    return mean.reshape(shape + (weights.shape[0],)).astype(values.dtype)
+
+
+def regional_mean(data, regions, n_sub=N_SUB, cache_dir=None):
+    """Area-weighted averages of data over each region
+
+    Args:
+        data: a DataArray or Dataset with lat and lon dimensions; variables
+            without them are passed through
+        regions: a list of regions made with box, polygon or read_geojson
+        n_sub: sub-samples per cell side when measuring polygon coverage
+        cache_dir: where to keep the weight matrices between runs
+    Returns:
+        data with lat and lon replaced by a region dimension
+    """
+    import xarray as xr  # pylint: disable=C0415
+
+    weights = weight_matrix(
+        data["lat"].values,
+        data["lon"].values,
+        regions,
+        n_sub=n_sub,
+        cache_dir=cache_dir,
+    )
+
+    def _reduce(var):
+        if not np.issubdtype(var.dtype, np.floating):
+            var = var.astype("float64")
+        if var.chunks is not None:
+            # each block must hold whole maps
+            var = var.chunk({"lat": -1, "lon": -1})
+        return xr.apply_ufunc(
+            _weighted_mean,
+            var,
+            kwargs=dict(weights=weights),
+            input_core_dims=[["lat", "lon"]],
+            output_core_dims=[["region"]],
+            dask="parallelized",
+            output_dtypes=[var.dtype],
+            dask_gufunc_kwargs=dict(output_sizes={"region": len(regions)}),
+            keep_attrs=True,
+        )
+
+    names = [region["name"] for region in regions]
+    if isinstance(data, xr.DataArray):
+        return _reduce(data).assign_coords(region=names)
+    reduced = OrderedDict(
+        (name, _reduce(var) if {"lat", "lon"} <= set(var.dims) else var)
+        for name, var in data.data_vars.items()
+    )
+    return xr.Dataset(reduced, attrs=data.attrs).assign_coords(region=names)
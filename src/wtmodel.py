@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""A fitted weather type classification, kept as one small .npz file
+
+make_weather_type --model saves everything needed to classify new days
+without fitting anything again: the grid and time mean of the anomalies the
+EOFs were computed from, the loadings of the EOFs retained, the mean and
+standard deviation that re-scale the PCs, the centroids of the chosen
+(best_part) KMeans partition and the weather type of each of its labels, as
+numbered by resort_labels.
+
+A day is then classified by one projection onto the EOFs and a search for
+the nearest centroid, as KMeans itself labels the days it was fitted on:
+
+    model = wtmodel.load("data/processed/weather_type_model.npz")
+    wtype = wtmodel.assign(model, anomaly)  # (time, lat, lon) anomalies
+
+The anomalies must be computed against the same climatology as those the
+model was fitted on (see make_anomaly).
+"""
+
+import os
+import numpy as np
+import instrument
+
+FIELDS = [
+    "lon",  # the grid, stacked lon-major as calc_pcs does
+    "lat",
+    "mean",  # (grid,) the mean removed before projecting
+    "loadings",  # (n_components, grid) the EOFs retained
+    "pc_mean",  # (n_components,) mean and standard deviation of the PCs
+    "pc_scale",
+    "centroids",  # (n_cluster, n_components) of the re-scaled PCs
+    "wtypes",  # (n_cluster,) the weather type of each KMeans label
+]
+
+
+def save(path, **model):
+    """Write a model file atomically
+
+    Args:
+        path: the .npz file to write
+        model: the arrays of FIELDS, plus any scalar metadata such as the
+            classifiability of the partition
+    """
+    missing = [field for field in FIELDS if field not in model]
+    if missing:
+        raise ValueError("the model has no {}".format(", ".join(missing)))
+    dirname = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with instrument.phase("write"):
+        with open(path + ".part", "wb") as fnpz:
+            np.savez(fnpz, **model)
+        os.replace(path + ".part", path)
+    instrument.add_output(path)
+
+
+def load(path):
+    """The arrays of a model file, by name
+    """
+    with np.load(path) as saved:
+        model = {key: saved[key] for key in saved.files}
+    # the squared norms of the centroids, for the nearest centroid search
+    model["_sq_norm"] = (model["centroids"] ** 2).sum(axis=1)
+    return model
+
+
+def project(model, values):
+    """The re-scaled PCs of (time, grid) anomalies
+    """
+    pcs = (values - model["mean"]).dot(model["loadings"].T)
+    return (pcs - model["pc_mean"]) / model["pc_scale"]
+
+
+def assign_values(model, values):
+    """The weather type of each row of (time, grid) anomalies
+
+    The nearest centroid minimizes |c|^2 - 2 x.c, which needs a single matrix
+    product for all days and centroids.
+    """
+    pcs = project(model, np.atleast_2d(values))
+    sq_norm = model.get("_sq_norm")
+    if sq_norm is None:
+        sq_norm = (model["centroids"] ** 2).sum(axis=1)
+    nearest = (sq_norm - 2 * pcs.dot(model["centroids"].T)).argmin(axis=1)
+    return model["wtypes"][nearest]
+
+
+def assign(model, anomaly, tolerance=1e-4):
+    """The weather type of each time step of a DataArray of anomalies
+
+    Args:
+        model: the output of load
+        anomaly: a (time, lat, lon) DataArray, in any order of dimensions,
+            covering the grid of the model
+        tolerance: how far, in degrees, the grid may be from the model's
+    Returns:
+        a DataArray of weather types along time
+    """
+    import xarray as xr  # pylint: disable=C0415
+
+    anomaly = anomaly.sel(lon=model["lon"], lat=model["lat"], method="nearest")
+    offset = max(
+        np.abs(anomaly["lon"].values - model["lon"]).max(),
+        np.abs(anomaly["lat"].values - model["lat"]).max(),
+    )
+    if offset > tolerance:
+        raise ValueError("the anomalies are not on the grid of the model")
+    values = anomaly.transpose("time", "lon", "lat").values
+    wtypes = assign_values(model, values.reshape((values.shape[0], -1)))
+    return xr.DataArray(
+        wtypes, dims="time", coords=dict(time=anomaly["time"].values), name="wtype"
+    )